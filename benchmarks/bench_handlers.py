@@ -0,0 +1,133 @@
+"""
+Compare the connection handlers (see pdt_handler.py) of a challenge on a real docker daemon.
+
+Usage: python3 benchmarks/bench_handlers.py [--parent ubuntu:20.04] [--handlers xinetd,socat] [-c 1,16]
+                                            [-n sessions] [--idle N] [--port 29000]
+
+For every handler an image of the same tiny challenge (print a banner, then echo one line) is built from the
+parent image in a temporary workspace and one container of it is started. Then:
+- accept latency: sessions connect and wait for the banner, at every concurrency level of -c. The time to the
+  banner covers accepting, forking and exec'ing the entry file, which is what differs between handlers.
+- memory per connection: --idle sessions are kept open at the banner, the growth of the memory usage of the
+  container (from docker stats) divided by the count of sessions. The usage of the idle container is reported
+  as well.
+The images and containers are removed afterwards, the shared base images are kept for later runs.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import pdt_factory                          # noqa: E402
+import pdt_loadgen                          # noqa: E402
+from pdt_handler import HANDLERS            # noqa: E402
+from pdt_health import PROBE_HOST           # noqa: E402
+from util import PrettyPrinter              # noqa: E402
+from helpers import Workspace               # noqa: E402
+
+BANNER = 'ready'
+CHALLENGE = f'#!/bin/sh\necho {BANNER}\nread line\necho "$line"\n'
+
+
+def memory_usage(container) -> int:
+    """
+    memory used by the container in bytes, without the page cache, like docker stats shows it.
+    """
+    stats = container.stats(stream=False)['memory_stats']
+    cache = stats.get('stats', {}).get('inactive_file', stats.get('stats', {}).get('cache', 0))
+    return stats.get('usage', 0) - cache
+
+
+async def hold(port: int, count: int, measure):
+    """
+    open count sessions, wait for the banner of every one of them, call measure() and close them.
+    :return: result of measure() and the count of sessions that got the banner
+    """
+    async def one():
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(PROBE_HOST, port), 5)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        try:
+            await asyncio.wait_for(reader.readuntil(BANNER.encode()), 5)
+            return writer
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            writer.close()
+            return None
+    writers = [w for w in await asyncio.gather(*(one() for _ in range(count))) if w is not None]
+    await asyncio.sleep(0.5)    # let the forked sessions settle
+    try:
+        return await asyncio.to_thread(measure), len(writers)
+    finally:
+        for w in writers:
+            w.close()
+
+
+def bench_handler(args, handler: str, port: int) -> list:
+    name = f'bench_{handler}'
+    factory = pdt_factory.PdtFactory(None)
+    pdt_factory.factory = factory
+    for command in (['new', name], ['select', name], ['set', 'parent', args.parent],
+                    ['set', 'basedir', 'challenge'], ['set', 'deploy', '-a', 'chal'], ['set', 'entry', 'chal'],
+                    ['set', 'port', '10001'], ['set', 'handler', handler], ['build'],
+                    ['run', '-n', '1', '-p', str(port), '--wait', '60', '--banner', BANNER]):
+        factory.arg_parser(command)
+    image = factory.select_list
+    try:
+        containers = list(image.containers.values())
+        if len(containers) == 0 or containers[0].container_object is None:
+            PrettyPrinter.error(f'Failed to start a container with handler {handler}.')
+            return [handler] + ['-'] * 6
+        container = containers[0].container_object
+        idle = memory_usage(container)
+        reports = pdt_loadgen.bench(port, pdt_loadgen.parse_script(f'expect {BANNER}'), args.c, args.n)
+        held, opened = asyncio.run(hold(port, args.idle, lambda: memory_usage(container)))
+        per_connection = (held - idle) / opened if opened else None
+        best = reports[-1]
+        return [handler, f'{idle / 2 ** 20:.1f}',
+                f'{per_connection / 2 ** 10:.0f}' if per_connection is not None else '-', f'{opened}/{args.idle}',
+                best.percentile(best.latency, 0.5), best.percentile(best.latency, 0.99),
+                ', '.join(f'c{r.concurrency}: {r.ok / r.wall:.0f}/s, {r.error_rate:.0%} err' for r in reports)]
+    finally:
+        factory.arg_parser(['rm', 'image', name, '-y'])
+        factory.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Compare accept latency and memory of the connection handlers.')
+    parser.add_argument('--parent', default='ubuntu:20.04', help='parent image, it must exist on the host')
+    parser.add_argument('--handlers', default=','.join(sorted(HANDLERS)), help='comma separated handlers')
+    parser.add_argument('-c', type=lambda v: [int(x) for x in v.split(',')], default=[1, 16],
+                        help='concurrency levels of the latency test')
+    parser.add_argument('-n', type=int, default=200, help='sessions of every level')
+    parser.add_argument('--idle', type=int, default=50, help='sessions held open for the memory test')
+    parser.add_argument('--port', type=int, default=29000, help='first outer port, one port per handler')
+    args = parser.parse_args()
+    handlers = args.handlers.split(',')
+    for h in handlers:
+        if h not in HANDLERS:
+            parser.error(f'unknown handler {h}, one of {", ".join(sorted(HANDLERS))} expected')
+
+    workspace = Workspace()
+    rows = []
+    try:
+        workspace.reset()
+        os.mkdir('challenge')
+        with open('challenge/chal', 'w') as f:
+            f.write(CHALLENGE)
+        os.chmod('challenge/chal', 0o755)
+        for i, handler in enumerate(handlers):
+            rows.append(bench_handler(args, handler, args.port + i))
+    finally:
+        workspace.close()
+    print(PrettyPrinter.table(rows, ['handler', 'idle MiB', 'KiB / conn', 'held', f'p50 ms (c{args.c[-1]})',
+                                     f'p99 ms (c{args.c[-1]})', 'levels']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
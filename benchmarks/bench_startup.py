@@ -0,0 +1,115 @@
+"""
+Startup benchmark of PDT: import time of every module and wall-clock time of pure-config commands.
+
+Usage: python3 benchmarks/bench_startup.py [-n runs] [--images count] [--target ms]
+
+PDT is copied into a temporary working directory with a generated config of --images images, so the real
+runtime directory is never touched. The exit code is 1 if the median time of any command exceeds the target.
+The startup of a bare interpreter is measured as well and subtracted to show what PDT itself costs: it varies a
+lot between hosts, .pth files in site-packages which import packages at startup can take most of the target.
+"""
+import argparse
+import compileall
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = [
+    ['command', 'list', 'select'],
+    ['command', 'list', 'apt'],
+    ['command', 'select', 'pwn_0'],
+]
+HEAVY_MODULES = ('docker', 'yaml', 'pandas', 'requests')
+
+
+def prepare_workdir(images: int) -> str:
+    workdir = tempfile.mkdtemp(prefix='pdt-bench-')
+    for f in os.listdir(ROOT):
+        if f.endswith('.py'):
+            shutil.copy(os.path.join(ROOT, f), workdir)
+    shutil.copytree(os.path.join(ROOT, 'templates'), os.path.join(workdir, 'templates'))
+    # like an installed tree, otherwise PYTHONDONTWRITEBYTECODE makes every run compile every module
+    compileall.compile_dir(workdir, quiet=1)
+    os.makedirs(os.path.join(workdir, 'runtime', 'deploy_files', 'zips'))
+    with open(os.path.join(workdir, 'runtime', 'config.yaml'), 'w') as f:
+        for i in range(images):
+            f.write(f"- name: pwn_{i}\n"
+                    f"  parent image id: null\n"
+                    f"  image id: null\n"
+                    f"  apt list: !!set {{xinetd: null, lib32z1: null}}\n"
+                    f"  base directory: {workdir}\n"
+                    f"  deployed files: !!set {{pwn: null}}\n"
+                    f"  entry file: pwn\n"
+                    f"  port: 10001\n"
+                    f"  containers: {{}}\n")
+    return workdir
+
+
+def import_times(workdir: str) -> list[tuple[int, str]]:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import pdt_factory'],
+                            cwd=workdir, capture_output=True, text=True)
+    ret = []
+    for line in result.stderr.splitlines():
+        if match := re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line):
+            if len(match.group(2)) == 1:    # top level imports only
+                ret.append((int(match.group(1)), match.group(3)))
+            elif match.group(3).split('.')[0] in HEAVY_MODULES:
+                ret.append((int(match.group(1)), match.group(3)))
+    return sorted(ret, reverse=True)
+
+
+def time_command(workdir: str, args: list[str], runs: int) -> list[float]:
+    ret = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'pdt.py'] + args, cwd=workdir, stdout=subprocess.DEVNULL, check=True)
+        ret.append((time.perf_counter() - start) * 1000)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20, help='runs of every command')
+    parser.add_argument('--images', type=int, default=50, help='count of images in the generated config')
+    parser.add_argument('--target', type=float, default=100.0, help='median time in ms a command may take')
+    args = parser.parse_args()
+
+    workdir = prepare_workdir(args.images)
+    try:
+        print('slowest imports of pdt_factory (cumulative us):')
+        imports = import_times(workdir)
+        for us, module in imports[:10]:
+            print(f'  {us:>8}  {module}')
+        heavy = sorted({m.split('.')[0] for _, m in imports if m.split('.')[0] in HEAVY_MODULES})
+        print(f'heavy modules imported at startup: {", ".join(heavy) if heavy else "none"}')
+
+        baseline = statistics.median([_interpreter_startup() for _ in range(args.n)])
+        bare = statistics.median([_interpreter_startup(['-S']) for _ in range(args.n)])
+        print(f'interpreter startup: {baseline:.1f}ms, {bare:.1f}ms without site')
+        failed = False
+        for command in COMMANDS:
+            times = time_command(workdir, command, args.n)
+            median = statistics.median(times)
+            over = median > args.target
+            failed |= over
+            print(f'{" ".join(command):<28} min {min(times):6.1f}ms  median {median:6.1f}ms  '
+                  f'max {max(times):6.1f}ms  +{median - baseline:5.1f}ms  {"FAIL" if over else "ok"}')
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(1 if failed else 0)
+
+
+def _interpreter_startup(options: list[str] | None = None) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + (options or []) + ['-c', 'pass'], check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+Benchmark suite of PDT's own overhead. The real PdtFactory, PdtImage and PdtContainer code runs against
+FakeDockerClient (see tests/helpers.py), so no docker daemon is needed and the latency of the daemon is injected.
+
+Usage: python3 benchmarks/bench_suite.py [scenario ...] [-r repeats] [--latency ms] [--images N] [--containers N]
+                                          [--files N] [--file-size bytes] [-j jobs]
+                                          [--save-baseline file] [--baseline file] [--tolerance ratio]
+
+Every scenario is run -r times on a fresh workspace in a temporary directory, the median wall-clock time is
+reported with the peak memory allocated (measured with tracemalloc in one extra run) and the count of docker API
+calls. A scenario fails if its median time exceeds the threshold in THRESHOLDS (defined for the default
+parameters), or, with --baseline, if its time or memory grows by more than --tolerance over the saved baseline.
+The exit code is 1 if any scenario fails.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import pdt_factory                          # noqa: E402
+import pdt_object                           # noqa: E402
+from pdt_store import ConfigStore           # noqa: E402
+from helpers import PARENT, FakeDockerClient, Workspace, new_factory  # noqa: E402
+
+# median milliseconds allowed for every scenario with the default parameters
+THRESHOLDS = {
+    'startup': 1500,
+    'new': 300,
+    'build-cold': 3000,
+    'build-warm': 1000,
+    'run': 1500,
+    'list-status': 500,
+    'teardown': 1500,
+    'store-commit': 50,
+    'store-compact': 3000,
+    'store-load': 3000,
+}
+
+
+def make_tree(path: str, files: int, size: int) -> None:
+    """
+    create a deploy tree of small directories, with mtimes old enough for the digest index to remember them.
+    """
+    old = time.time() - 3600
+    os.makedirs(path, exist_ok=True)
+    for i in range(files):
+        directory = os.path.join(path, f'd{i // 100}')
+        os.makedirs(directory, exist_ok=True)
+        file = os.path.join(directory, f'f{i}')
+        with open(file, 'wb') as f:
+            f.write(os.urandom(size))
+        os.utime(file, (old, old))
+    with open(os.path.join(path, 'pwn'), 'wb') as f:
+        f.write(b'\x7fELF' + os.urandom(size))
+    os.utime(os.path.join(path, 'pwn'), (old, old))
+
+
+def make_config(images: int, containers: int, client: FakeDockerClient | None) -> list[dict]:
+    """
+    generate the config of built images with running containers, the docker objects are put into the fake client.
+    """
+    parent = client.images.add([PARENT]) if client is not None else None
+    ret = []
+    port = 20000
+    for i in range(images):
+        name = f'pwn_{i}'
+        image = client.images.add([f'{name}:latest']) if client is not None else None
+        recorded = {}
+        for j in range(1, containers + 1):
+            flag = f'flag{{{name}_{j}}}'
+            container_id = None
+            if client is not None:
+                labels = {pdt_object.LABEL_MANAGED: 'true', pdt_object.LABEL_IMAGE: name,
+                          pdt_object.LABEL_FLAG: pdt_object.flag_id(flag), pdt_object.LABEL_PORT: str(port)}
+                container = client.containers.run(f'{name}:latest', ports={'10001/tcp': ('0.0.0.0', port)},
+                                                  labels=labels, detach=True)
+                container_id = container.short_id
+            recorded[j] = {'flag': flag, 'mapping port': port, 'container id': container_id}
+            port += 1
+        ret.append({
+            'name': name,
+            'parent image id': parent.short_id[7:] if parent is not None else None,
+            'image id': image.short_id[7:] if image is not None else None,
+            'apt list': {'xinetd', 'lib32z1'},
+            'base directory': os.getcwd(),
+            'deployed files': {'pwn'},
+            'entry file': 'pwn',
+            'port': 10001,
+            'stop timeout': 2,
+            'stable ids': False,
+            'containers': recorded
+        })
+    return ret
+
+
+def ready_image(args, client: FakeDockerClient) -> pdt_factory.PdtFactory:
+    """
+    a factory with one configured and built image 'pwn'.
+    """
+    client.images.add([PARENT])
+    factory = new_factory(client)
+    make_tree('problem', 0, 1024)
+    for command in (['new', 'pwn'], ['select', 'pwn'], ['set', 'parent', PARENT],
+                    ['set', 'basedir', 'problem'], ['set', 'deploy', '-a', 'pwn'], ['set', 'entry', 'pwn'],
+                    ['set', 'port', '10001'], ['build']):
+        factory.arg_parser(command)
+    return factory
+
+
+'''****************************** scenarios ******************************'''
+# every scenario prepares the workspace and returns the function to be measured
+
+
+def bench_startup(args, client):
+    store = ConfigStore()
+    store.compact([_Config(i) for i in make_config(args.images, args.containers, client)])
+
+    def run():
+        factory = new_factory(client, ConfigStore().load())
+        factory.connect()
+    return run
+
+
+def bench_new(args, client):
+    client.images.add([PARENT])
+    factory = new_factory(client)
+    return lambda: factory.arg_parser(['new', f'pwn*{args.images * 10}'])
+
+
+def deploy_tree(args, factory: pdt_factory.PdtFactory) -> None:
+    make_tree('problem', args.files, args.file_size)
+    directories = [f'd{i}' for i in range((args.files + 99) // 100)]
+    factory.arg_parser(['set', 'deploy'] + [a for d in directories for a in ('-a', d)])
+
+
+def bench_build_cold(args, client):
+    factory = ready_image(args, client)
+    deploy_tree(args, factory)
+    return lambda: factory.arg_parser(['build'])
+
+
+def bench_build_warm(args, client):
+    factory = ready_image(args, client)
+    deploy_tree(args, factory)
+    factory.arg_parser(['build'])    # fills the archive cache and the digest index
+    return lambda: factory.arg_parser(['build'])
+
+
+def bench_run(args, client):
+    factory = ready_image(args, client)
+    return lambda: factory.arg_parser(['run', '-n', str(args.containers * 10), '-j', str(args.jobs)])
+
+
+def bench_list_status(args, client):
+    factory = new_factory(client, make_config(args.images, args.containers, client))
+    factory.connect()
+    return lambda: factory.arg_parser(['list', 'status'])
+
+
+def bench_teardown(args, client):
+    factory = ready_image(args, client)
+    count = args.containers * 10
+    factory.arg_parser(['run', '-n', str(count), '-j', str(args.jobs)])
+    return lambda: factory.arg_parser(['rm', 'container', f'pwn.1-{count}', '-j', str(args.jobs)])
+
+
+def bench_store_commit(args, client):
+    images = [_Config(i) for i in make_config(args.images, args.containers, None)]
+    store = ConfigStore()
+    store.compact(images)
+    return lambda: store.commit(images[:1], [], sync=True)
+
+
+def bench_store_compact(args, client):
+    images = [_Config(i) for i in make_config(args.images, args.containers, None)]
+    store = ConfigStore()
+    return lambda: store.compact(images)
+
+
+def bench_store_load(args, client):
+    images = [_Config(i) for i in make_config(args.images, args.containers, None)]
+    store = ConfigStore()
+    store.compact(images)
+    for _ in range(100):    # a journal which is not compacted yet
+        store.commit(images[:1], [], sync=False)
+    store.close()
+    return lambda: ConfigStore().load()
+
+
+class _Config:
+    """
+    stands for a PdtImage in ConfigStore, which only needs its config.
+    """
+
+    def __init__(self, info: dict):
+        self.name: str = info['name']
+        self.info_dict_for_config: dict = info
+
+
+SCENARIOS = {
+    'startup': bench_startup,
+    'new': bench_new,
+    'build-cold': bench_build_cold,
+    'build-warm': bench_build_warm,
+    'run': bench_run,
+    'list-status': bench_list_status,
+    'teardown': bench_teardown,
+    'store-commit': bench_store_commit,
+    'store-compact': bench_store_compact,
+    'store-load': bench_store_load,
+}
+
+
+def measure(workspace: Workspace, scenario, args, trace: bool) -> tuple[float, int, int, list[str]]:
+    """
+    :return: wall-clock milliseconds, peak bytes allocated (0 if not traced), docker API calls, errors printed by PDT
+    """
+    workspace.reset()
+    client = FakeDockerClient(latency=args.latency / 1000, build_latency=args.build_latency / 1000)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        run = scenario(args, client)
+        calls = client.stats['calls']
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        run()
+        elapsed = (time.perf_counter() - start) * 1000
+        peak = 0
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    client.close()
+    errors = [line for line in output.getvalue().splitlines() if pdt_object.PDT_ERROR in line]
+    return elapsed, peak, client.stats['calls'] - calls, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenarios', nargs='*', help=f'scenarios to run, all by default: {", ".join(SCENARIOS)}')
+    parser.add_argument('-r', type=int, default=5, help='runs of every scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds every docker API call takes')
+    parser.add_argument('--build-latency', type=float, default=0.0, help='milliseconds every image build takes')
+    parser.add_argument('--images', type=int, default=50, help='count of images in generated state')
+    parser.add_argument('--containers', type=int, default=20, help='count of containers of every image')
+    parser.add_argument('--files', type=int, default=2000, help='count of files in the deploy tree')
+    parser.add_argument('--file-size', type=int, default=4096, help='size of every deployed file')
+    parser.add_argument('-j', '--jobs', type=int, default=pdt_object.DEFAULT_RUN_JOBS, help='jobs of run/rm')
+    parser.add_argument('--save-baseline', help='save the results as a baseline to this file')
+    parser.add_argument('--baseline', help='compare with the baseline saved in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='growth over the baseline allowed')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    default_params = all(parser.get_default(k) == v for k, v in vars(args).items()
+                         if k not in ('scenarios', 'r', 'save_baseline', 'baseline', 'tolerance'))
+
+    results = {}
+    failed = False
+    workspace = Workspace()
+    try:
+        print(f'{"scenario":<14} {"median":>10} {"min":>10} {"max":>10} {"peak mem":>10} {"calls":>6}  result')
+        for name in args.scenarios or SCENARIOS:
+            times = []
+            calls = 0
+            errors = []
+            for _ in range(args.r):
+                elapsed, _, calls, errors = measure(workspace, SCENARIOS[name], args, trace=False)
+                times.append(elapsed)
+            _, peak, _, _ = measure(workspace, SCENARIOS[name], args, trace=True)
+            median = statistics.median(times)
+            results[name] = {'median ms': median, 'peak bytes': peak}
+            problems = []
+            if errors:     # a scenario which failed halfway measures nothing
+                problems.append(f'{len(errors)} error(s), first: {errors[0].split(pdt_object.PDT_ERROR)[1]}')
+            if default_params and median > THRESHOLDS[name]:
+                problems.append(f'> {THRESHOLDS[name]}ms')
+            if name in baseline:
+                if median > baseline[name]['median ms'] * (1 + args.tolerance):
+                    problems.append(f'time +{median / baseline[name]["median ms"] - 1:.0%}')
+                if peak > baseline[name]['peak bytes'] * (1 + args.tolerance):
+                    problems.append(f'memory +{peak / baseline[name]["peak bytes"] - 1:.0%}')
+            failed |= len(problems) != 0
+            print(f'{name:<14} {median:>8.1f}ms {min(times):>8.1f}ms {max(times):>8.1f}ms '
+                  f'{peak / 2 ** 20:>8.1f}MB {calls:>6}  {"FAIL " + ", ".join(problems) if problems else "ok"}')
+    finally:
+        workspace.close()
+    if not default_params:
+        print('thresholds are defined for the default parameters and were not checked')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
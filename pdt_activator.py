@@ -0,0 +1,198 @@
+import time
+import asyncio
+import threading
+import collections
+from util import *
+from pdt_proxy import LoopThread, relay, PROXY_HOST, PROXY_CONNECT_TIMEOUT
+import pdt_health
+
+docker = LazyModule('docker')
+
+COLD_START_TIMEOUT = 30.0   # seconds a started container may take to accept connections
+REAP_INTERVAL = 5.0         # seconds between two checks for idle containers
+COLD_START_SAMPLES = 100
+
+
+class Activation:
+    """
+    Holds the outer port of an on-demand container on the host. The container publishes its port on a loopback
+    backend port only, it is started by the first connection and stopped again by the reaper when it has been
+    without connections for idle_timeout seconds.
+    """
+
+    def __init__(self, key, port: int, backend_port: int, container_object, idle_timeout: int, stop_timeout: int):
+        self.key = key      # (image name, container id)
+        self.port: int = port
+        self.backend_port: int = backend_port
+        self.container_object = container_object
+        self.idle_timeout: int = idle_timeout
+        self.stop_timeout: int = stop_timeout
+        self.running: bool = container_object.status == 'running'
+        self.stopping: bool = False
+        self.active: int = 0
+        self.connections: int = 0
+        self.starts: int = 0
+        self.stops: int = 0
+        self.cold: collections.deque = collections.deque(maxlen=COLD_START_SAMPLES)     # cold start ms
+        self.last_active: float = time.monotonic()
+        self.__transition: asyncio.Lock | None = None   # starting and stopping never overlap
+        self.__server: asyncio.AbstractServer | None = None
+
+    @property
+    def signature(self) -> tuple:
+        return self.port, self.backend_port, self.container_object.id
+
+    async def listen(self) -> None:
+        self.__transition = asyncio.Lock()
+        self.__server = await asyncio.start_server(self.__handle, PROXY_HOST, self.port, reuse_address=True)
+
+    async def close(self) -> None:
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+
+    async def __ensure_running(self) -> bool:
+        # a connection arriving while the reaper stops the container waits for the stop and starts it again
+        if self.running and not self.__transition.locked():
+            return True
+        async with self.__transition:
+            if self.running:
+                return True
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self.container_object.start)
+            except (docker.errors.APIError, OSError) as e:     # OSError: the docker daemon is unreachable
+                PrettyPrinter.error(f'Failed to start container {self.key[0]}.{self.key[1]}: {e}')
+                return False
+            results = await pdt_health.wait_ready([(self.key, self.backend_port)], COLD_START_TIMEOUT)
+            self.running = True
+            self.starts += 1
+            if results[self.key].ok:
+                self.cold.append((time.perf_counter() - start) * 1000)
+            return results[self.key].ok
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.active += 1
+        self.connections += 1
+        try:
+            if not await self.__ensure_running():
+                writer.close()
+                return
+            try:
+                up_reader, up_writer = await asyncio.wait_for(
+                    asyncio.open_connection(pdt_health.PROBE_HOST, self.backend_port), PROXY_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                self.running = False    # stopped or crashed behind our back, the next connection starts it again
+                writer.close()
+                return
+            await relay(reader, writer, up_reader, up_writer)
+        finally:
+            self.active -= 1
+            self.last_active = time.monotonic()
+
+    async def reap(self) -> None:
+        if not self.running or self.active != 0 or time.monotonic() - self.last_active < self.idle_timeout:
+            return
+        async with self.__transition:
+            if not self.running or self.active != 0:
+                return
+            self.running, self.stopping = False, True
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, lambda: self.container_object.stop(timeout=self.stop_timeout))
+            except (docker.errors.APIError, OSError) as e:     # OSError: the docker daemon is unreachable
+                PrettyPrinter.error(f'Failed to stop idle container {self.key[0]}.{self.key[1]}: {e}')
+                self.running = True
+                return
+            finally:
+                self.stopping = False
+            self.stops += 1
+
+    def row(self) -> list:
+        cold = sorted(self.cold)
+        return [self.key[0], self.key[1], self.port, self.backend_port,
+                'stopping' if self.stopping else 'running' if self.running else 'stopped', self.active, self.connections, self.starts, self.stops,
+                f'{cold[len(cold) // 2]:.0f}' if cold else '-', f'{cold[-1]:.0f}' if cold else '-',
+                f'{time.monotonic() - self.last_active:.0f}' if self.active == 0 else '-']
+
+
+class Activator:
+    """
+    Activations of all on-demand containers, served by one event loop on a background thread together with the
+    idle reaper.
+    """
+    HEADERS = ['image', 'id', 'port', 'backend port', 'state', 'active', 'connections', 'starts', 'stops',
+               'cold start p50 ms', 'cold start max ms', 'idle s']
+
+    def __init__(self):
+        self.__thread: LoopThread = LoopThread('pdt-activator')
+        self.__activations: dict = {}
+        self.__reaper: asyncio.Task | None = None
+        self.__lock = threading.Lock()
+
+    def sync(self, specs: list[tuple]) -> None:
+        """
+        make the activations match the on-demand containers.
+        :param specs: (key, port, backend port, container object, idle timeout, stop timeout) of every container
+        """
+        if len(specs) == 0 and len(self.__activations) == 0:
+            return      # the loop thread is only started for the first on-demand container
+        self.__thread.call(self.__sync(specs))
+
+    async def __sync(self, specs: list[tuple]) -> None:
+        wanted = {}
+        for key, port, backend_port, container_object, idle_timeout, stop_timeout in specs:
+            wanted[key] = Activation(key, port, backend_port, container_object, idle_timeout, stop_timeout)
+        with self.__lock:
+            current = dict(self.__activations)
+        for key, activation in current.items():
+            fresh = wanted.get(key)
+            if fresh is None or fresh.signature != activation.signature:
+                await activation.close()
+                with self.__lock:
+                    del self.__activations[key]
+            else:
+                activation.idle_timeout, activation.stop_timeout = fresh.idle_timeout, fresh.stop_timeout
+        for key, activation in wanted.items():
+            if key in self.__activations:
+                continue
+            try:
+                await activation.listen()
+            except OSError as e:
+                PrettyPrinter.error(f'Failed to listen on port {activation.port} for {key[0]}.{key[1]}: {e}')
+                continue
+            with self.__lock:
+                self.__activations[key] = activation
+        if self.__reaper is None:
+            self.__reaper = asyncio.create_task(self.__reap_loop())
+
+    async def __reap_loop(self) -> None:
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            with self.__lock:
+                activations = list(self.__activations.values())
+            await asyncio.gather(*(a.reap() for a in activations))
+
+    def rows(self) -> list[list]:
+        if len(self.__activations) == 0:
+            return []
+        return self.__thread.call(self.__rows())
+
+    async def __rows(self) -> list[list]:
+        # read the counters in the loop thread, where they change
+        with self.__lock:
+            return [a.row() for _, a in sorted(self.__activations.items())]
+
+    def close(self) -> None:
+        if self.__reaper is not None:
+            self.__thread.call(self.__shutdown())
+        self.__thread.stop()
+
+    async def __shutdown(self) -> None:
+        await self.__sync([])
+        self.__reaper.cancel()
+        try:
+            await self.__reaper
+        except asyncio.CancelledError:
+            pass
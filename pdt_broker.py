@@ -0,0 +1,267 @@
+from __future__ import annotations
+import json
+import time
+import socket
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import TYPE_CHECKING
+from util import *
+from pdt_lease import Lease, requester_id
+
+if TYPE_CHECKING:
+    from pdt_object import PdtImage, PdtContainer
+
+DEFAULT_BROKER_LISTEN = '127.0.0.1:8040'
+BROKER_RECLAIM_INTERVAL = float(os.environ.get('PDT_BROKER_RECLAIM_INTERVAL', 10.0))    # seconds between reclaims
+
+
+class BrokerError(Exception):
+    def __init__(self, status: int, message: str, **details):
+        super().__init__(message)
+        self.status: int = status
+        self.details: dict = details
+
+
+class InstanceBroker:
+    """
+    Hands out containers of images to requesters identified by tokens. A lease takes an unleased running container
+    of the image, or a pooled one, or a new one, in this order. Expired and released containers are removed rather
+    than handed out again, since the previous requester may have changed them. A container docker fails to remove
+    is retired: it keeps its lease, expired, so it is never handed out and the next reclaim removes it.
+    Every operation runs between commands, through between_commands, as it changes the images and the config.
+    """
+    HEADERS = ['image', 'id', 'port', 'requester', 'expires in s']
+
+    def __init__(self, images, between_commands, connect, on_change):
+        """
+        :param images: image registry of the factory
+        :param between_commands: runs a function between two commands and persists the changes it made
+        :param connect: connects the factory to docker
+        :param on_change: called with an image after its containers were leased or removed
+        """
+        self.__images = images
+        self.between_commands = between_commands
+        self.__connect = connect
+        self.__on_change = on_change
+        self.host: str = ''
+        self.listen: tuple[str, int] | None = None
+        self.__server: ThreadingHTTPServer | None = None
+        self.__stopped: threading.Event = threading.Event()
+        self.stats: dict[str, int] = {'leased': 0, 'released': 0, 'expired': 0, 'rejected': 0}
+
+    @property
+    def running(self) -> bool:
+        return self.__server is not None
+
+    def start(self, listen: tuple[str, int], host: str) -> None:
+        """
+        :param listen: address of the HTTP endpoint
+        :param host: host returned to requesters, where the ports of containers are reachable
+        """
+        self.__server = ThreadingHTTPServer(listen, BrokerRequestHandler)
+        self.__server.daemon_threads = True
+        self.__server.broker = self
+        self.listen, self.host = listen, host
+        self.__stopped = threading.Event()
+        threading.Thread(target=self.__server.serve_forever, name='pdt-broker', daemon=True).start()
+        threading.Thread(target=self.__reclaim_loop, args=(self.__stopped,), name='pdt-broker-reclaim',
+                         daemon=True).start()
+
+    def stop(self) -> None:
+        if self.__server is None:
+            return
+        # not joined, the reclaimer may be waiting for the command stopping the broker, it exits after that
+        self.__stopped.set()
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__server = None
+
+    def __reclaim_loop(self, stopped: threading.Event) -> None:
+        while not stopped.wait(BROKER_RECLAIM_INTERVAL):
+            try:
+                self.between_commands(self.reclaim)
+            except Exception as e:
+                PrettyPrinter.error(f'Failed to reclaim instances: {type(e).__name__}: {e}')
+
+    '''****************************** operations, run between commands ******************************'''
+
+    def __image(self, name: str) -> PdtImage:
+        image = self.__images.get(name)
+        if image is None or not image.broker.enabled:
+            raise BrokerError(404, f'no image {name} served by the broker')
+        return image
+
+    @staticmethod
+    def leased(image: PdtImage) -> list[PdtContainer]:
+        """
+        :return: containers with a lease which has not expired, retired containers are not counted
+        """
+        return [c for c in image.containers.values() if c.lease is not None and c.lease.remaining > 0]
+
+    def describe(self, image: PdtImage, container: PdtContainer) -> dict:
+        return {'image': image.name, 'id': container.id, 'host': self.host, 'port': container.outer_port,
+                'expires': int(container.lease.expires), 'ttl': max(0, int(container.lease.remaining))}
+
+    def acquire(self, token: str, name: str) -> dict:
+        image = self.__image(name)
+        self.__connect()
+        self.reclaim([image])
+        requester = requester_id(token)
+        leased = self.leased(image)
+        mine = [c for c in leased if c.lease.requester == requester]
+        if len(mine) >= image.broker.quota:
+            self.stats['rejected'] += 1
+            raise BrokerError(429, f'quota of {image.broker.quota} instance(s) of {name} reached',
+                              instances=[self.describe(image, c) for c in mine])
+        if image.broker.cap and len(leased) >= image.broker.cap:
+            self.stats['rejected'] += 1
+            raise BrokerError(503, f'all {image.broker.cap} instances of {name} are leased, try again later')
+        container = self.__take(image)
+        if container is None:
+            raise BrokerError(503, f'failed to create an instance of {name}')
+        container.lease = Lease(requester, time.time() + image.broker.ttl)
+        self.stats['leased'] += 1
+        self.__on_change(image)
+        return self.describe(image, container)
+
+    @staticmethod
+    def __take(image: PdtImage) -> PdtContainer | None:
+        free = [c for c in image.containers.values() if c.lease is None and c.container_object is not None
+                and (c.status == 'running' or c.backend_port)]     # on-demand containers are started later
+        if len(free) != 0:
+            return free[0]
+        start_time = time.perf_counter()
+        claimed = image.claim_pooled(1)
+        if len(claimed) != 0:
+            image.pool.record(1, 0, [(time.perf_counter() - start_time) * 1000])
+            return claimed[0]
+        created = image.add_containers(1)
+        if image.pool.target > 0:
+            image.pool.record(0, 1, [(time.perf_counter() - start_time) * 1000] * len(created))
+        return created[0] if len(created) != 0 else None
+
+    def instances(self, token: str) -> list[dict]:
+        requester = requester_id(token)
+        return [self.describe(image, c) for image in self.__images if image.broker.enabled
+                for c in self.leased(image) if c.lease.requester == requester]
+
+    def release(self, token: str, name: str, cid: int) -> dict:
+        image = self.__image(name)
+        container = image.containers.get(cid)
+        if container is None or container.lease is None or container.lease.requester != requester_id(token):
+            raise BrokerError(404, f'no instance {name}.{cid} leased by this token')
+        self.__connect()
+        self.__remove(image, [container])
+        self.stats['released'] += 1
+        return {'image': name, 'id': cid, 'released': True}
+
+    def reclaim(self, images: list[PdtImage] | None = None) -> int:
+        """
+        remove the containers whose leases expired.
+        :return: count of containers removed
+        """
+        count = 0
+        for image in images if images is not None else list(self.__images):
+            expired = [c for c in image.containers.values() if c.lease is not None and c.lease.remaining <= 0]
+            if len(expired) == 0:
+                continue
+            self.__connect()
+            PrettyPrinter.info(f'{len(expired)} lease(s) of {image.name} expired, removing the instances ...')
+            removed = self.__remove(image, expired)
+            self.stats['expired'] += removed
+            count += removed
+        return count
+
+    def __remove(self, image: PdtImage, containers: list[PdtContainer]) -> int:
+        """
+        remove leased containers. The instances are gone for their requesters even if docker fails to remove them:
+        their leases are expired, so they are retired until reclaim or 'rm container' removes them.
+        :return: count of containers removed
+        """
+        now = time.time()
+        for container in containers:
+            container.lease.expires = min(container.lease.expires, now)
+        image.delete_containers([[c.id, c.id] for c in containers], kill=True)
+        self.__on_change(image)
+        return sum(1 for c in containers if image.containers.get(c.id) is not c)
+
+    def rows(self) -> list[list]:
+        return [[image.name, c.id, c.outer_port, c.lease.requester,
+                 f'{c.lease.remaining:.0f}' if c.lease.remaining > 0 else 'retired']
+                for image in self.__images for c in image.containers.values() if c.lease is not None]
+
+
+class BrokerRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP, the requester sends its token as 'Authorization: Bearer <token>':
+        POST /instances/<image>             lease an instance: {"image", "id", "host", "port", "expires", "ttl"}
+        GET /instances                      instances leased by the token
+        DELETE /instances/<image>/<id>      give an instance back before its lease expires
+    Errors are {"error": "..."} with the status 400, 401, 404, 429 (quota reached) or 503 (cap reached).
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def __reply(self, status: int, body) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __discard_body(self) -> None:
+        # the connection is kept alive, an unread body would be parsed as the next request
+        length = self.headers.get('Content-Length')
+        if self.headers.get('Transfer-Encoding') is not None or (length is not None and not length.isdigit()):
+            self.close_connection = True
+            return
+        remaining = int(length or 0)
+        while remaining > 0 and (chunk := self.rfile.read(min(remaining, 65536))):
+            remaining -= len(chunk)
+
+    def __dispatch(self, method: str) -> None:
+        self.__discard_body()
+        broker: InstanceBroker = self.server.broker
+        auth = self.headers.get('Authorization', '')
+        token = auth[len('Bearer '):].strip() if auth.startswith('Bearer ') else ''
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        try:
+            if token == '':
+                raise BrokerError(401, 'a token is needed, send it as \'Authorization: Bearer <token>\'')
+            if parts[:1] != ['instances']:
+                raise BrokerError(404, f'unknown path {self.path}')
+            if method == 'POST' and len(parts) == 2:
+                self.__reply(201, broker.between_commands(lambda: broker.acquire(token, parts[1])))
+            elif method == 'GET' and len(parts) == 1:
+                self.__reply(200, broker.between_commands(lambda: broker.instances(token)))
+            elif method == 'DELETE' and len(parts) == 3 and parts[2].isdigit():
+                self.__reply(200, broker.between_commands(lambda: broker.release(token, parts[1], int(parts[2]))))
+            else:
+                raise BrokerError(400, f'bad request {method} {self.path}')
+        except BrokerError as e:
+            self.__reply(e.status, {'error': str(e), **e.details})
+        except Exception as e:
+            self.__reply(500, {'error': f'{type(e).__name__}: {e}'})
+
+    def do_POST(self):
+        self.__dispatch('POST')
+
+    def do_GET(self):
+        self.__dispatch('GET')
+
+    def do_DELETE(self):
+        self.__dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        pass    # requests are not logged to the daemon's output
+
+
+def parse_listen(value: str) -> tuple[str, int] | None:
+    host, _, port = value.rpartition(':')
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        return None
+    return host or '127.0.0.1', int(port)
+
+
+def default_public_host() -> str:
+    return os.environ.get('PDT_PUBLIC_HOST') or socket.getfqdn()
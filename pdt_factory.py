@@ -0,0 +1,1536 @@
+import sys
+import time
+import signal
+import fnmatch
+import os.path
+from pdt_object import *
+from pdt_port import port_allocator
+from pdt_handler import HANDLERS
+from pdt_registry import ImageRegistry, DockerImageCache
+from pdt_store import ConfigStore
+from pdt_server import PdtServer, connect, forward
+from pdt_scheduler import BuildScheduler, BUILD_DONE
+from pdt_trace import tracer
+from pdt_pool import PoolRefiller, WarmPool
+import pdt_pool
+
+pdt_health = LazyModule('pdt_health')   # asyncio is only imported by the commands probing containers
+pdt_loadgen = LazyModule('pdt_loadgen')
+pdt_proxy = LazyModule('pdt_proxy')
+pdt_activator = LazyModule('pdt_activator')
+pdt_broker = LazyModule('pdt_broker')   # http.server is only imported by the broker commands and the daemon
+
+
+class PdtFactory:
+    def __init__(self, images, docker_client=None):
+        """
+        :param images: image configs loaded from config.yaml
+        :param docker_client: client to use instead of connecting with docker.from_env() on demand
+        """
+        self.__docker_client = LazyDockerClient(self.__on_connect, (lambda: docker_client) if docker_client else None)
+        self.__docker_images: DockerImageCache = DockerImageCache(self.__docker_client)
+        self.watch_events: bool = False     # watch docker events to keep the image cache valid, for the daemon
+        self.background_refill: bool = False    # refill pools in a background thread instead of after the command
+        self.between_commands = None    # runs a function of a background thread between commands and persists it
+        self.__refiller: PoolRefiller = PoolRefiller(self.__pool_changed)
+        self.__proxies = None   # ProxyManager, created when the first proxy starts
+        self.__activator = None     # Activator serving on-demand containers, in the daemon only
+        self.__images: ImageRegistry = ImageRegistry()
+        self.__broker = None    # InstanceBroker, created by the first broker command
+        self.__orphans: list = []
+        self.__dirty: dict[str, PdtImage] = {}      # images changed since the last take_changes()
+        self.__deleted: list[str] = []
+        if images is not None:
+            for i in images:
+                new_container = PdtImage(i['name'], self.__docker_client)
+                new_container.initialize(i)
+                self.__images.add(new_container)
+        self.__selected_image: PdtImage = PdtImage('none', self.__docker_client)
+        self.__command_tree = {
+            'new': self.__new,
+            'select': self.__select,
+            'set': {
+                'image': self.__set_parent,
+                'apt': self.__set_apt,
+                'basedir': self.__set_basedir,
+                'deploy': self.__set_deploy,
+                'entry': self.__set_entry,
+                'port': self.__set_port,
+                'stoptimeout': self.__set_stop_timeout,
+                'stableids': self.__set_stable_ids,
+                'limit': self.__set_limit,
+                'handler': self.__set_handler,
+                'pool': self.__set_pool,
+                'proxy': self.__set_proxy,
+                'ondemand': self.__set_ondemand,
+                'broker': self.__set_broker
+            },
+            'list': {
+                'image': self.__list_image,
+                'apt': self.__list_apt,
+                'deploy': self.__list_deploy,
+                'select': self.__list_select,
+                'status': self.__list_status,
+                'orphan': self.__list_orphan,
+                'limit': self.__list_limit,
+                'pool': self.__list_pool,
+                'ondemand': self.__list_ondemand
+            },
+            'build': self.__build,
+            'run': self.__run,
+            'check': self.__check,
+            'bench': self.__bench,
+            'reset': self.__reset,
+            'proxy': {
+                'start': self.__proxy_start,
+                'stop': self.__proxy_stop,
+                'status': self.__proxy_status
+            },
+            'broker': {
+                'start': self.__broker_start,
+                'stop': self.__broker_stop,
+                'status': self.__broker_status
+            },
+            'rm': {
+                'image': self.__rm_image,
+                'container': self.__rm_container
+            }
+        }
+        self.__parser_builders = {
+            'new': self.__add_new_parser,
+            'select': self.__add_select_parser,
+            'set': self.__add_set_parser,
+            'list': self.__add_list_parser,
+            'build': self.__add_build_parser,
+            'run': self.__add_run_parser,
+            'check': self.__add_check_parser,
+            'bench': self.__add_bench_parser,
+            'reset': self.__add_reset_parser,
+            'proxy': self.__add_proxy_parser,
+            'broker': self.__add_broker_parser,
+            'rm': self.__add_rm_parser,
+            'stop': self.__add_stop_parser
+        }
+        self.__arg_parsers: dict[str, argparse.ArgumentParser] = {}
+
+    def __get_arg_parser(self, command: str | None) -> argparse.ArgumentParser:
+        """
+        Build the argument parser on demand. Only the sub-parser of the command to execute is built, the whole
+        tree is built for unknown commands so that argparse can print the usage.
+        """
+        key = command if command in self.__parser_builders else None
+        if key not in self.__arg_parsers:
+            parser = argparse.ArgumentParser(prog='pdt')
+            parser.add_argument('--trace', action='store_true',
+                                help='Time this command, see PDT_TRACE for tracing all commands')
+            subparsers = parser.add_subparsers()
+            for name, builder in self.__parser_builders.items():
+                if key is None or name == key:
+                    builder(subparsers)
+            self.__arg_parsers[key] = parser
+        return self.__arg_parsers[key]
+
+    def __add_new_parser(self, subparsers) -> None:
+        parser_new = subparsers.add_parser(
+            'new',
+            help="Create docker object(s) not configured. You need to"
+                 "use 'select' command to select one of them.")
+        parser_new.add_argument('name', nargs='+', help='Image name to be created')
+        parser_new.set_defaults(func=self.__new, docker=True)
+
+    def __add_select_parser(self, subparsers) -> None:
+        parser_select = subparsers.add_parser(
+            'select',
+            help="Select one object that is ready to be configured."
+                 "You can only select ONE object simultaneously.")
+        parser_select.add_argument('name', type=str, action='store', help='Image you want to select')
+        parser_select.set_defaults(func=self.__select)
+
+    def __add_set_parser(self, subparsers) -> None:
+        parser_set = subparsers.add_parser(
+            'set',
+            help="Set some config for the selected object.")
+        subparsers_set = parser_set.add_subparsers()
+        # set parent
+        parser_set_parent = subparsers_set.add_parser(
+            'parent',
+            help="set the image you problem based on. The image must exist"
+                 "in your host. Eg: set image ubuntu:20.04")
+        parser_set_parent.add_argument('tag', type=str, action='store', help='Image tag')
+        parser_set_parent.set_defaults(func=self.__set_parent, docker=True)
+        # set apt
+        parser_set_apt = subparsers_set.add_parser(
+            'apt',
+            help='set the package name that your problem needs to install.'
+                 'There are some packages installed in default, like lib32z1, '
+                 'and the packages of the handler, like xinetd, are always installed.'
+                 'Eg. set apt -a musl -r vim'
+        )
+        parser_set_apt.add_argument('-a', action='append', help='add packets')
+        parser_set_apt.add_argument('-r', action='append', help='remove packets')
+        parser_set_apt.set_defaults(func=self.__set_apt)
+        # set basedir
+        parser_set_basedir = subparsers_set.add_parser(
+            'basedir',
+            help='set the base directory of your problem. The basedir '
+                 'must be a local path. In PDT, when you need to build a problem, '
+                 'the PDT will zip your files into a .zip file, and the basedir '
+                 'will influence the zip process. Eg. if you set basedir to /foo, '
+                 'then when you need to zip /foo/1/1.txt and /foo/2.txt, then you '
+                 'can get a zip file. If you unzip it, you can get 1/1.txt and 2.txt '
+                 'in the directory where you place the zip file.'
+        )
+        parser_set_basedir.add_argument('base', type=str, action='store', help='base directory')
+        parser_set_basedir.set_defaults(func=self.__set_basedir)
+        # set deploy
+        parser_set_deploy = subparsers_set.add_parser(
+            'deploy',
+            help='set the file you want to deploy in your problem. '
+                 'Eg. set deploy -a cpp pwn.elf -r .gdb_history'
+        )
+        parser_set_deploy.add_argument('-a', action='append', help='add files/directories')
+        parser_set_deploy.add_argument('-r', action='append', help='remove files/directories')
+        parser_set_deploy.set_defaults(func=self.__set_deploy)
+        # set entry
+        parser_set_entry = subparsers_set.add_parser(
+            'entry',
+            help='set the entry file of your problem, this file must be '
+                 'an executable file for Linux, like a shell file or an ELF file.'
+        )
+        parser_set_entry.add_argument('entry', type=str, action='store', help='entry file')
+        parser_set_entry.set_defaults(func=self.__set_entry)
+        # set port
+        parser_set_port = subparsers_set.add_parser(
+            'port',
+            help='set the outer port of your problem '
+        )
+        parser_set_port.add_argument('port', type=int, choices=range(0, 65536), help='port specified')
+        parser_set_port.set_defaults(func=self.__set_port)
+        # set stoptimeout
+        parser_set_stop_timeout = subparsers_set.add_parser(
+            'stoptimeout',
+            help='set how many seconds to wait for a container to stop before it is killed, '
+                 '0 means killing it at once.'
+        )
+        parser_set_stop_timeout.add_argument('timeout', type=int, help='timeout in seconds')
+        parser_set_stop_timeout.set_defaults(func=self.__set_stop_timeout)
+        # set stableids
+        parser_set_stable_ids = subparsers_set.add_parser(
+            'stableids',
+            help='keep the ids of containers after some of them are deleted (on), '
+                 'or renumber the remaining containers from 1 (off, default).'
+        )
+        parser_set_stable_ids.add_argument('switch', choices=['on', 'off'], help='on/off')
+        parser_set_stable_ids.set_defaults(func=self.__set_stable_ids)
+        # set limit
+        parser_set_limit = subparsers_set.add_parser(
+            'limit',
+            help='set the resource profile. xinetd limits (instances, per_source, rlimit_cpu, rlimit_as, '
+                 'rlimit_data, rlimit_rss, rlimit_stack, rlimit_files) apply after the image is rebuilt, '
+                 'container limits (cpus, mem_limit, pids_limit, cpuset_cpus, pin) apply to new containers. '
+                 'Eg. set limit per_source=4 cpus=0.5 mem_limit=256m pids_limit=64 pin=1 -r rlimit_as'
+        )
+        parser_set_limit.add_argument('limits', nargs='*', help='<key>=<value>')
+        parser_set_limit.add_argument('-r', action='append', help='reset a limit to its default')
+        parser_set_limit.set_defaults(func=self.__set_limit)
+        # set handler
+        parser_set_handler = subparsers_set.add_parser(
+            'handler',
+            help='set the server accepting connections in containers: xinetd (default) or socat, '
+                 'which forks a lighter process for every connection. Applies after the image is rebuilt.'
+        )
+        parser_set_handler.add_argument('handler', choices=sorted(HANDLERS), help='handler name')
+        parser_set_handler.set_defaults(func=self.__set_handler)
+        # set pool
+        parser_set_pool = subparsers_set.add_parser(
+            'pool',
+            help='keep this many containers created, started and ready, so that \'run -n\' hands them out at once '
+                 'and the pool is refilled afterwards. 0 (default) disables the pool.'
+        )
+        parser_set_pool.add_argument('size', type=int, help='target size of the pool')
+        parser_set_pool.set_defaults(func=self.__set_pool, docker=True)
+        # set proxy
+        parser_set_proxy = subparsers_set.add_parser(
+            'proxy',
+            help='set the public port of the proxy spreading connections over all containers of this image, '
+                 'see \'proxy start\'. 0 disables the proxy.'
+        )
+        parser_set_proxy.add_argument('port', type=int, choices=range(0, 65536), metavar='port', help='public port')
+        parser_set_proxy.set_defaults(func=self.__set_proxy)
+        # set ondemand
+        parser_set_ondemand = subparsers_set.add_parser(
+            'ondemand',
+            help='create new containers stopped and start them on their first connection, stop them again after '
+                 'this many seconds without connections. Existing containers follow after \'reset\'. The daemon '
+                 'holds the ports of on-demand containers. 0 (default) keeps containers running.'
+        )
+        parser_set_ondemand.add_argument('idle', type=int, help='idle timeout in seconds')
+        parser_set_ondemand.set_defaults(func=self.__set_ondemand)
+        # set broker
+        parser_set_broker = subparsers_set.add_parser(
+            'broker',
+            help='let the broker (see \'broker start\') lease containers of this image to requesters for ttl '
+                 'seconds, at most quota instances per requester and cap leased instances in total. '
+                 '0 keeps the image out of the broker. Eg. set broker 3600 -q 1 -c 300'
+        )
+        parser_set_broker.add_argument('ttl', type=int, help='lease time in seconds')
+        parser_set_broker.add_argument('-q', type=int, default=1, help='instances per requester, 1 by default')
+        parser_set_broker.add_argument('-c', type=int, default=0, help='leased instances in total, 0 for no cap')
+        parser_set_broker.set_defaults(func=self.__set_broker)
+
+    def __add_list_parser(self, subparsers) -> None:
+        parser_list = subparsers.add_parser(
+            'list',
+            help='List some configs of selected objects.'
+        )
+        subparsers_list = parser_list.add_subparsers()
+        # list image
+        parser_list_image = subparsers_list.add_parser(
+            'image',
+            help='Show the images managed by pdt.'
+        )
+        parser_list_image.add_argument('image', nargs='*', type=str, action='store', help='Image specified')
+        parser_list_image.add_argument('-d', action='store_true', help='Show detailed information')
+        parser_list_image.add_argument('-a', action='store_true', help='Show all images')
+        parser_list_image.set_defaults(func=self.__list_image)
+        # list apt
+        parser_list_apt = subparsers_list.add_parser(
+            'apt',
+            help='Show the apt packages should be installed.'
+        )
+        parser_list_apt.add_argument('-a', action='store_true', help='Show all the images')
+        parser_list_apt.set_defaults(func=self.__list_apt)
+        # list deploy
+        parser_list_deploy = subparsers_list.add_parser(
+            'deploy',
+            help='Show the file deployed in selected objects.'
+        )
+        parser_list_deploy.add_argument('-a', action='store_true', help='Show all the images')
+        parser_list_deploy.set_defaults(func=self.__list_deploy)
+        # list select
+        parser_list_select = subparsers_list.add_parser(
+            'select',
+            help='Show the selected image.'
+        )
+        parser_list_select.add_argument('-d', action='store_true', help='Show detailed information')
+        parser_list_select.set_defaults(func=self.__list_select)
+        # list status
+        parser_list_status = subparsers_list.add_parser(
+            'status',
+            help='Show the status of all images and containers.'
+        )
+        parser_list_status.set_defaults(func=self.__list_status, docker=True)
+        # list orphan
+        parser_list_orphan = subparsers_list.add_parser(
+            'orphan',
+            help='Show the containers created by PDT but not recorded in config.'
+        )
+        parser_list_orphan.set_defaults(func=self.__list_orphan, docker=True)
+        # list limit
+        parser_list_limit = subparsers_list.add_parser(
+            'limit',
+            help='Show the resource profiles of all images and how containers are spread over host cores.'
+        )
+        parser_list_limit.set_defaults(func=self.__list_limit)
+        # list pool
+        parser_list_pool = subparsers_list.add_parser(
+            'pool',
+            help='Show the warm pools of images, their hits and misses and how long handing out containers took.'
+        )
+        parser_list_pool.set_defaults(func=self.__list_pool)
+        # list ondemand
+        parser_list_ondemand = subparsers_list.add_parser(
+            'ondemand',
+            help='Show the on-demand containers, whether they are running, their connections and cold starts.'
+        )
+        parser_list_ondemand.set_defaults(func=self.__list_ondemand)
+
+    def __add_build_parser(self, subparsers) -> None:
+        parser_build = subparsers.add_parser(
+            'build',
+            help='Start building selected image. You will get an image for '
+                 'your problem, you need to use \'run\' to create __containers. '
+                 'Eg. build -a, build pwn_* -j 8'
+        )
+        parser_build.add_argument('images', nargs='*', type=str, action='store',
+                                  help='Images (shell-style wildcards allowed) to build, '
+                                       'the selected image is built if not specified')
+        parser_build.add_argument('-a', action='store_true', help='Build all images')
+        parser_build.add_argument('-j', type=int, action='store', default=DEFAULT_BUILD_JOBS,
+                                  help=f'Count of concurrent builds, {DEFAULT_BUILD_JOBS} by default')
+        parser_build.set_defaults(func=self.__build, docker=True)
+
+    def __add_run_parser(self, subparsers) -> None:
+        parser_run = subparsers.add_parser(
+            'run',
+            help='Create/Start __containers for your problem.'
+        )
+        parser_run.add_argument('ids', type=lambda v: validate_ids(v), nargs='*', action='append')
+        parser_run.add_argument('-n', type=int, action='store', help='Create new container(s)')
+        parser_run.add_argument('-p', type=int, choices=range(0, 65536), action='store',
+                                help='Set outer port(s), if not specified, PDT will select free ports randomly')
+        parser_run.add_argument('-f', action='store',
+                                help='Set the flag, if not specified, the flag will be randomly generated')
+        parser_run.add_argument('-a', action='store_true', help='Start all __containers')
+        parser_run.add_argument('-j', type=int, action='store', default=DEFAULT_RUN_JOBS,
+                                help=f'Count of containers created concurrently, {DEFAULT_RUN_JOBS} by default')
+        parser_run.add_argument('--wait', type=float, nargs='?', const=30.0, metavar='SECONDS',
+                                help='Wait until the challenges accept connections, 30 seconds at most by default')
+        parser_run.add_argument('--banner', type=str, help='Text the challenges must print to be ready')
+        parser_run.set_defaults(func=self.__run, docker=True)
+
+    def __add_check_parser(self, subparsers) -> None:
+        parser_check = subparsers.add_parser(
+            'check',
+            help='Connect to the outer ports of containers to check whether the challenges are alive. '
+                 'Eg. check -a, check pwn_* --banner Welcome --watch 10'
+        )
+        parser_check.add_argument('images', nargs='*', type=str, action='store',
+                                  help='Images (shell-style wildcards allowed) to check, '
+                                       'the selected image is checked if not specified')
+        parser_check.add_argument('-a', action='store_true', help='Check all images')
+        parser_check.add_argument('--banner', type=str, help='Text the challenges must print')
+        parser_check.add_argument('--timeout', type=float, default=2.0, help='Timeout of every probe in seconds')
+        parser_check.add_argument('--watch', type=float, metavar='SECONDS',
+                                  help='Check again every SECONDS seconds and report changes, until interrupted')
+        parser_check.add_argument('-c', type=int, default=pdt_health.PROBE_CONCURRENCY,
+                                  help='Count of probes running concurrently')
+        parser_check.set_defaults(func=self.__check)
+
+    def __add_bench_parser(self, subparsers) -> None:
+        parser_bench = subparsers.add_parser(
+            'bench',
+            help='Open many concurrent sessions to a container to measure how many players it can serve. '
+                 'Eg. bench pwn.1 -c 5,10,20,50 -n 500 --script login.txt'
+        )
+        parser_bench.add_argument('target', type=str, help='image, or image.id for a specific container')
+        parser_bench.add_argument('-c', type=validate_levels, default='10',
+                                  help='Concurrent sessions, a comma separated list runs the levels one by one')
+        parser_bench.add_argument('-n', type=int, help='Sessions of every level, 10 times the concurrency by default')
+        parser_bench.add_argument('-d', type=float, help='Seconds every level lasts, instead of a count of sessions')
+        parser_bench.add_argument('--script', type=str,
+                                  help='File of the exchange every session runs, lines of '
+                                       '"expect <text>", "send <text>", "sendline <text>" or "sleep <seconds>"')
+        parser_bench.add_argument('--timeout', type=float, default=5.0, help='Timeout of every step in seconds')
+        parser_bench.set_defaults(func=self.__bench)
+
+    def __add_rm_parser(self, subparsers) -> None:
+        parser_rm = subparsers.add_parser(
+            'rm',
+            help='Remove something.'
+        )
+        subparsers_rm = parser_rm.add_subparsers()
+        # rm image
+        parser_rm_image = subparsers_rm.add_parser(
+            'image',
+            help='Remove some image(s). '
+                 'If both -y and -n are not specified, PDT will ask you whether images with '
+                 'existing containers should be deleted.'
+        )
+        parser_rm_image.add_argument('images', nargs='+', help='images needed to be deleted')
+        parser_rm_image.add_argument('-y', action='store_true',
+                                     help='If there are existing containers of images to be removed, '
+                                          'PDT will delete these containers first, and delete the image.')
+        parser_rm_image.add_argument('-n', action='store_true',
+                                     help='If there are existing containers of images to be removed, '
+                                          'PDT will not delete these containers and images.')
+        parser_rm_image.add_argument('--kill', action='store_true',
+                                     help='Kill and remove the containers at once instead of stopping them')
+        parser_rm_image.add_argument('-j', type=int, action='store', default=DEFAULT_RUN_JOBS,
+                                     help='Count of containers removed concurrently')
+        parser_rm_image.set_defaults(func=self.__rm_image, docker=True)
+        # rm container
+        parser_rm_container = subparsers_rm.add_parser(
+            'container',
+            help='Remove some container(s). '
+                 'Argument format: '
+                 '"rm container foo.1,4-5,6-12 goo.2-10" --- '
+                 'It means deleting the container 1, 4~5, 6~12 of image foo, and container '
+                 '2~10 of image goo.'
+        )
+        parser_rm_container.add_argument('containers', nargs='+', help='containers needed to be deleted')
+        parser_rm_container.add_argument('--kill', action='store_true',
+                                         help='Kill and remove the containers at once instead of stopping them')
+        parser_rm_container.add_argument('-j', type=int, action='store', default=DEFAULT_RUN_JOBS,
+                                         help='Count of containers removed concurrently')
+        parser_rm_container.set_defaults(func=self.__rm_container, docker=True)
+
+    def __add_reset_parser(self, subparsers) -> None:
+        parser_reset = subparsers.add_parser(
+            'reset',
+            help='Replace containers with fresh ones from the same image, keeping their ids, ports and flags. '
+                 'Eg. reset pwn.1-5,7 pwn2.3 --wait'
+        )
+        parser_reset.add_argument(
+            'containers', nargs='+', help='The argument format is the same as \'rm container\'')
+        parser_reset.add_argument('-j', type=int, action='store', default=DEFAULT_RUN_JOBS,
+                                  help='Count of containers reset concurrently')
+        parser_reset.add_argument('--wait', type=float, nargs='?', const=30.0, metavar='SECONDS',
+                                  help='Wait until the challenges accept connections, 30 seconds at most by default')
+        parser_reset.add_argument('--banner', type=str, help='Text the challenges must print to be ready')
+        parser_reset.set_defaults(func=self.__reset, docker=True)
+
+    def __add_proxy_parser(self, subparsers) -> None:
+        parser_proxy = subparsers.add_parser(
+            'proxy',
+            help='Manage the proxies listening on the public ports of images (set proxy), which relay every '
+                 'connection to the healthy container with the fewest connections.'
+        )
+        subparsers_proxy = parser_proxy.add_subparsers()
+        for action, text in (('start', 'start'), ('stop', 'stop')):
+            parser_action = subparsers_proxy.add_parser(
+                action,
+                help=f'{text} the proxies of the selected, matched or all images. '
+                     + ('Outside the daemon the proxies run in the foreground until Ctrl+C.'
+                        if action == 'start' else '')
+            )
+            parser_action.add_argument('images', nargs='*', type=str, action='store',
+                                       help='Images (shell-style wildcards allowed)')
+            parser_action.add_argument('-a', action='store_true', help='All images with a public port')
+            parser_action.set_defaults(func=self.__proxy_start if action == 'start' else self.__proxy_stop)
+        parser_proxy_status = subparsers_proxy.add_parser(
+            'status',
+            help='Show the containers behind every running proxy, their health and connection counts.'
+        )
+        parser_proxy_status.set_defaults(func=self.__proxy_status)
+
+    def __add_broker_parser(self, subparsers) -> None:
+        parser_broker = subparsers.add_parser(
+            'broker',
+            help='Manage the instance broker of the daemon, an HTTP endpoint leasing a container of an image '
+                 '(set broker) to every requester token.'
+        )
+        subparsers_broker = parser_broker.add_subparsers()
+        parser_broker_start = subparsers_broker.add_parser(
+            'start',
+            help='start the broker in the daemon. The daemon starts it at launch if PDT_BROKER_LISTEN is set.'
+        )
+        listen = pdt_broker.DEFAULT_BROKER_LISTEN
+        parser_broker_start.add_argument('-l', type=str, default=listen, metavar='HOST:PORT',
+                                         help=f'address of the HTTP endpoint, {listen} by default')
+        parser_broker_start.add_argument('--host', type=str, help='host returned to requesters, PDT_PUBLIC_HOST '
+                                                                  'or the name of this host by default')
+        parser_broker_start.set_defaults(func=self.__broker_start)
+        parser_broker_stop = subparsers_broker.add_parser('stop', help='stop the broker, leases are kept.')
+        parser_broker_stop.set_defaults(func=self.__broker_stop)
+        parser_broker_status = subparsers_broker.add_parser(
+            'status',
+            help='Show the images served by the broker and the instances leased.'
+        )
+        parser_broker_status.set_defaults(func=self.__broker_status)
+
+    def __add_stop_parser(self, subparsers) -> None:
+        parser_stop = subparsers.add_parser(
+            'stop',
+            help='Stop something(containers supported only until now).'
+        )
+        subparsers_stop = parser_stop.add_subparsers()
+        # stop container
+        parser_stop_container = subparsers_stop.add_parser(
+            'container',
+            help='stop containers.'
+        )
+        parser_stop_container.add_argument(
+            'containers', nargs='+', help='The argument format is the same as \'rm container\'')
+        parser_stop_container.add_argument('--kill', action='store_true',
+                                           help='Kill the containers instead of waiting for the stop timeout')
+        parser_stop_container.add_argument('-j', type=int, action='store', default=DEFAULT_RUN_JOBS,
+                                           help='Count of containers stopped concurrently')
+        parser_stop_container.set_defaults(func=self.__stop_container, docker=True)
+
+    '''****************************** some properties of Factory classes ******************************'''
+
+    @property
+    def containers(self) -> list[PdtImage]:
+        return self.__images.values()
+
+    @property
+    def select_list(self) -> PdtImage:
+        return self.__selected_image
+
+    @property
+    def image_names(self) -> list[str]:
+        return self.__images.names
+
+    @property
+    def image_apts(self) -> list[set[str]]:
+        return [x.apt for x in self.__images]
+
+    @property
+    def image_deploys(self) -> list[set[str]]:
+        return [x.deploy.files for x in self.__images]
+
+    @property
+    def image_details(self) -> list[str]:
+        return [x.info_dict for x in self.__images]
+
+    @property
+    def command_tree(self) -> dict:
+        return self.__get_command_tree(self.__command_tree)
+
+    def __get_command_tree(self, root) -> dict:
+        ret = {}
+        for k in root:
+            if type(root[k]) == dict:
+                ret[k] = self.__get_command_tree(root[k])
+            else:
+                ret[k] = None
+        return ret
+
+    '''****************************** functions for all commands ******************************'''
+
+    def __new(self, pc: dict) -> None:
+        new_images = pc['name']
+        image_names = self.docker_images_namelist()
+        for i in translate_containers(new_images):
+            if f"{i}:latest" in image_names:
+                PrettyPrinter.error(f'\'{i}\' exists.')
+                continue
+            else:
+                self.add_image(i)
+                self.mark_dirty(self.__images.get(i))
+                PrettyPrinter.info(f'\'{i}\' created.')
+
+    def __select(self, pc: dict) -> None:
+        if pc['name'] not in self.__images:
+            PrettyPrinter.error('image specified do not exist.')
+            return
+        self.__selected_image = self.__images.get(pc['name'])
+
+    def __set_parent(self, pc: dict) -> None:
+        parent = self.__docker_images.get(pc['tag'], refresh_on_miss=True)
+        if parent is None:
+            PrettyPrinter.error(f'image {pc["tag"]} not found in local machine.')
+            return
+        self.__selected_image.parent = parent
+        self.mark_dirty(self.__selected_image)
+
+    def __set_apt(self, pc: dict) -> None:
+        if pc['a'] is not None:
+            self.__selected_image.apt |= set(pc['a'])
+        if pc['r'] is not None:
+            self.__selected_image.apt -= set(pc['r'])
+        self.mark_dirty(self.__selected_image)
+
+    def __set_basedir(self, pc: dict) -> None:
+        self.__selected_image.deploy.basedir = pc['base']
+        self.mark_dirty(self.__selected_image)
+
+    def __set_deploy(self, pc: dict) -> None:
+        # ATTENTION: all files cannot have any spaces in its path!!!
+        if pc['a'] is not None:
+            self.__selected_image.deploy.files |= set(pc['a'])
+        if pc['r'] is not None:
+            self.__selected_image.deploy.files -= set(pc['r'])
+        self.mark_dirty(self.__selected_image)
+
+    def __set_entry(self, pc: dict) -> None:
+        self.__selected_image.deploy.entry = pc['entry']
+        self.mark_dirty(self.__selected_image)
+
+    def __set_port(self, pc: dict) -> None:
+        self.__selected_image.port = pc['port']
+        self.mark_dirty(self.__selected_image)
+
+    def __set_stop_timeout(self, pc: dict) -> None:
+        if pc['timeout'] < 0:
+            PrettyPrinter.error('Stop timeout cannot be negative.')
+            return
+        self.__selected_image.stop_timeout = pc['timeout']
+        self.mark_dirty(self.__selected_image)
+
+    def __set_stable_ids(self, pc: dict) -> None:
+        self.__selected_image.stable_ids = pc['switch'] == 'on'
+        self.mark_dirty(self.__selected_image)
+
+    def __set_limit(self, pc: dict) -> None:
+        changes = []
+        for item in pc['limits']:
+            key, sep, value = item.partition('=')
+            error = ResourceProfile.check(key, value) if sep else f'{item}: <key>=<value> expected.'
+            if error is not None:
+                PrettyPrinter.error(error)
+                return
+            changes.append((key, value))
+        for key in pc['r'] or []:
+            if key not in ResourceProfile.keys():
+                PrettyPrinter.error(ResourceProfile.check(key, ''))
+                return
+            changes.append((key, None))
+        for key, value in changes:
+            self.__selected_image.limits.set(key, value)
+        if any(key in ResourceProfile.XINETD_KEYS for key, _ in changes):
+            PrettyPrinter.info(f'xinetd limits take effect after {self.__selected_image.name} is rebuilt.')
+        self.mark_dirty(self.__selected_image)
+
+    def __set_handler(self, pc: dict) -> None:
+        image = self.__selected_image
+        previous = image.handler
+        image.handler_name = pc['handler']
+        if leftover := (previous.packages - image.handler.packages) & image.apt:
+            PrettyPrinter.warning(f'{", ".join(sorted(leftover))} of handler {previous.name} is still in the apt '
+                                  f'list, remove it with \'set apt -r\' if the challenge does not need it.')
+        PrettyPrinter.info(f'handler {image.handler.name} takes effect after {image.name} is rebuilt.')
+        self.mark_dirty(image)
+
+    def __set_pool(self, pc: dict) -> None:
+        if pc['size'] < 0:
+            PrettyPrinter.error('Pool size cannot be negative.')
+            return
+        image = self.__selected_image
+        if pc['size'] > 0 and image.ondemand:
+            PrettyPrinter.error(f'Containers of {image.name} are started on demand, pooled containers would always '
+                                f'run, use \'set ondemand 0\' first.')
+            return
+        image.pool.target = pc['size']
+        self.__refill_pool(image)
+        self.mark_dirty(image)
+
+    def __refill_pool(self, image: PdtImage) -> None:
+        if self.background_refill:
+            self.__refiller.request(image)
+            return
+        missing = image.pool.target - len(image.pool)
+        if missing > 0:
+            PrettyPrinter.info(f'Filling the pool of {image.name} with {missing} container(s) ...')
+        # only the daemon waits for the new containers to accept connections, a command would block on the probes
+        added = pdt_pool.refill(image, wait_ready=False)
+        if missing > 0:
+            PrettyPrinter.info(f'{added} container(s) added, {len(image.pool)}/{image.pool.target} in the pool.')
+        self.mark_dirty(image)
+
+    def __pool_changed(self, image: PdtImage) -> None:
+        # the image may have been removed while its pool was being refilled
+        if self.__images.get(image.name) is not image:
+            return
+        self.mark_dirty(image)
+        if self.between_commands is not None:
+            self.between_commands(lambda: None)
+
+    def __set_proxy(self, pc: dict) -> None:
+        image = self.__selected_image
+        if pc['port'] == image.proxy_port:
+            return
+        if pc['port'] != 0:
+            if not 10000 <= pc['port'] <= 65535:
+                PrettyPrinter.error(f'Bad public port: {pc["port"]}, 10000~65535 needed.')
+                return
+            reserved = port_allocator.allocate(1, pc['port'])
+            if reserved != [pc['port']]:
+                port_allocator.release(reserved)
+                PrettyPrinter.error(f'Port {pc["port"]} is already used.')
+                return
+            if image.limits.xinetd.get('per_source', 'UNLIMITED') != 'UNLIMITED':
+                PrettyPrinter.warning('Connections relayed by the proxy all come from the host, per_source limits the '
+                                      'sessions of every container, consider \'set limit per_source=UNLIMITED\'.')
+        if image.proxy_port:
+            port_allocator.release([image.proxy_port])
+        restart = self.__proxies is not None and self.__proxies.stop(image.name)
+        image.proxy_port = pc['port']
+        if restart and image.proxy_port:
+            if (error := self.__proxies.start(image.name, image.proxy_port,
+                                              self.__proxy_targets(image))) is not None:
+                PrettyPrinter.error(error)
+        self.mark_dirty(image)
+
+    def __set_ondemand(self, pc: dict) -> None:
+        if pc['idle'] < 0:
+            PrettyPrinter.error('Idle timeout cannot be negative.')
+            return
+        image = self.__selected_image
+        if pc['idle'] > 0 and image.pool.target > 0:
+            PrettyPrinter.error(f'{image.name} has a warm pool, use \'set pool 0\' first.')
+            return
+        if pc['idle'] > 0 and image.proxy_port:
+            PrettyPrinter.warning('The health probes of the proxy connect to every container, they keep on-demand '
+                                  'containers running unless the idle timeout is shorter than '
+                                  f'{pdt_proxy.PROXY_HEALTH_INTERVAL:.0f}s.')
+        converted = image.ondemand != (pc['idle'] > 0)
+        image.idle_timeout = pc['idle']
+        if converted and image.container_cnt != 0:
+            PrettyPrinter.info(f'Existing containers of {image.name} are not changed, '
+                               f'use \'reset {image.name}.<ids>\' to replace them.')
+        if image.ondemand and not self.watch_events:
+            PrettyPrinter.info('On-demand containers are only reachable while the daemon (serve) is running.')
+        self.mark_dirty(image)
+
+    def __set_broker(self, pc: dict) -> None:
+        if pc['ttl'] < 0 or pc['q'] < 1 or pc['c'] < 0:
+            PrettyPrinter.error('ttl and cap cannot be negative, quota must be at least 1.')
+            return
+        image = self.__selected_image
+        image.broker.ttl, image.broker.quota, image.broker.cap = pc['ttl'], pc['q'], pc['c']
+        if image.broker.enabled and not image.stable_ids:
+            # requesters give instances back by id, the ids of leased containers must not change
+            image.stable_ids = True
+            PrettyPrinter.info(f'stableids of {image.name} turned on, requesters identify instances by id.')
+        self.mark_dirty(image)
+
+    def __list_image(self, pc: dict) -> None:
+        if pc['a']:
+            for image in self.__images:
+                if pc['d']:
+                    print(PrettyPrinter.print_dict_as_a_tree(image.info_dict))
+                else:
+                    print(image.name)
+        else:
+            for image in pc['image']:
+                if pc['d']:
+                    print(PrettyPrinter.print_dict_as_a_tree(image.info_dict))
+                else:
+                    print(image.__name)
+
+    def __list_apt(self, _: dict) -> None:
+        max_name_len = max([len(i.name) for i in self.__images], default=0)
+        bound = 78 - max_name_len
+        data = []
+        for image in self.__images:
+            data.append([image.name, PrettyPrinter.alignment_of_lists(sorted(image.apt), bound),
+                         f'{image.handler.name} ({" ".join(sorted(image.handler.packages))})'])
+        print(PrettyPrinter.table(data, ['name', 'apt list', 'handler']))
+
+    def __list_deploy(self, _: dict) -> None:
+        max_name_len = max([len(i.name) for i in self.__images], default=0)
+        bound = 78 - max_name_len
+        data = []
+        for image in self.__images:
+            data.append([image.name, PrettyPrinter.alignment_of_lists(sorted(image.deploy.files), bound)])
+        print(PrettyPrinter.table(data, ['name', 'deploy']))
+
+    def __list_select(self, pc: dict):
+        if pc['d']:
+            print(PrettyPrinter.print_dict_as_a_tree(self.__selected_image.info_dict))
+        else:
+            print(self.__selected_image.name)
+
+    def __list_status(self, _: dict) -> None:
+        data = {}
+        for image in self.__images:
+            if image.image_object is None:
+                data[image.name] = {'status': Style.BRIGHT + Fore.RED + '⬤  ', 'containers': {}}
+            else:
+                data[image.name] = {'status': Style.BRIGHT + Fore.GREEN + '⬤  ', 'containers': {}}
+            data[image.name]['status'] += ('Not Built' if image.image_object is None else "Built") + Style.RESET_ALL
+            for cid, container in image.containers.items():
+                data[image.name]['containers'][cid] = (Fore.RED if container.status == 'exited' else Fore.GREEN) \
+                                                      + '⬤  ' + Fore.RESET + container.status
+        print(PrettyPrinter.print_dict_as_a_tree(data))
+
+    def __list_limit(self, _: dict) -> None:
+        rows = []
+        for image in self.__images:
+            rows.append([image.name, image.handler.name,
+                         ', '.join(f'{k}={v}' for k, v in image.limits.xinetd.items()),
+                         ', '.join(f'{k}={v}' for k, v in image.limits.docker.items()) or '<not set>'])
+        print(PrettyPrinter.table(rows, ['name', 'handler', 'session', 'container']))
+        pinned = {}
+        for image in self.__images:
+            for c in image.containers.values():
+                for core in parse_cpuset(c.cpuset) if c.cpuset else []:
+                    pinned[core] = pinned.get(core, 0) + 1
+        if len(pinned) != 0:
+            print(PrettyPrinter.table([[core, pinned.get(core, 0)] for core in host_cores()],
+                                      ['core', 'pinned containers']))
+
+    def __list_pool(self, _: dict) -> None:
+        rows = [[image.name] + image.pool.row() for image in self.__images
+                if image.pool.target != 0 or image.pool.hits + image.pool.misses != 0]
+        print(PrettyPrinter.table(rows, ['name'] + WarmPool.HEADERS))
+
+    def __list_ondemand(self, _: dict) -> None:
+        rows = [[image.name, image.idle_timeout,
+                 sum(1 for c in image.containers.values() if c.backend_port), image.container_cnt]
+                for image in self.__images if image.ondemand]
+        print(PrettyPrinter.table(rows, ['name', 'idle timeout s', 'on-demand containers', 'containers']))
+        if not self.watch_events:
+            PrettyPrinter.info('Connections and cold starts are counted by the daemon (serve).')
+            return
+        activator = self.__container_activator()
+        print(PrettyPrinter.table(activator.rows(), activator.HEADERS))
+
+    def __list_orphan(self, _: dict) -> None:
+        rows = []
+        for c in self.__orphans:
+            labels = container_labels(c)
+            rows.append([c.short_id, labels.get(LABEL_IMAGE, ''), labels.get(LABEL_PORT, ''), c.status])
+        print(PrettyPrinter.table(rows, ['container id', 'image', 'port', 'status']))
+
+    def __build(self, pc: dict) -> None:
+        targets = self.__match_images(pc, 'build')
+        if len(targets) == 0:
+            return
+        scheduler = BuildScheduler(pc['j'])
+        scheduler.submit(targets)
+        tasks = scheduler.run()
+        for image in targets:
+            self.mark_dirty(image)
+        if len(targets) > 1:
+            print(scheduler.summary())
+        # the listing stays valid, base images built as well are found by 'set parent' with refresh_on_miss
+        for task in tasks:
+            if task.status == BUILD_DONE:
+                self.__docker_images.put(task.image.image_object)
+
+    def __run(self, pc: dict) -> None:
+        pc['ids'] = delayer_list(pc['ids'])
+        create_num = pc['n'] if pc['n'] is not None else 0
+        started: list[PdtContainer] = []
+
+        # start running existing __containers
+        if pc['a']:
+            pc['ids'] = [(1, self.__selected_image.containers.next_id() - 1)]
+        for ctn_id in pc['ids']:
+            start, end = (int(ctn_id[0]), int(ctn_id[1])) if isinstance(ctn_id, tuple) else (int(ctn_id),) * 2
+            ids = self.__selected_image.containers_in_range(start, end)
+            if len(ids) == 0:
+                PrettyPrinter.error(f'Container id out of bound: {start}-{end}.' if start != end else
+                                    f'Container id out of bound: {start}.')
+            for i in ids:
+                if self.__selected_image.container_stat(i) != 'running':
+                    self.__selected_image.start_container(i)
+                    started.append(self.__selected_image.containers[i])
+
+        # hand out pooled containers first, they have their own ports and flags
+        image = self.__selected_image
+        use_pool = create_num > 0 and image.pool.target > 0 and pc['p'] is None and pc['f'] is None
+        claimed = []
+        if use_pool:
+            start_time = time.perf_counter()
+            claimed = image.claim_pooled(create_num)
+            hit_ms = (time.perf_counter() - start_time) * 1000
+            started += claimed
+            create_num -= len(claimed)
+
+        # start creating new __containers
+        start_time = time.perf_counter()
+        created = image.add_containers(create_num, outer_port=pc['p'], flag=pc['f'], jobs=pc['j'])
+        started += created
+        self.mark_dirty(image)
+        if image.ondemand and len(created) != 0 and not self.watch_events:
+            PrettyPrinter.info(f'Containers of {image.name} start on their first connection, '
+                               f'which is only accepted while the daemon (serve) is running.')
+        if use_pool:
+            miss_ms = (time.perf_counter() - start_time) * 1000
+            image.pool.record(len(claimed), create_num, [hit_ms] * len(claimed) + [miss_ms] * len(created))
+            PrettyPrinter.info(f'pool of {image.name}: {len(claimed)} hit(s) in {hit_ms:.1f}ms'
+                               + (f', {create_num} miss(es) in {miss_ms / 1000:.2f}s' if create_num else '') + '.')
+        if pc['wait'] is not None and len(started) != 0:
+            self.__wait_ready(started, pc['wait'], pc['banner'])
+        if use_pool:
+            self.__refill_pool(image)
+
+    def __wait_ready(self, containers: list[PdtContainer], deadline: float, banner: str | None) -> None:
+        self.sync_activations()     # the probes of on-demand containers go through the activator
+        PrettyPrinter.info(f'Waiting for {len(containers)} challenge(s) to accept connections ...')
+        results = pdt_health.gate([((c.image.name, c.id), c.outer_port) for c in containers], deadline,
+                                  banner=banner.encode() if banner else None)
+        ready = sorted(r.ready_ms for r in results.values() if r.ok)
+        if len(ready) != 0:
+            PrettyPrinter.info(f'{len(ready)}/{len(results)} ready, median {ready[len(ready) // 2] / 1000:.2f}s, '
+                               f'slowest {ready[-1] / 1000:.2f}s.')
+        failed = [r for r in results.values() if not r.ok]
+        if len(failed) != 0:
+            PrettyPrinter.error(f'{len(failed)} challenge(s) not ready after {deadline}s:')
+            print(PrettyPrinter.table([[f'{r.key[0]}.{r.key[1]}'] + r.row() for r in failed],
+                                      ['container', 'port', 'state', 'connect ms', 'first byte ms', 'error']))
+
+    def __check(self, pc: dict) -> None:
+        images = self.__match_images(pc, 'check')
+        targets = [((image.name, c.id), c.outer_port) for image in images for c in image.containers.values()]
+        if len(targets) == 0:
+            PrettyPrinter.info('No container to check.')
+            return
+        if pc['watch'] is not None and self.watch_events:
+            PrettyPrinter.error('check --watch would block the daemon, repeat \'check\' instead, '
+                                'e.g. watch -n 10 python3 pdt.py command check -a')
+            return
+        banner = pc['banner'].encode() if pc['banner'] else None
+        results = pdt_health.check(targets, pc['timeout'], banner, pc['c'])
+        self.__report_check(results, verbose=True)
+        if pc['watch'] is None:
+            return
+        try:
+            while True:
+                time.sleep(pc['watch'])
+                previous = {r.key: r.state for r in results}
+                results = pdt_health.check(targets, pc['timeout'], banner, pc['c'])
+                changed = [r for r in results if r.state != previous[r.key]]
+                print(time.strftime('%H:%M:%S'), end=' ')
+                self.__report_check(results, verbose=False)
+                if len(changed) != 0:
+                    print(PrettyPrinter.table([[f'{r.key[0]}.{r.key[1]}', previous[r.key]] + r.row()
+                                               for r in changed],
+                                              ['container', 'was', 'port', 'state', 'connect ms', 'first byte ms',
+                                               'error']))
+        except KeyboardInterrupt:
+            pass
+
+    def __bench(self, pc: dict) -> None:
+        name, _, cid = pc['target'].partition('.')
+        image = self.__images.get(name)
+        if image is None:
+            PrettyPrinter.error(f'Image {name} not found.')
+            return
+        if image.container_cnt == 0:
+            PrettyPrinter.error(f'No container of {name} to bench, use \'run\' to create one.')
+            return
+        if cid and (not cid.isdigit() or int(cid) not in image.containers):
+            PrettyPrinter.error(f'Container {pc["target"]} not found.')
+            return
+        container = image.containers[int(cid) if cid else image.containers.keys()[0]]
+        levels = pc['c']
+        try:
+            steps = []
+            if pc['script'] is not None:
+                with open(pc['script'], 'r') as f:
+                    steps = pdt_loadgen.parse_script(f.read())
+        except (ValueError, OSError) as e:
+            PrettyPrinter.error(f'Bad bench script: {e}')
+            return
+        PrettyPrinter.info(f'Benchmarking {name}.{container.id} on port {container.outer_port}, '
+                           f'concurrency {", ".join(map(str, levels))} ...')
+        reports = pdt_loadgen.bench(
+            container.outer_port, steps, levels,
+            sessions=None if pc['d'] is not None else pc['n'] or None, duration=pc['d'], timeout=pc['timeout'],
+            on_level=lambda r: PrettyPrinter.info(f'concurrency {r.concurrency}: {r.ok}/{r.sessions} ok '
+                                                  f'in {r.wall:.1f}s'))
+        print(PrettyPrinter.table([r.row() for r in reports], pdt_loadgen.LevelReport.HEADERS))
+        served = [r.concurrency for r in reports if r.error_rate < 0.01]
+        if len(served) != 0:
+            PrettyPrinter.info(f'{name} served up to {max(served)} concurrent sessions with less than 1% errors.')
+        else:
+            PrettyPrinter.warning(f'{name} failed more than 1% of sessions at every level.')
+
+    @staticmethod
+    def __report_check(results: list, verbose: bool) -> None:
+        dead = [r for r in results if not r.ok]
+        connect = sorted(r.connect_ms for r in results if r.ok)
+        p50 = f', connect p50 {connect[len(connect) // 2]:.1f}ms p99 {connect[int(len(connect) * 0.99)]:.1f}ms' \
+            if connect else ''
+        if verbose:
+            print(PrettyPrinter.table([[f'{r.key[0]}.{r.key[1]}'] + r.row() for r in results],
+                                      ['container', 'port', 'state', 'connect ms', 'first byte ms', 'error']))
+        (PrettyPrinter.error if dead else PrettyPrinter.info)(
+            f'{len(results) - len(dead)}/{len(results)} alive{p50}' +
+            (f', dead: {", ".join(f"{r.key[0]}.{r.key[1]}" for r in dead[:20])}' if dead else '') +
+            (f' and {len(dead) - 20} more' if len(dead) > 20 else ''))
+
+    def __rm_image(self, pc: dict) -> None:
+        images = pc['images']
+        for i in images:
+            if i not in self.__images:
+                PrettyPrinter.error(f'Image {i} not found.')
+                continue
+            target = self.__images.get(i)
+            if not use_script:
+                if pc['y']:
+                    PrettyPrinter.info(f'There are {target.container_cnt} containers based on image {i}, deleted.')
+                elif pc['n'] and target.container_cnt != 0:
+                    PrettyPrinter.info(f'There are {target.container_cnt} containers based on image {i}, skipped.')
+                    continue
+                elif target.container_cnt != 0:
+                    PrettyPrinter.warning(f'There are {target.container_cnt} containers based on image {i}, '
+                                          f'Deleting this image will delete all these containers! Continue? <N/y>')
+                    choice = input()
+                    if choice == 'Y' or choice == 'y':
+                        PrettyPrinter.info('Deleted.')
+                    else:
+                        PrettyPrinter.info('Skipped.')
+                        continue
+                else:
+                    PrettyPrinter.info(f'No container found based on this image, ready to delete.')
+            else:
+                if not pc['y'] and target.container_cnt != 0:
+                    PrettyPrinter.info(f'Skipped {i}')
+                    continue
+                PrettyPrinter.info(f'Ready to delete image {i}, which has {target.container_cnt} containers.')
+            # delete the pooled containers and all the containers
+            if self.__proxies is not None:
+                self.__proxies.stop(target.name)
+            if target.proxy_port:
+                port_allocator.release([target.proxy_port])
+            self.__refiller.cancel(target)
+            target.drain_pool()
+            if target.container_cnt != 0:
+                target.delete_all_containers(kill=pc['kill'], jobs=pc['j'])
+                if target.container_cnt != 0:
+                    self.mark_dirty(target)
+                    PrettyPrinter.error(f'{target.container_cnt} containers of {i} cannot be removed, '
+                                        f'image {i} is kept.')
+                    continue
+            target.delete_image()
+            self.__docker_images.invalidate()
+            # delete this image
+            self.__images.remove(target)
+            self.__dirty.pop(target.name, None)
+            self.__deleted.append(target.name)
+            del target
+
+    def __rm_container(self, pc: dict) -> None:
+        targets: list[str] = pc['containers']
+        ic_range_list = parse_ic_range_list(targets)
+        for i, r in ic_range_list.items():
+            image = self.__images.get(i)
+            if image is None:
+                PrettyPrinter.error(f'specified image {i} not found.')
+                continue
+            # start deleting containers
+            image.delete_containers(r, kill=pc['kill'], jobs=pc['j'])
+            self.mark_dirty(image)
+
+    def __reset(self, pc: dict) -> None:
+        ic_range_list = parse_ic_range_list(pc['containers'])
+        if ic_range_list is None:
+            return
+        reset = []
+        for i, r in ic_range_list.items():
+            image = self.__images.get(i)
+            if image is None:
+                PrettyPrinter.error(f'specified image {i} not found.')
+                continue
+            reset += image.reset_containers(r, jobs=pc['j'])
+            self.mark_dirty(image)
+        if pc['wait'] is not None and len(reset) != 0:
+            self.__wait_ready(reset, pc['wait'], pc['banner'])
+
+    def __proxy_manager(self):
+        if self.__proxies is None:
+            self.__proxies = pdt_proxy.ProxyManager()
+        return self.__proxies
+
+    def __proxy_start(self, pc: dict) -> None:
+        proxies = self.__proxy_manager()
+        for image in self.__match_images(pc, 'proxy'):
+            if image.proxy_port == 0:
+                if not pc['a']:
+                    PrettyPrinter.error(f'No public port set for {image.name}, use \'set proxy <port>\' first.')
+                continue
+            if (error := proxies.start(image.name, image.proxy_port, self.__proxy_targets(image))) is not None:
+                PrettyPrinter.error(error)
+            else:
+                PrettyPrinter.info(f'Proxy of {image.name} listening on port {image.proxy_port}, '
+                                   f'{image.container_cnt} container(s) behind it.')
+        if self.watch_events or len(proxies.names) == 0:
+            return
+        PrettyPrinter.info('Proxies running in the foreground, press Ctrl+C to stop them.')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            proxies.close()
+
+    def __proxy_stop(self, pc: dict) -> None:
+        for image in self.__match_images(pc, 'proxy'):
+            if self.__proxies is not None and self.__proxies.stop(image.name):
+                PrettyPrinter.info(f'Proxy of {image.name} stopped.')
+            elif not pc['a']:
+                PrettyPrinter.error(f'Proxy of {image.name} is not running.')
+
+    def __proxy_status(self, _: dict) -> None:
+        rows = self.__proxies.rows() if self.__proxies is not None else []
+        if len(rows) == 0:
+            PrettyPrinter.info('No proxy running.')
+            return
+        print(PrettyPrinter.table(rows, self.__proxies.HEADERS))
+
+    @staticmethod
+    def __proxy_targets(image: PdtImage) -> list[tuple]:
+        return [(c.id, c.outer_port) for c in image.containers.values() if c.outer_port]
+
+    def start_services(self) -> None:
+        """
+        start the proxies of all images with a public port and the activator of on-demand containers, for the daemon.
+        """
+        for image in self.__images:
+            if image.proxy_port:
+                if (error := self.__proxy_manager().start(image.name, image.proxy_port,
+                                                          self.__proxy_targets(image))) is not None:
+                    PrettyPrinter.error(error)
+        if any(image.ondemand for image in self.__images):
+            self.connect()      # the activator needs the container objects
+            self.sync_activations()
+        if listen := os.environ.get('PDT_BROKER_LISTEN'):
+            self.__broker_start({'l': listen, 'host': None})
+
+    def sync_activations(self) -> None:
+        """
+        listen on the ports of on-demand containers, and stop listening for containers gone or replaced. The
+        activator only runs in the daemon, other modes exit after the command.
+        """
+        if not self.watch_events:
+            return
+        specs = [((image.name, c.id), c.outer_port, c.backend_port, c.container_object, image.idle_timeout,
+                  image.stop_timeout) for image in self.__images if image.ondemand
+                 for c in image.containers.values() if c.backend_port and c.container_object is not None]
+        if len(specs) != 0 or self.__activator is not None:
+            self.__container_activator().sync(specs)
+
+    def __container_activator(self):
+        if self.__activator is None:
+            self.__activator = pdt_activator.Activator()
+        return self.__activator
+
+    def __instance_broker(self):
+        if self.__broker is None:
+            self.__broker = pdt_broker.InstanceBroker(self.__images, lambda f: self.between_commands(f),
+                                                      self.connect, self.__broker_changed)
+        return self.__broker
+
+    def __broker_start(self, pc: dict) -> None:
+        if self.between_commands is None:
+            PrettyPrinter.error('The broker runs in the daemon (serve) only.')
+            return
+        broker = self.__instance_broker()
+        if broker.running:
+            PrettyPrinter.error(f'The broker is already listening on {broker.listen[0]}:{broker.listen[1]}.')
+            return
+        if (listen := pdt_broker.parse_listen(pc['l'])) is None:
+            PrettyPrinter.error(f'Bad address {pc["l"]}, HOST:PORT expected.')
+            return
+        try:
+            broker.start(listen, pc['host'] or pdt_broker.default_public_host())
+        except OSError as e:
+            PrettyPrinter.error(f'Failed to listen on {pc["l"]}: {e}')
+            return
+        served = [i.name for i in self.__images if i.broker.enabled]
+        PrettyPrinter.info(f'Broker listening on {listen[0]}:{listen[1]}, serving '
+                           f'{", ".join(served) if served else "no image yet, see set broker"}.')
+
+    def __broker_stop(self, _: dict) -> None:
+        if self.__broker is None or not self.__broker.running:
+            PrettyPrinter.error('The broker is not running.')
+            return
+        self.__broker.stop()
+        PrettyPrinter.info('Broker stopped, leases are kept and expire once it is started again.')
+
+    def __broker_status(self, _: dict) -> None:
+        broker = self.__instance_broker()
+        rows = [[i.name, i.broker.ttl, i.broker.quota, i.broker.cap or '-', len(broker.leased(i)),
+                 i.container_cnt, len(i.pool)] for i in self.__images if i.broker.enabled]
+        print(PrettyPrinter.table(rows, ['name', 'ttl s', 'quota', 'cap', 'leased', 'containers', 'pooled']))
+        leases = broker.rows()
+        if len(leases) != 0:
+            print(PrettyPrinter.table(leases, broker.HEADERS))
+        if broker.running:
+            PrettyPrinter.info(f'Broker listening on {broker.listen[0]}:{broker.listen[1]}, '
+                               + ', '.join(f'{v} {k}' for k, v in broker.stats.items()) + '.')
+        else:
+            PrettyPrinter.info('Broker not running.')
+
+    def __broker_changed(self, image: PdtImage) -> None:
+        self.mark_dirty(image)
+        if image.pool.target > 0:
+            self.__refill_pool(image)
+        self.__sync_services()
+
+    def __stop_container(self, pc: dict) -> None:
+        targets: list[str] = pc['containers']
+        ic_range_list = parse_ic_range_list(targets)
+        for i, r in ic_range_list.items():
+            image = self.__images.get(i)
+            if image is None:
+                PrettyPrinter.error(f'specified image {i} not found.')
+                continue
+            image.stop_containers(r, kill=pc['kill'], jobs=pc['j'])
+
+    '''****************************** auxiliary methods for executing commands ******************************'''
+
+    def __match_images(self, pc: dict, action: str) -> list[PdtImage]:
+        """
+        images targeted by commands like build and check: all images with -a, images matching the given
+        shell-style patterns, or the selected image.
+        """
+        if pc['a']:
+            return list(self.__images)
+        if pc['images']:
+            targets = []
+            for pattern in pc['images']:
+                matched = [i for i in self.__images if fnmatch.fnmatchcase(i.name, pattern)]
+                if len(matched) == 0:
+                    PrettyPrinter.error(f'No image matches {pattern}.')
+                targets += [i for i in matched if i not in targets]
+            return targets
+        if self.__selected_image.name != 'none':
+            return [self.__selected_image]
+        PrettyPrinter.error(f'No image selected, use -a or specify images to {action}.')
+        return []
+
+    def check_set(self, parsed_command: dict):
+        """
+        Check whether the set command is valid.
+        :param parsed_command: command list
+        :return: True/False
+        """
+        if len(parsed_command['commands']) < 3 and parsed_command['commands'][1] in ['entry', 'basedir', 'image',
+                                                                                     'port']:
+            PrettyPrinter.error(f'no target object selected.')
+            return False
+        if self.__selected_image.name == 'none':
+            PrettyPrinter.info(f'No image selected, this command will do nothing.')
+            return False
+        return True
+
+    def connect(self) -> None:
+        """
+        connect to the docker daemon and reconcile the state, commands which only touch the config never call it.
+        """
+        _ = self.__docker_client.client
+
+    def __on_connect(self, client) -> None:
+        tracer.instrument_docker(client)
+        docker_images, docker_containers = self.reconcile()
+        for image in self.__images:
+            if image.attach(docker_images, docker_containers):
+                self.mark_dirty(image)
+        # containers labelled by PDT but not recorded in config
+        self.__orphans = sorted(docker_containers.values(), key=lambda c: (
+            container_labels(c).get(LABEL_IMAGE, ''), int(container_labels(c).get(LABEL_PORT) or 0)))
+        if len(self.__orphans) != 0:
+            PrettyPrinter.warning(f'{len(self.__orphans)} container(s) created by PDT are not recorded in config, '
+                                  f'use \'list orphan\' to check them.')
+        recorded = [c for i in self.__images for c in [*i.containers.values(), *i.pool.containers, *i.pool.stale]]
+        # orphans still publish their ports, reservations of any other port are leftovers of a crash
+        orphan_ports = [container_labels(c).get(LABEL_PORT, '') for c in self.__orphans]
+        port_allocator.sync([p for c in recorded for p in (c.outer_port, c.backend_port)] +
+                            [i.proxy_port for i in self.__images if i.proxy_port] +
+                            [int(p) for p in orphan_ports if p.isdigit()])
+        core_allocator.claim([c.cpuset for c in recorded if c.cpuset])
+        if self.watch_events:
+            self.__docker_images.watch()
+        if self.background_refill:
+            for image in self.__images:
+                if image.pool.target > len(image.pool) or image.pool.stale:
+                    self.__refiller.request(image)
+
+    def reconcile(self) -> tuple[dict, dict]:
+        """
+        Fetch the state of docker with one container listing and one image listing, instead of inspecting every
+        recorded image and container one by one.
+        :return: images indexed by short id and by tag, containers labelled by PDT or recorded in config indexed by
+                 short id
+        """
+        self.__docker_images.refresh()
+        docker_images = self.__docker_images.as_dict()
+        docker_containers = {c.short_id: c for c in self.__docker_client.containers.list(
+            all=True, sparse=True, filters={'label': LABEL_MANAGED})}
+        # containers created before PDT labelled them are only found by an unfiltered listing, they are adopted
+        missing = {c.recorded_id for i in self.__images for c in [*i.containers.values(), *i.pool.containers]
+                   if c.recorded_id} - docker_containers.keys()
+        if len(missing) != 0:
+            for c in self.__docker_client.containers.list(all=True, sparse=True):
+                if c.short_id in missing:
+                    docker_containers[c.short_id] = c
+        return docker_images, docker_containers
+
+    def __sync_services(self) -> None:
+        # containers behind running proxies and on-demand containers may have changed
+        if self.__proxies is not None:
+            for name in self.__proxies.names:
+                if (image := self.__images.get(name)) is not None:
+                    self.__proxies.update(name, self.__proxy_targets(image))
+        self.sync_activations()
+
+    def mark_dirty(self, image: PdtImage) -> None:
+        if image.name != 'none':
+            self.__dirty[image.name] = image
+
+    def take_changes(self) -> tuple[list[PdtImage], list[str]]:
+        """
+        :return: images changed and names of images deleted since the last call
+        """
+        dirty, deleted = list(self.__dirty.values()), self.__deleted
+        self.__dirty, self.__deleted = {}, []
+        return dirty, deleted
+
+    def close(self) -> None:
+        self.__docker_images.unwatch()
+        self.__refiller.stop()
+        if self.__broker is not None:
+            self.__broker.stop()
+        if self.__proxies is not None:
+            self.__proxies.close()
+        if self.__activator is not None:
+            self.__activator.close()
+
+    def add_image(self, newone) -> None:
+        self.__images.add(PdtImage(newone, self.__docker_client))
+
+    def peek_docker_images(self) -> None:
+        self.__docker_images.refresh()
+
+    def docker_images_namelist(self) -> set[str]:
+        """
+        :return: tags of all images on the host, from the image cache
+        """
+        return self.__docker_images.tags
+
+    def arg_parser(self, command):
+        # try:
+        with tracer.span('argparse'):
+            parsed = self.__get_arg_parser(command[0] if len(command) != 0 else None).parse_args(command)
+        if 'func' not in parsed:
+            PrettyPrinter.error('Incomplete command, use -h to get help.')
+            return
+        parsed.__dict__.pop('trace', None)
+        if parsed.__dict__.pop('docker', False):
+            with tracer.span('docker connect'):
+                self.connect()
+        with tracer.span('handler ' + parsed.func.__name__.lstrip('_')):
+            parsed.func(parsed.__dict__)
+        self.__sync_services()
+        # except (SystemExit, Exception):
+        #     print("Error")
+
+
+factory = None
+store = None
+use_script = False
+busy = False            # a command is being executed
+terminating = False     # SIGTERM/SIGHUP received while a command was being executed
+
+
+def crash_handler(signum=None, frame=None):
+    global terminating
+    if signum == signal.SIGINT:
+        raise KeyboardInterrupt
+    # the journal is consistent between commands, so PDT exits at once when idle, otherwise after the command
+    if busy and not terminating:
+        PrettyPrinter.warning('Terminating after the current command ...')
+        terminating = True
+        return
+    if store is not None:
+        store.close()
+    sys.exit(0)
+
+
+def execute(command: list[str], sync: bool = True) -> bool:
+    """
+    :return: whether the command succeeded, that is printed no error
+    """
+    global busy
+    busy = True
+    trace = command[:1] == ['--trace']
+    try:
+        with tracer.command(command[1:] if trace else command, force=trace), command_status() as status:
+            try:
+                factory.arg_parser(command[1:] if trace else command)
+            finally:
+                store.commit(*factory.take_changes(), sync=sync)
+                if store.need_compact():
+                    store.compact(factory.containers)
+        return not status.failed
+    finally:
+        busy = False
+
+
+def run_in_daemon(command: list[str], sync: bool = True) -> bool:
+    if (ok := forward(command)) is None:
+        PrettyPrinter.error('The PDT daemon has stopped.')
+        sys.exit(1)
+    return ok
+
+
+def exit_if_terminating() -> None:
+    if terminating:
+        store.close()
+        sys.exit(0)
+
+
+def serve(path: str) -> None:
+    global use_script
+    use_script = True   # nobody can answer questions, like 'rm image' without -y
+    factory.watch_events = True
+    factory.background_refill = True
+    server = PdtServer(path, execute, factory.command_tree, should_stop=lambda: terminating)
+
+    def between_commands(function):
+        def run():
+            try:
+                return function()
+            finally:
+                store.commit(*factory.take_changes())
+        return server.call(run)
+
+    factory.between_commands = between_commands
+    factory.start_services()
+    PrettyPrinter.info(f'PDT daemon listening on {path}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        factory.close()
+        store.compact(factory.containers)
+        store.close()
+
+
+def check_dirs():
+    if not os.path.exists('./runtime'):
+        os.mkdir('./runtime')
+    if not os.path.exists('./runtime/deploy_files'):
+        os.mkdir('./runtime/deploy_files')
+    if not os.path.exists('./runtime/deploy_files/zips'):
+        os.mkdir('./runtime/deploy_files/zips')
+
+
+def main(argv: list[str]) -> None:
+    """
+    entry of pdt.py: run a script, a single command, the daemon or the interactive console. While a daemon is
+    running it is the only process writing the config, scripts and the console send their commands to it.
+    """
+    global factory, store, use_script
+    signal.signal(signal.SIGINT, crash_handler)
+    signal.signal(signal.SIGHUP, crash_handler)
+    signal.signal(signal.SIGTERM, crash_handler)
+    mode = argv[1] if len(argv) > 1 and argv[1] in ('script', 'command', 'serve') else None
+    if (daemon := connect()) is not None:
+        daemon.close()
+        if mode not in ('script', None):
+            PrettyPrinter.error(f'A PDT daemon is listening on {SERVER_SOCKET}, stop it first.')
+            sys.exit(1)
+        PrettyPrinter.info(f'Commands are executed by the PDT daemon listening on {SERVER_SOCKET}.')
+        run = run_in_daemon
+    else:
+        check_dirs()
+        store = ConfigStore()
+        factory = PdtFactory(store.load())
+        run = execute
+    if mode == 'script':
+        use_script = True
+        if len(argv) < 3:
+            PrettyPrinter.error('No scripts specified.')
+            sys.exit(0)
+        if not os.path.exists(argv[2]):
+            PrettyPrinter.error('Script file not found.')
+            sys.exit(0)
+        with open(argv[2], 'r') as f:
+            script_content = f.read()
+        script_commands = script_content.split('\n')
+        for c in script_commands:
+            c = c.strip()
+            if len(c) == 0 or c.startswith('#'):    # empty lines and comment lines
+                continue
+            PrettyPrinter.script(c)
+            run(re.split(r'\s+', c), sync=False)
+            exit_if_terminating()
+        if store is not None:
+            store.compact(factory.containers)
+        sys.exit(0)
+    elif mode == 'command':
+        ok = execute(argv[2:])
+        store.close()
+        sys.exit(0 if ok else 1)
+    elif mode == 'serve':
+        serve(argv[2] if len(argv) > 2 else SERVER_SOCKET)
+        sys.exit(0)
+    while True:
+        cmd = input('pdt> ')
+        args = re.split(r'\s+', cmd)
+        if len(args) == 0:
+            continue
+        if args[0] == 'exit':
+            if store is not None:
+                store.compact(factory.containers)
+            print('Bye')
+            sys.exit(0)
+        run(args)
+        exit_if_terminating()
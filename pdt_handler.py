@@ -0,0 +1,117 @@
+from __future__ import annotations
+import abc
+from typing import TYPE_CHECKING
+from util import *
+
+if TYPE_CHECKING:
+    from pdt_object import PdtImage, ResourceProfile
+
+
+class Handler(abc.ABC):
+    """
+    The server accepting connections inside a container and starting the entry file for every one of them. A
+    handler owns a Dockerfile fragment, the service.sh template started as CMD, and its config files, all of them
+    in ./templates. Placeholders of the form {**key**} are replaced with the values of placeholders().
+    """
+    name: str = ''
+    packages: frozenset[str] = frozenset()      # apt packages the handler needs, added to the base image
+    dockerfile_template: str = ''
+    service_template: str = ''
+    config_templates: dict[str, str] = {}       # file in build context -> template
+    unsupported: tuple[str, ...] = ()           # limits of the resource profile the handler cannot enforce
+
+    def placeholders(self, image: PdtImage) -> dict[str, str]:
+        return {
+            'port': str(image.port),
+            'entry': f'{BASEDIR_IN_DOCKER}/{image.deploy.entry}',
+            'user': USER,
+            'limits': self.limit_lines(image.limits)
+        }
+
+    @abc.abstractmethod
+    def limit_lines(self, limits: ResourceProfile) -> str:
+        """
+        :return: the limits of the resource profile as written into the handler's templates at {**limits**}
+        """
+
+    def render(self, template: str, image: PdtImage) -> str:
+        with open(f'./templates/{template}', 'r') as f:
+            text = f.read()
+        for key, value in self.placeholders(image).items():
+            text = text.replace(f'{{**{key}**}}', value)
+        return text
+
+    def files(self, image: PdtImage) -> dict[str, str]:
+        """
+        :return: name in build context -> content, of service.sh and the config files
+        """
+        ret = {'service.sh': self.render(self.service_template, image)}
+        for name, template in self.config_templates.items():
+            ret[name] = self.render(template, image)
+        return ret
+
+    def dockerfile(self, image: PdtImage) -> str:
+        return self.render(self.dockerfile_template, image)
+
+    def ignored_limits(self, limits: ResourceProfile) -> list[str]:
+        return [k for k in self.unsupported if limits.xinetd.get(k, 'UNLIMITED') != 'UNLIMITED']
+
+
+class XinetdHandler(Handler):
+    """
+    xinetd forks and execs the entry file for every connection, with the limits written into pwn.xinetd.
+    """
+    name = 'xinetd'
+    packages = frozenset({'xinetd'})
+    dockerfile_template = 'xinetd_dockerfile.template'
+    service_template = 'service.template'
+    config_templates = {'pwn.xinetd': 'xinetd.template'}
+
+    def limit_lines(self, limits: ResourceProfile) -> str:
+        return limits.xinetd_lines()
+
+
+class SocatHandler(Handler):
+    """
+    socat forks for every connection and runs session.sh, which applies the rlimit_* limits with ulimit before
+    exec'ing the entry file. instances becomes max-children when the socat of the image supports it (1.7.4 or
+    later, checked by service.sh at start), per_source cannot be enforced by socat.
+    """
+    name = 'socat'
+    packages = frozenset({'socat'})
+    dockerfile_template = 'socat_dockerfile.template'
+    service_template = 'socat_service.template'
+    config_templates = {'session.sh': 'socat_session.template'}
+    unsupported = ('per_source',)
+    # xinetd limit -> ulimit option, sizes of ulimit are in KiB
+    ULIMIT_OPTIONS = {'rlimit_cpu': '-t', 'rlimit_as': '-v', 'rlimit_data': '-d', 'rlimit_rss': '-m',
+                      'rlimit_stack': '-s', 'rlimit_files': '-n'}
+
+    def placeholders(self, image: PdtImage) -> dict[str, str]:
+        ret = super().placeholders(image)
+        instances = image.limits.xinetd.get('instances', 'UNLIMITED')
+        ret['max children'] = '' if instances == 'UNLIMITED' else instances
+        return ret
+
+    def limit_lines(self, limits: ResourceProfile) -> str:
+        lines = []
+        for key, option in self.ULIMIT_OPTIONS.items():
+            if key in limits.xinetd:
+                lines.append(f'ulimit {option} {self.__ulimit_value(key, limits.xinetd[key])}')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def __ulimit_value(key: str, value: str) -> str:
+        if value == 'UNLIMITED':
+            return 'unlimited'
+        if key in ('rlimit_cpu', 'rlimit_files'):
+            return value
+        if value.endswith('K'):
+            return value[:-1]
+        if value.endswith('M'):
+            return str(int(value[:-1]) * 1024)
+        return str(max(1, int(value) // 1024))
+
+
+HANDLERS: dict[str, Handler] = {h.name: h for h in (XinetdHandler(), SocatHandler())}
+DEFAULT_HANDLER = 'xinetd'
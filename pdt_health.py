@@ -0,0 +1,141 @@
+import time
+import asyncio
+from util import *
+
+PROBE_HOST = '127.0.0.1'
+PROBE_CONCURRENCY = int(os.environ.get('PDT_PROBE_CONCURRENCY', 256))
+PROBE_SETTLE = 0.5      # seconds a silent connection must stay open to count as ready
+
+STATE_READY = 'ready'
+STATE_CLOSED = 'closed'         # accepted and closed at once, docker-proxy does this when xinetd is not up yet
+STATE_REFUSED = 'refused'
+STATE_TIMEOUT = 'timeout'
+STATE_BAD_BANNER = 'bad banner'
+STATE_ERROR = 'error'
+
+
+class ProbeResult:
+    def __init__(self, key, port: int):
+        self.key = key
+        self.port: int = port
+        self.state: str = STATE_ERROR
+        self.connect_ms: float | None = None
+        self.first_byte_ms: float | None = None    # None if the service printed nothing before the timeout
+        self.ready_ms: float | None = None          # time since the first probe when it got ready, see wait_ready
+        self.error: str = ''
+        self.finished: float = 0.0     # perf_counter when the probe finished
+
+    @property
+    def ok(self) -> bool:
+        return self.state == STATE_READY
+
+    def row(self) -> list:
+        return [self.port, self.state,
+                f'{self.connect_ms:.1f}' if self.connect_ms is not None else '-',
+                f'{self.first_byte_ms:.1f}' if self.first_byte_ms is not None else '-',
+                self.error]
+
+
+async def probe(key, port: int, timeout: float = 2.0, banner: bytes | None = None,
+                host: str = PROBE_HOST) -> ProbeResult:
+    """
+    Connect to a challenge and wait for its first bytes. A challenge that keeps the connection open for
+    PROBE_SETTLE seconds without printing anything is ready as well, unless a banner is expected.
+    :param key: anything identifying the target, returned in the result
+    :param banner: bytes the challenge must print within the timeout
+    """
+    result = ProbeResult(key, port)
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        result.state = STATE_TIMEOUT
+        return result
+    except ConnectionRefusedError:
+        result.state = STATE_REFUSED
+        return result
+    except OSError as e:
+        result.error = str(e)
+        return result
+    result.connect_ms = (time.perf_counter() - start) * 1000
+    data = b''
+    deadline = start + (timeout if banner is not None else min(timeout, PROBE_SETTLE))
+    try:
+        while banner is None or banner not in data:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            chunk = await asyncio.wait_for(reader.read(4096), remaining)
+            if not chunk:
+                break
+            if not data:
+                result.first_byte_ms = (time.perf_counter() - start) * 1000
+            data += chunk
+            if banner is None:
+                break
+        if not data:
+            result.state = STATE_CLOSED
+        elif banner is not None and banner not in data:
+            result.state = STATE_BAD_BANNER
+        else:
+            result.state = STATE_READY
+    except asyncio.TimeoutError:
+        # silent but open: fine unless a banner is expected
+        result.state = STATE_READY if banner is None else (STATE_BAD_BANNER if data else STATE_TIMEOUT)
+    except OSError as e:
+        result.state = STATE_CLOSED if isinstance(e, ConnectionResetError) else STATE_ERROR
+        result.error = str(e) if result.state == STATE_ERROR else ''
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+    return result
+
+
+async def probe_all(targets: list[tuple], timeout: float = 2.0, banner: bytes | None = None,
+                    concurrency: int = PROBE_CONCURRENCY) -> list[ProbeResult]:
+    """
+    probe many (key, port) targets concurrently, at most concurrency connections are open at the same time.
+    :return: results in the order of targets
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def bounded(key, port):
+        async with semaphore:
+            result = await probe(key, port, timeout, banner)
+        result.finished = time.perf_counter()
+        return result
+    return await asyncio.gather(*(bounded(key, port) for key, port in targets))
+
+
+async def wait_ready(targets: list[tuple], deadline: float, interval: float = 0.2, timeout: float = 2.0,
+                     banner: bytes | None = None, concurrency: int = PROBE_CONCURRENCY) -> dict:
+    """
+    probe the targets again and again until all of them are ready or the deadline (seconds from now) passes.
+    :return: key -> last result of every target, results of ready targets keep the time they got ready at
+    """
+    end = time.monotonic() + deadline
+    start = time.perf_counter()
+    pending = list(targets)
+    results = {}
+    while True:
+        for result in await probe_all(pending, min(timeout, max(0.1, end - time.monotonic())), banner, concurrency):
+            results[result.key] = result
+            if result.ok:
+                result.ready_ms = (result.finished - start) * 1000
+        pending = [(k, p) for k, p in pending if not results[k].ok]
+        if not pending or time.monotonic() >= end:
+            return results
+        await asyncio.sleep(interval)
+
+
+def check(targets: list[tuple], timeout: float = 2.0, banner: bytes | None = None,
+          concurrency: int = PROBE_CONCURRENCY) -> list[ProbeResult]:
+    return asyncio.run(probe_all(targets, timeout, banner, concurrency))
+
+
+def gate(targets: list[tuple], deadline: float, timeout: float = 2.0, banner: bytes | None = None,
+         concurrency: int = PROBE_CONCURRENCY) -> dict:
+    return asyncio.run(wait_ready(targets, deadline, timeout=timeout, banner=banner, concurrency=concurrency))
@@ -0,0 +1,53 @@
+from __future__ import annotations
+import time
+import hashlib
+
+
+def requester_id(token: str) -> str:
+    """
+    tokens are never stored, leases only keep a digest of them, like containers keep a digest of their flags.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+class Lease:
+    def __init__(self, requester: str, expires: float):
+        self.requester: str = requester     # digest of the token, see requester_id
+        self.expires: float = expires       # unix time
+
+    @property
+    def remaining(self) -> float:
+        return self.expires - time.time()
+
+    def to_dict(self) -> dict:
+        return {'requester': self.requester, 'expires': self.expires}
+
+    @classmethod
+    def load(cls, info: dict | None) -> Lease | None:
+        if not info:
+            return None
+        return cls(info['requester'], info['expires'])
+
+
+class BrokerPolicy:
+    """
+    How the broker hands out containers of an image: a lease lasts ttl seconds, a requester holds at most quota
+    leases and at most cap containers are leased at the same time (0 for no cap). A ttl of 0 keeps the image out
+    of the broker.
+    """
+
+    def __init__(self):
+        self.ttl: int = 0
+        self.quota: int = 1
+        self.cap: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def to_dict(self) -> dict:
+        return {'ttl': self.ttl, 'quota': self.quota, 'cap': self.cap}
+
+    def load(self, info: dict | None) -> None:
+        if info:
+            self.ttl, self.quota, self.cap = info.get('ttl', 0), info.get('quota', 1), info.get('cap', 0)
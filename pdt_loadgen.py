@@ -0,0 +1,188 @@
+import time
+import codecs
+import asyncio
+from util import *
+from pdt_health import PROBE_HOST, PROBE_SETTLE
+
+ERROR_REFUSED = 'refused'
+ERROR_CLOSED = 'closed'         # closed by the server, xinetd does this when instances or per_source is exceeded
+ERROR_TIMEOUT = 'timeout'
+ERROR_MISMATCH = 'mismatch'
+ERROR_OTHER = 'error'
+
+
+class Step:
+    def __init__(self, action: str, data: bytes = b'', seconds: float = 0.0):
+        self.action: str = action     # send / expect / sleep
+        self.data: bytes = data
+        self.seconds: float = seconds
+
+
+def parse_script(text: str) -> list[Step]:
+    """
+    Parse a scripted exchange, one step a line, empty lines and lines starting with # are ignored:
+        expect <text>       wait until the text is received
+        send <text>         send the text, escapes like \\n and \\x00 are allowed
+        sendline <text>     send the text and a newline
+        sleep <seconds>     think time
+    """
+    steps = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        action, _, arg = line.partition(' ')
+        data = codecs.escape_decode(arg.encode())[0]
+        if action == 'expect' or action == 'send':
+            steps.append(Step(action, data))
+        elif action == 'sendline':
+            steps.append(Step('send', data + b'\n'))
+        elif action == 'sleep':
+            steps.append(Step('sleep', seconds=float(arg)))
+        else:
+            raise ValueError(f'line {number}: unknown step {action}')
+    return steps
+
+
+class SessionResult:
+    def __init__(self):
+        self.error: str | None = None
+        self.connect_ms: float | None = None
+        self.session_ms: float | None = None
+
+
+async def session(port: int, steps: list[Step], timeout: float, host: str = PROBE_HOST) -> SessionResult:
+    """
+    one player: connect, run the steps, close. Without steps the session waits for the first bytes, a server
+    which stays silent for PROBE_SETTLE seconds is fine as well.
+    """
+    result = SessionResult()
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        result.error = ERROR_TIMEOUT
+        return result
+    except ConnectionRefusedError:
+        result.error = ERROR_REFUSED
+        return result
+    except OSError:
+        result.error = ERROR_OTHER
+        return result
+    result.connect_ms = (time.perf_counter() - start) * 1000
+    buffer = b''
+    try:
+        if len(steps) == 0:
+            try:
+                if await asyncio.wait_for(reader.read(4096), min(timeout, PROBE_SETTLE)) == b'':
+                    result.error = ERROR_CLOSED
+            except asyncio.TimeoutError:
+                pass
+        for step in steps:
+            if step.action == 'send':
+                writer.write(step.data)
+                await writer.drain()
+            elif step.action == 'sleep':
+                await asyncio.sleep(step.seconds)
+            else:
+                while step.data not in buffer:
+                    chunk = await asyncio.wait_for(reader.read(4096), timeout)
+                    if not chunk:
+                        result.error = ERROR_CLOSED if buffer == b'' else ERROR_MISMATCH
+                        break
+                    buffer += chunk
+                if result.error is not None:
+                    break
+                buffer = buffer[buffer.index(step.data) + len(step.data):]
+    except asyncio.TimeoutError:
+        result.error = ERROR_TIMEOUT
+    except ConnectionResetError:
+        result.error = ERROR_CLOSED
+    except OSError:
+        result.error = ERROR_OTHER
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+    if result.error is None:
+        result.session_ms = (time.perf_counter() - start) * 1000
+    return result
+
+
+class LevelReport:
+    """
+    results of one concurrency level.
+    """
+
+    def __init__(self, concurrency: int, results: list[SessionResult], wall: float):
+        self.concurrency: int = concurrency
+        self.sessions: int = len(results)
+        self.wall: float = wall
+        self.errors: dict[str, int] = {}
+        for r in results:
+            if r.error is not None:
+                self.errors[r.error] = self.errors.get(r.error, 0) + 1
+        self.ok: int = self.sessions - sum(self.errors.values())
+        self.latency: list[float] = sorted(r.session_ms for r in results if r.session_ms is not None)
+        self.connect: list[float] = sorted(r.connect_ms for r in results if r.connect_ms is not None)
+
+    @property
+    def error_rate(self) -> float:
+        return 1 - self.ok / self.sessions if self.sessions else 0.0
+
+    @staticmethod
+    def percentile(values: list[float], p: float) -> str:
+        if len(values) == 0:
+            return '-'
+        return f'{values[min(len(values) - 1, int(len(values) * p))]:.1f}'
+
+    def row(self) -> list:
+        return [self.concurrency, self.sessions, f'{self.ok / self.wall:.1f}' if self.wall else '-',
+                f'{self.error_rate:.1%}', self.percentile(self.connect, 0.5),
+                self.percentile(self.latency, 0.5), self.percentile(self.latency, 0.9),
+                self.percentile(self.latency, 0.99), f'{self.latency[-1]:.1f}' if self.latency else '-',
+                ', '.join(f'{k} {v}' for k, v in sorted(self.errors.items()))]
+
+    HEADERS = ['conc', 'sessions', 'ok conn/s', 'errors', 'connect p50', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+               'error kinds']
+
+
+async def run_level(port: int, steps: list[Step], concurrency: int, sessions: int | None, duration: float | None,
+                    timeout: float) -> LevelReport:
+    """
+    keep concurrency sessions open at the same time, until the count of sessions or the duration is reached.
+    """
+    results: list[SessionResult] = []
+    started = 0
+    start = time.perf_counter()
+
+    async def player():
+        nonlocal started
+        while True:
+            if sessions is not None and started >= sessions:
+                return
+            if duration is not None and time.perf_counter() - start >= duration:
+                return
+            started += 1
+            results.append(await session(port, steps, timeout))
+    await asyncio.gather(*(player() for _ in range(concurrency)))
+    return LevelReport(concurrency, results, time.perf_counter() - start)
+
+
+def bench(port: int, steps: list[Step], levels: list[int], sessions: int | None = None,
+          duration: float | None = None, timeout: float = 5.0, on_level=None) -> list[LevelReport]:
+    """
+    run the levels of concurrency one after another against one port.
+    :param sessions: sessions of every level, 10 times the concurrency if neither sessions nor duration is given
+    :param on_level: called with the report of every level as soon as it finishes
+    """
+    reports = []
+    for concurrency in levels:
+        count = sessions if sessions is not None or duration is not None else concurrency * 10
+        report = asyncio.run(run_level(port, steps, concurrency, count, duration, timeout))
+        reports.append(report)
+        if on_level is not None:
+            on_level(report)
+    return reports
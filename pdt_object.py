@@ -1,64 +1,162 @@
-import docker
+from __future__ import annotations
+import io
+import json
+import time
 import hashlib
-import zipfile
+import threading
+from typing import TYPE_CHECKING
 from util import *
-from docker import errors
-from docker.client import DockerClient
-from docker.models.containers import Container
-from docker.models.images import Image
+from pdt_handler import HANDLERS, DEFAULT_HANDLER, Handler
+from pdt_pool import WarmPool
+from pdt_lease import BrokerPolicy, Lease
+from pdt_port import port_allocator
+from pdt_registry import ContainerRegistry
+from pdt_trace import tracer
+
+if TYPE_CHECKING:
+    from docker.client import DockerClient
+    from docker.models.containers import Container
+    from docker.models.images import Image
+
+docker = LazyModule('docker')   # the docker SDK is only imported when a command really talks to the daemon
+concurrent_futures = LazyModule('concurrent.futures')     # only bulk operations use threads
+tarfile = LazyModule('tarfile')     # archives are only written by build and when flags are put into containers
+tempfile = LazyModule('tempfile')
+
+# archive key -> lock, images with the same deploy files share one archive in ZIP_DIR, built only once
+_archive_locks: dict[str, threading.Lock] = {}
+_base_locks: dict[str, threading.Lock] = {}     # base image tag -> lock, a base image is built only once
+_locks_guard = threading.Lock()
+
+
+def _reset_owner(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    info.uid = info.gid = 0
+    info.uname = info.gname = 'root'
+    return info
 
 
 class PdtImage:
-    def __init__(self, name: str, docker_client: docker.client.DockerClient):
+    def __init__(self, name: str, docker_client: DockerClient | LazyDockerClient):
         self.__name: str = name
         self.__parent: Image | None = None          # image object of docker SDK
+        self.__parent_id: str | None = None         # short id recorded in config, resolved by attach()
         self.__image_object: Image | None = None  # image object of docker SDK
-        self.apt: set[str] = {'xinetd', 'lib32z1', 'zip'}
+        self.__image_id: str | None = None
+        self.apt: set[str] = {'lib32z1'}     # packages of the handler are installed as well, see packages
+        self.handler_name: str = DEFAULT_HANDLER    # server accepting connections in containers, see pdt_handler
         self.deploy: PdtDeploy = PdtDeploy()
         self._port: int = 0  # port of container itself, you can set outer ports for __containers to map it to the host
+        self.stop_timeout: int = DEFAULT_STOP_TIMEOUT  # seconds to wait for a container to stop before killing it
         # runtime related
         self.__docker_client: DockerClient = docker_client
-        self.__containers: dict[int, PdtContainer] = {}
+        self.__containers: ContainerRegistry = ContainerRegistry()
+        self.stable_ids: bool = False   # keep container ids after deleting containers instead of compacting them
+        self.limits: ResourceProfile = ResourceProfile()
+        self.pool: WarmPool = WarmPool()    # ready containers waiting to be handed out by 'run -n'
+        self.proxy_port: int = 0    # public port of the load balancing proxy in front of the containers, 0 if none
+        self.idle_timeout: int = 0  # seconds before an idle on-demand container is stopped, 0 if always running
+        self.broker: BrokerPolicy = BrokerPolicy()  # how containers are leased to requesters, see pdt_broker
+        self.build_error: str = ''  # why the last build failed
 
     def initialize(self, info: dict):
+        """
+        restore an image from config. Docker objects are not looked up here, see attach().
+        :param info: config of this image
+        """
         if {'name', 'parent image id', 'apt list', 'base directory', 'deployed files',
             'entry file', 'port', 'containers'} \
                 < set(info.keys()):
             self.__name = info['name']
-            try:
-                self.__parent = self.__docker_client.images.get(info['parent image id']) \
-                    if info['parent image id'] is not None else None
-            except docker.errors.ImageNotFound:
-                PrettyPrinter.error(f"parent image for {info['name']}({info['parent image id']} not found.)")
-                self.__parent = None
-            try:
-                self.__parent = self.__docker_client.images.get(info['image id']) \
-                    if info['image id'] is not None else None
-            except docker.errors.ImageNotFound:
-                PrettyPrinter.error(f"image id {info['image id']} not found.")
-                self.__image_object = None
-            self.apt = info['apt list']
+            self.__parent_id = info['parent image id']
+            self.__image_id = info['image id']
+            self.apt = set(info['apt list'])
             self.deploy.basedir = info['base directory']
-            self.deploy.files = info['deployed files']
+            self.deploy.files = set(info['deployed files'])
             self.deploy.entry = info['entry file']
             self.port = info['port']
-            idx = 1
-            for c in info['containers'].keys():
-                try:        # discard containers not found
-                    container_object = self.__docker_client.containers.get(info['containers'][c]['container id'])
-                except docker.errors.NotFound:
-                    PrettyPrinter.error(f"container {info['containers'][c]['container id']} not found.")
-                    continue
+            self.stop_timeout = info.get('stop timeout', DEFAULT_STOP_TIMEOUT)
+            self.stable_ids = info.get('stable ids', False)
+            self.limits.load(info.get('resource profile'))
+            self.handler_name = info.get('handler', DEFAULT_HANDLER)
+            if self.handler_name not in HANDLERS:
+                PrettyPrinter.error(f'unknown handler {self.handler_name} of {self.__name}, using {DEFAULT_HANDLER}.')
+                self.handler_name = DEFAULT_HANDLER
+            for idx, c in info['containers'].items():
+                container = PdtContainer(self)
+                container.id = int(idx)
+                container.flag = c['flag']
+                container.outer_port = c['mapping port']
+                container.backend_port = c.get('backend port', 0)
+                container.recorded_id = c['container id']
+                container.cpuset = c.get('cpuset')
+                container.lease = Lease.load(c.get('lease'))
+                self.__containers.add(container)
+            self.pool.target = info.get('pool size', 0)
+            self.proxy_port = info.get('proxy port', 0)
+            self.idle_timeout = info.get('ondemand idle', 0)
+            self.broker.load(info.get('broker'))
+            pooled = []
+            for c in info.get('pool', []):
                 container = PdtContainer(self)
-                container.id = idx
-                container.flag = info['containers'][c]['flag']
-                container.outer_port = info['containers'][c]['mapping port']
-                container.container_object = container_object
-                self.__containers[idx] = container
-                idx += 1
+                container.flag = c['flag']
+                container.outer_port = c['mapping port']
+                container.recorded_id = c['container id']
+                container.cpuset = c.get('cpuset')
+                pooled.append(container)
+            self.pool.load(pooled)
         else:
             PrettyPrinter.error(f'initialization of container {self.__name} failed.')
 
+    def attach(self, docker_images: dict, docker_containers: dict) -> bool:
+        """
+        resolve the docker objects of this image and its containers after connecting to the daemon.
+        :param docker_images: docker images indexed by short id and by tag, see PdtFactory.reconcile
+        :param docker_containers: containers labelled by PDT or recorded in config indexed by short id, containers
+                                  found are popped out
+        :return: whether the state recorded in config changed
+        """
+        recorded = (self.parent_image_id, self.image_id, [c.container_id for c in self.__containers.values()],
+                    [c.container_id for c in self.pool.containers])
+        if self.__parent_id is not None:
+            self.__parent = docker_images.get(self.__parent_id)
+            if self.__parent is None:
+                PrettyPrinter.error(f"parent image for {self.__name}({self.__parent_id}) not found.")
+                self.__parent_id = None
+        if self.__image_id is not None:
+            self.__image_object = docker_images.get(self.__image_id)
+            if self.__image_object is None and (tagged := docker_images.get(f'{self.__name}:latest')):
+                PrettyPrinter.warning(f"image {self.__name} was rebuilt outside PDT "
+                                      f"({self.__image_id} -> {tagged.short_id[7:]}), using the new one.")
+                self.__image_object = tagged
+            elif self.__image_object is None:
+                PrettyPrinter.error(f"image id {self.__image_id} not found.")
+                self.__image_id = None
+        for container in self.__containers.values():
+            container.container_object = docker_containers.pop(container.recorded_id, None)
+            if container.container_object is None:     # discard containers not found
+                PrettyPrinter.error(f"container {container.recorded_id} not found.")
+                self.__containers.remove(container.id)
+                self.__release_reservations(container)
+                continue
+            for drift in container.check_labels():
+                PrettyPrinter.warning(f'container {container.container_id} of {self.__name}: {drift}')
+        if not self.stable_ids:
+            self.__containers.compact()
+        pooled = []
+        for container in self.pool.containers:
+            container.container_object = docker_containers.pop(container.recorded_id, None)
+            if container.container_object is None:
+                PrettyPrinter.error(f"pooled container {container.recorded_id} of {self.__name} not found.")
+                self.__release_reservations(container)
+            elif container.status != 'running':
+                self.pool.stale.append(container)
+            else:
+                pooled.append(container)
+        self.pool.load(pooled)
+        return recorded != (self.parent_image_id, self.image_id,
+                            [c.container_id for c in self.__containers.values()],
+                            [c.container_id for c in self.pool.containers])
+
     @property
     def info_dict(self):
         return {
@@ -70,10 +168,22 @@ class PdtImage:
             'deployed files': self.deploy.files if len(self.deploy.files) != 0 else '<not set>',
             'entry file': self.deploy.entry if self.deploy.entry != '' else '<not set>',
             'port': self.port if self.port != 0 else '<not set>',
+            'stop timeout': self.stop_timeout,
+            'stable ids': self.stable_ids,
+            'handler': self.handler_name,
+            'resource profile': self.limits.to_dict(),
+            'pool size': self.pool.target,
+            'pool': self.pool.to_list(),
+            'proxy port': self.proxy_port,
+            'ondemand idle': self.idle_timeout,
+            'broker': self.broker.to_dict(),
             'containers': {c.id: {
                 'flag': c.flag if c.flag != '' else '<not set>',
                 'mapping port': c.outer_port if c.outer_port != 0 else '<not set>',
-                'container id': c.container_id
+                'backend port': c.backend_port,
+                'container id': c.container_id,
+                'cpuset': c.cpuset,
+                'lease': c.lease.to_dict() if c.lease is not None else None
             } for c in self.__containers.values()}
         }
 
@@ -88,10 +198,22 @@ class PdtImage:
             'deployed files': self.deploy.files,
             'entry file': self.deploy.entry,
             'port': self.port,
+            'stop timeout': self.stop_timeout,
+            'stable ids': self.stable_ids,
+            'handler': self.handler_name,
+            'resource profile': self.limits.to_dict(),
+            'pool size': self.pool.target,
+            'pool': self.pool.to_list(),
+            'proxy port': self.proxy_port,
+            'ondemand idle': self.idle_timeout,
+            'broker': self.broker.to_dict(),
             'containers': {c.id: {
                 'flag': c.flag,
                 'mapping port': c.outer_port,
-                'container id': c.container_id
+                'backend port': c.backend_port,
+                'container id': c.container_id,
+                'cpuset': c.cpuset,
+                'lease': c.lease.to_dict() if c.lease is not None else None
             } for c in self.__containers.values()}
         }
 
@@ -101,14 +223,17 @@ class PdtImage:
 
     @property
     def parent_image_id(self):
-        return self.__parent.short_id[7:] if self.__parent is not None else None
+        return self.__parent.short_id[7:] if self.__parent is not None else self.__parent_id
 
     @property
     def parent(self):
         return self.__parent
 
     @parent.setter
-    def parent(self, name: str):
+    def parent(self, name: str | Image):
+        if not isinstance(name, str):     # image object looked up by the caller
+            self.__parent = name
+            return
         try:
             self.__parent = self.__docker_client.images.get(name)
         except docker.errors.ImageNotFound:
@@ -120,7 +245,7 @@ class PdtImage:
 
     @property
     def image_id(self):
-        return self.__image_object.short_id[7:] if self.__image_object is not None else None
+        return self.__image_object.short_id[7:] if self.__image_object is not None else self.__image_id
 
     @property
     def image_object(self):
@@ -132,15 +257,15 @@ class PdtImage:
 
     @property
     def container_cnt(self):
-        return len(self.__containers.keys())
+        return len(self.__containers)
 
     def container_stat(self, idx: int):
-        if 1 <= idx <= len(self.__containers.keys()):
+        if idx in self.__containers:
             return self.__containers[idx].container_object.status
         PrettyPrinter.error(f"Index out of bound for getting status of container #{idx}")
 
     def start_container(self, idx: int):
-        if 1 <= idx <= len(self.__containers.keys()):
+        if idx in self.__containers:
             self.__containers[idx].container_object.start()
         else:
             PrettyPrinter.error(f"Index out of bound for starting a container #{idx}")
@@ -158,188 +283,544 @@ class PdtImage:
             return
         self._port = value
 
-    def build(self):
+    def build(self) -> bool:
+        """
+        :return: whether the image was built, build_error tells why it was not
+        """
+        self.build_error = ''
         if self.__parent is None or len(self.deploy.files) == 0 or self.deploy.entry == '' or self.port == 0:
             PrettyPrinter.error('Incomplete info of container found, use \'list\' to check the missing config.')
             PrettyPrinter.error('Failed to run ' + self.__name)
-            return
+            self.build_error = 'incomplete config, parent image, deploy files, entry and port are needed'
+            return False
+        if not self.build_base():
+            return False
         with open('./templates/dockerfile.template', 'r') as f:
             dockerfile = f.read()
-        with open('./templates/xinetd.template', 'r') as f:
-            xinetd = f.read()
+        handler = self.handler
+        for key in handler.ignored_limits(self.limits):
+            PrettyPrinter.warning(f'{key} is not supported by handler {handler.name}, ignored.')
         if not os.path.exists(f'{DEPLOY_FILE_DIR}/{self.__name}'):
             os.mkdir(f'{DEPLOY_FILE_DIR}/{self.__name}')
-        if not os.path.exists(f'{ZIP_DIR}/{self.deploy.hash()}.zip'):
-            zf = zipfile.ZipFile(f'{ZIP_DIR}/{self.deploy.hash()}.zip', mode='w')
-            PrettyPrinter.info(f'building {zf.filename} ...')
-            for file in self.deploy.files:
-                if os.path.isdir(f'{self.deploy.basedir}/{file}'):
-                    for parent, dirname, filename in os.walk(f'{self.deploy.basedir}/{file}'):
-                        for dirfile in filename:
-                            PrettyPrinter.info(f'Adding {dirfile} ...')
-                            zf.write(f'{parent}/{dirfile}', f'{parent}/{dirfile}'[len(self.deploy.basedir) + 1:])
-                elif os.path.exists(f'{self.deploy.basedir}/{file}'):
-                    zf.write(f'{self.deploy.basedir}/{file}', file)
-                else:
-                    PrettyPrinter.error(f'File not found: {self.deploy.basedir}/{file}')
-            zf.close()
+        with tracer.span('deploy hash', image=self.__name):
+            archive_key = self.deploy.hash()
+        with _locks_guard:
+            lock = _archive_locks.setdefault(archive_key, threading.Lock())
+        with lock:
+            if not os.path.exists(f'{ZIP_DIR}/{archive_key}.tar'):
+                # write to a temporary name first, so that a half-written archive is never reused
+                with tracer.span('archive', image=self.__name), \
+                        tarfile.open(f'{ZIP_DIR}/{archive_key}.tar.tmp', mode='w') as tf:
+                    PrettyPrinter.info(f'building {ZIP_DIR}/{archive_key}.tar ...')
+                    for arcname, path in self.deploy.manifest():
+                        PrettyPrinter.info(f'Adding {arcname} ...')
+                        tf.add(path, arcname, recursive=False, filter=_reset_owner)
+                os.replace(f'{ZIP_DIR}/{archive_key}.tar.tmp', f'{ZIP_DIR}/{archive_key}.tar')
+            else:
+                PrettyPrinter.info(f'deploy files unchanged, reusing {ZIP_DIR}/{archive_key}.tar')
+        deploy_index.save()
 
         # generate dockerfile
         d = open(f'{DEPLOY_FILE_DIR}/{self.__name}/Dockerfile', 'w')
         d.write(
             dockerfile.format(
-                image=self.__parent.tags[0],
-                apt=' '.join(list(self.apt)),
-                copyfile=f'{self.deploy.hash()}.zip',
+                image=self.base_tag,
+                copyfile=DEPLOY_ARCHIVE_NAME,
                 entry=self.deploy.entry,
                 basedir_in_docker=BASEDIR_IN_DOCKER,
                 port=self.port,
-                name=self.__name
+                name=self.__name,
+                uid=USER_ID,
+                handler=handler.dockerfile(self)
             )
         )
         d.close()
 
-        # generate xinetd config file
-        x = open(f'{DEPLOY_FILE_DIR}/{self.__name}/pwn.xinetd', 'w')
-        x.write(
-            xinetd.replace('{**port**}', str(self.port))
-            .replace('{**entry**}', f'{BASEDIR_IN_DOCKER}/{self.deploy.entry}')
-        )
-        x.close()
-
-        # start service file
-        os.system(f'cp ./templates/service.template ./runtime/deploy_files/{self.__name}/service.sh')
-
-        # # build your image for pwn problems
-        # with open('./templates/build_shell.template', 'r') as f:
-        #     shell = f.read()
-        # shell = shell.format(name=self.__name, dockerfile=self.__name + '/Dockerfile')
-        # with open(f'./runtime/deploy_files/{self.__name}/build.sh', 'w') as f:
-        #     f.write(shell)
-        # os.chmod(f'./runtime/deploy_files/{self.__name}/build.sh', 0o744)
+        # generate service.sh and config files of the handler
+        for file, content in handler.files(self).items():
+            with open(f'{DEPLOY_FILE_DIR}/{self.__name}/{file}', 'w') as f:
+                f.write(content)
 
         try:
-            self.__image_object, _ = self.__docker_client.images.build(
-                path=relative_to_absolute_path('./runtime/deploy_files'),
-                tag=self.__name,
-                dockerfile=relative_to_absolute_path(f'runtime/deploy_files/{self.__name}/Dockerfile'),
-                quiet=False,
-                rm=True
-            )
-        except docker.errors.BuildError:
-            PrettyPrinter.error(f'Failed to build image: {self.__name}')
-            return
+            with self.build_context(f'{ZIP_DIR}/{archive_key}.tar') as context:
+                self.__image_object, _ = self.__docker_client.images.build(
+                    fileobj=context,
+                    custom_context=True,
+                    tag=self.__name,
+                    labels={LABEL_MANAGED: 'true', LABEL_IMAGE: self.__name},
+                    quiet=False,
+                    rm=True
+                )
+        except (docker.errors.BuildError, docker.errors.APIError) as e:
+            PrettyPrinter.error(f'Failed to build image: {self.__name} ({e})')
+            self.build_error = str(e)
+            return False
         PrettyPrinter.info(f'Successfully built image: {self.__name}.')
+        return True
+
+    @property
+    def ondemand(self) -> bool:
+        """
+        whether new containers are started by their first connection and stopped when idle, see pdt_activator.
+        """
+        return self.idle_timeout > 0
+
+    @property
+    def handler(self) -> Handler:
+        return HANDLERS[self.handler_name]
+
+    @property
+    def packages(self) -> set[str]:
+        """
+        apt packages of the base image: the apt list and the packages of the handler.
+        """
+        return self.apt | self.handler.packages
+
+    @property
+    def base_tag(self) -> str:
+        """
+        tag of the shared base image, images with the same parent and packages get the same tag.
+        """
+        key = self.__parent.id + ';' + ' '.join(sorted(self.packages))
+        return f'{BASE_IMAGE_REPO}:{hashlib.sha256(key.encode()).hexdigest()[:16]}'
+
+    def build_base(self) -> bool:
+        """
+        Build the base image (parent + apt packages) of this image if it does not exist yet. It is built only once
+        for every group of images with the same parent and packages, even when they are built concurrently.
+        """
+        tag = self.base_tag
+        with _locks_guard:
+            lock = _base_locks.setdefault(tag, threading.Lock())
+        with lock:
+            try:
+                self.__docker_client.images.get(tag)
+                return True
+            except docker.errors.ImageNotFound:
+                pass
+            with open('./templates/base_dockerfile.template', 'r') as f:
+                dockerfile = f.read().format(image=self.__parent.tags[0], apt=' '.join(sorted(self.packages)))
+            context = tempfile.SpooledTemporaryFile(max_size=CONTEXT_SPOOL_SIZE)
+            with tarfile.open(fileobj=context, mode='w') as tf:
+                info = tarfile.TarInfo('Dockerfile')
+                info.size = len(dockerfile.encode())
+                tf.addfile(info, io.BytesIO(dockerfile.encode()))
+            context.seek(0)
+            PrettyPrinter.info(f'building base image {tag} for {self.__parent.tags[0]} ...')
+            try:
+                self.__docker_client.images.build(
+                    fileobj=context,
+                    custom_context=True,
+                    tag=tag,
+                    labels={'pdt.base.parent': self.__parent.id, 'pdt.base.apt': ' '.join(sorted(self.packages))},
+                    quiet=False,
+                    rm=True
+                )
+            except (docker.errors.BuildError, docker.errors.APIError) as e:
+                PrettyPrinter.error(f'Failed to build base image {tag} for {self.__name} ({e})')
+                self.build_error = f'base image {tag}: {e}'
+                return False
+            finally:
+                context.close()
+            PrettyPrinter.info(f'Successfully built base image: {tag}.')
+            return True
 
-        # return_code = os.system(f'./runtime/deploy_files/{self.__name}/build.sh')
-        # if return_code == 0:
-        #     PrettyPrinter.info(f'Successfully built image: {self.__name}.')
-        # else:
-        #     PrettyPrinter.error(f'Failed to build image: {self.__name}')
+    def build_context(self, archive: str):
+        """
+        Pack the build context of this image only: the generated Dockerfile, service.sh and config files of the
+        handler and the deploy archive. The context is spooled in memory (or a temporary file when it is large) and streamed
+        to the docker daemon, instead of uploading the whole deploy_files directory for every build.
+        :param archive: path of the deploy archive in ZIP_DIR
+        :return: file object positioned at the start of the tar stream
+        """
+        context = tempfile.SpooledTemporaryFile(max_size=CONTEXT_SPOOL_SIZE)
+        with tracer.span('build context', image=self.__name), tarfile.open(fileobj=context, mode='w') as tf:
+            for file in ['Dockerfile', 'service.sh', *self.handler.config_templates]:
+                tf.add(f'{DEPLOY_FILE_DIR}/{self.__name}/{file}', file, filter=_reset_owner)
+            tf.add(archive, DEPLOY_ARCHIVE_NAME, filter=_reset_owner)
+        context.seek(0)
+        return context
 
     def next_container_id(self):
-        return len(self.__containers) + 1
+        return self.__containers.next_id()
 
     def add_container(self, outer_port: None | int = None, flag: None | str = None, exit_after_created: bool = False):
+        self.add_containers(1, outer_port=outer_port, flag=flag, exit_after_created=exit_after_created)
+
+    def __create_container(self, index: int, outer_port: int, flag: str, exit_after_created: bool,
+                           cpuset: str | None = None, backend_port: int = 0) -> PdtContainer:
+        """
+        create a container, put its flag and start it, unless exit_after_created. Flags are never baked into the
+        image, so one build serves any number of containers with distinct flags. On-demand containers (with a
+        backend port) are only created, the activator starts them.
+        """
         new_container: PdtContainer = PdtContainer(self)
-        new_container.id = self.next_container_id()
-        if outer_port is not None:
-            if not 10000 <= outer_port <= 65535:
-                PrettyPrinter.warning(f"Bad outer port specified: {outer_port}, 10000~65535 needed.")
-                new_container.outer_port = get_free_port()
-                PrettyPrinter.info(f"Allocated a random free port: {new_container.outer_port}")
-            else:
-                if check_sock_free(outer_port):
-                    new_container.outer_port = outer_port
+        new_container.id = index
+        new_container.outer_port = outer_port
+        new_container.backend_port = backend_port
+        new_container.cpuset = cpuset
+        new_container.flag = flag
+        for retry in range(CREATE_RETRIES):
+            try:
+                created = self.__prepare_object(new_container)
+                if not exit_after_created and not backend_port:
+                    self.__start_or_remove(created)
+                new_container.container_object = created
+                break
+            except docker.errors.APIError as e:
+                replacement = []
+                if retry < CREATE_RETRIES - 1 and 'port' in str(e).lower():
+                    # the port docker publishes, the outer port is held by the activator for on-demand containers
+                    seized = new_container.backend_port or new_container.outer_port
+                    PrettyPrinter.warning(f"Socket {seized} seized. Trying to get a new port...")
+                    port_allocator.mark_used(seized)
+                    replacement = port_allocator.allocate(1)
+                if len(replacement) == 0:
+                    port_allocator.release([new_container.outer_port, new_container.backend_port])
+                    if cpuset is not None:
+                        core_allocator.release([cpuset])
+                    raise
+                if new_container.backend_port:
+                    new_container.backend_port = replacement[0]
                 else:
-                    PrettyPrinter.warning(f"Specified port was occupied.")
-                    new_container.outer_port = get_free_port()
-                    PrettyPrinter.info(f"Allocated a random free port: {new_container.outer_port}")
+                    new_container.outer_port = replacement[0]
+        return new_container
+
+    def __prepare_object(self, container: PdtContainer) -> Container:
+        """
+        create the docker container of a PdtContainer, with its port, labels, limits and cores, and put its flag.
+        The docker container is not started, and it is removed again if putting the flag fails.
+        """
+        limits = self.limits.run_kwargs()
+        if container.cpuset is not None:
+            limits['cpuset_cpus'] = container.cpuset
+        if container.backend_port:
+            published = ('127.0.0.1', container.backend_port)
         else:
-            new_container.outer_port = get_free_port()
-            PrettyPrinter.info(f"Allocated a random free port: {new_container.outer_port}")
-        if flag is not None:
-            new_container.flag = flag
-        while True:
+            published = ('0.0.0.0', container.outer_port)
+        created = self.__docker_client.containers.create(
+            image=self.__name,
+            ports={f'{self.port}/tcp': published},
+            labels=container.labels,
+            detach=True,
+            **limits
+        )
+        try:
+            created.put_archive('/', flag_archive(container.flag))
+        except docker.errors.APIError:
+            self.__remove_quietly(created)
+            raise
+        return created
+
+    def __start_or_remove(self, created: Container) -> None:
+        try:
+            created.start()
+        except docker.errors.APIError:
+            self.__remove_quietly(created)
+            raise
+
+    @staticmethod
+    def __remove_quietly(container_object: Container) -> None:
+        try:
+            container_object.remove(force=True)
+        except docker.errors.APIError:
+            pass
+
+    def __reset_one(self, ctn: PdtContainer) -> tuple[str, float | None, float]:
+        """
+        replace the docker container of ctn with a fresh one from the same image, keeping the id, port, flag and
+        cores. The fresh container is created and gets its flag while the old one still serves, so the challenge
+        is only down between removing the old container and starting the new one. A fresh container follows the
+        current on-demand setting of the image: it gets a backend port and is left to the activator, or it
+        publishes the outer port again.
+        :return: outcome, downtime and total time in ms
+        """
+        start_time = time.perf_counter()
+        old_id = ctn.container_id
+        old_backend = ctn.backend_port
+        if self.ondemand and not old_backend:
+            allocated = port_allocator.allocate(1)
+            if len(allocated) == 0:
+                return ('failed, old container kept: no free port for the backend', None,
+                        (time.perf_counter() - start_time) * 1000)
+            ctn.backend_port = allocated[0]
+        elif not self.ondemand:
+            ctn.backend_port = 0
+        try:
+            fresh = self.__prepare_object(ctn)
+        except docker.errors.APIError as e:
+            self.__restore_backend(ctn, old_backend)
+            return f'failed, old container kept: {e}', None, (time.perf_counter() - start_time) * 1000
+        down_time = time.perf_counter()
+        try:
+            if ctn.container_object is not None:
+                ctn.container_object.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+        except docker.errors.APIError as e:
+            self.__remove_quietly(fresh)
+            self.__restore_backend(ctn, old_backend)
+            return f'failed, old container kept: {e}', None, (time.perf_counter() - start_time) * 1000
+        ctn.container_object = fresh
+        if old_backend != ctn.backend_port:
+            port_allocator.release([old_backend])
+        if ctn.backend_port:
+            end_time = time.perf_counter()
+            return (f'{old_id} -> {ctn.container_id}, starts on demand', (end_time - down_time) * 1000,
+                    (end_time - start_time) * 1000)
+        try:
+            fresh.start()
+        except docker.errors.APIError as e:
+            return f'created but not started: {e}', None, (time.perf_counter() - start_time) * 1000
+        end_time = time.perf_counter()
+        return f'{old_id} -> {ctn.container_id}', (end_time - down_time) * 1000, (end_time - start_time) * 1000
+
+    @staticmethod
+    def __restore_backend(ctn: PdtContainer, old_backend: int) -> None:
+        if ctn.backend_port != old_backend:
+            port_allocator.release([ctn.backend_port])
+            ctn.backend_port = old_backend
+
+    def reset_containers(self, cid: list, jobs: int = DEFAULT_RUN_JOBS) -> list[PdtContainer]:
+        """
+        replace the docker containers of the given ids with fresh ones concurrently, see __reset_one.
+        :return: containers reset and started
+        """
+        ids = self.__collect_ids(cid)
+        if ids is None:
+            return []
+        targets = []
+        for i in ids:
+            if (ctn := self.__containers.get(i)) is None:
+                PrettyPrinter.error(f'container for id {i} not found.')
+            else:
+                targets.append(ctn)
+        if len(targets) == 0:
+            return []
+        start_time = time.monotonic()
+        outcomes: dict[int, tuple] = {}
+        with concurrent_futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(targets))),
+                                                   thread_name_prefix='pdt-reset',
+                                                   initializer=inherit_output()) as pool:
+            futures = {pool.submit(self.__reset_one, ctn): ctn for ctn in targets}
+            for future in concurrent_futures.as_completed(futures):
+                outcomes[futures[future].id] = future.result()
+        elapsed = time.monotonic() - start_time
+        print(PrettyPrinter.table(
+            [[ctn.id, ctn.outer_port, outcomes[ctn.id][0],
+              f'{outcomes[ctn.id][1]:.0f}' if outcomes[ctn.id][1] is not None else '-',
+              f'{outcomes[ctn.id][2]:.0f}'] for ctn in targets],
+            ['id', 'port', 'outcome', 'downtime ms', 'total ms']))
+        downtime = sorted(o[1] for o in outcomes.values() if o[1] is not None)
+        if len(downtime) != 0:
+            PrettyPrinter.info(f'{len(downtime)}/{len(targets)} containers of {self.__name} reset in {elapsed:.2f}s, '
+                               f'downtime median {downtime[len(downtime) // 2]:.0f}ms, max {downtime[-1]:.0f}ms.')
+        return [ctn for ctn in targets if outcomes[ctn.id][1] is not None]
+
+    def add_containers(self, count: int, outer_port: None | int = None, flag: None | str = None,
+                       exit_after_created: bool = False, jobs: int = DEFAULT_RUN_JOBS) -> list[PdtContainer]:
+        """
+        create containers with spawn_containers and give them ids.
+        :return: list of containers created
+        """
+        start_time = time.monotonic()
+        created = self.spawn_containers(count, outer_port, flag, exit_after_created, jobs)
+        elapsed = time.monotonic() - start_time
+        for new_container in created:
+            new_container.id = self.next_container_id()
+            self.__containers.add(new_container)
+            PrettyPrinter.info(f'Successfully created a container, id={new_container.id}, '
+                               f'container_id={new_container.container_id}, port={new_container.outer_port}')
+        if count > 1:
+            PrettyPrinter.info(f'{len(created)}/{count} containers of {self.__name} created in {elapsed:.2f}s '
+                               f'({len(created) / max(elapsed, 1e-6):.1f} containers/s).')
+        return created
+
+    def spawn_containers(self, count: int, outer_port: None | int = None, flag: None | str = None,
+                         exit_after_created: bool = False, jobs: int = DEFAULT_RUN_JOBS) -> list[PdtContainer]:
+        """
+        create containers concurrently, without giving them ids. Ports are reserved for the whole batch first (sequentially from outer_port
+        if it is specified) and flags are generated for the whole batch if flag is None, then the containers are
+        created by a bounded thread pool. A failed creation does not stop the rest of the batch, and successful
+        containers get their ids in the order their ports were reserved, not in the order they finished.
+        :return: list of containers created
+        """
+        if count <= 0:
+            return []
+        if outer_port is not None and not 10000 <= outer_port <= 65535:
+            PrettyPrinter.warning(f"Bad outer port specified: {outer_port}, 10000~65535 needed.")
+            outer_port = None
+        ports = port_allocator.allocate(count, outer_port)
+        if len(ports) < count:
+            return []
+        backends = port_allocator.allocate(count) if self.ondemand else [0] * count
+        if len(backends) < count:
+            port_allocator.release(ports)
+            return []
+        # cores are decided up front as well, so that a batch is spread evenly whatever order it is created in
+        cpusets = [core_allocator.allocate(self.limits.pin, self.limits.cpu_pool()) if self.limits.pin else None
+                   for _ in ports]
+        flags = [flag] * count if flag is not None else flag_generator(count)
+        results: list[PdtContainer | None] = [None] * count
+        with concurrent_futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, count)),
+                                                   thread_name_prefix='pdt-run', initializer=inherit_output()) as pool:
+            futures = {pool.submit(self.__create_container, 0, port, flags[i], exit_after_created, cpusets[i],
+                                   backends[i]): i
+                       for i, port in enumerate(ports)}
+            for future in concurrent_futures.as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except docker.errors.APIError as e:
+                    PrettyPrinter.error(f'Failed to create a container on port {ports[futures[future]]}: {e}')
+        return [c for c in results if c is not None]
+
+    def claim_pooled(self, count: int) -> list[PdtContainer]:
+        """
+        hand out up to count containers of the pool, they get ids like newly created containers.
+        """
+        claimed = self.pool.claim(count)
+        for container in claimed:
+            container.id = self.next_container_id()
+            self.__containers.add(container)
+            PrettyPrinter.info(f'Handed out a pooled container, id={container.id}, '
+                               f'container_id={container.container_id}, port={container.outer_port}')
+        return claimed
+
+    def discard(self, containers: list[PdtContainer]) -> None:
+        """
+        remove containers which have no ids, like the pooled ones, and release their ports and cores.
+        """
+        for container in containers:
             try:
-                new_container.container_object = self.__docker_client.containers.run(
-                    image=self.__name,
-                    ports={f'{self.port}/tcp': ('0.0.0.0', new_container.outer_port)},
-                    detach=True
-                )
-                break
-            except docker.errors.APIError:
-                PrettyPrinter.warning("Socket seized. Trying to get a new port...")
-                new_container.outer_port = get_free_port()
+                if container.container_object is not None:
+                    container.container_object.remove(force=True)
+            except docker.errors.NotFound:
+                pass
+            except docker.errors.APIError as e:
+                PrettyPrinter.error(f'Failed to remove container {container.container_id} of {self.__name}: {e}')
+                continue
+            self.__release_reservations(container)
+
+    @staticmethod
+    def __release_reservations(container: PdtContainer) -> None:
+        port_allocator.release([container.outer_port, container.backend_port])
+        if container.cpuset:
+            core_allocator.release([container.cpuset])
 
-        if exit_after_created:
-            new_container.container_object.stop()
-        PrettyPrinter.info(f'Successfully created a container, id={new_container.id},'
-                           f' container_id={new_container.container_id}')
-        self.__containers[new_container.id] = new_container
+    def drain_pool(self) -> None:
+        self.pool.target = 0
+        stale, self.pool.stale = self.pool.stale, []
+        self.discard(self.pool.shrink() + stale)
 
-    def delete_all_containers(self):
+    def delete_all_containers(self, kill: bool = False, jobs: int = DEFAULT_RUN_JOBS):
         if self.container_cnt == 0:
             return
-        for _, ctn in self.__containers.items():
-            if ctn.container_object.status in ('running', 'created'):
-                ctn.container_object.stop()
-            ctn.container_object.remove()
-        self.__containers.clear()
-        PrettyPrinter.info(f"All containers of {self.__name} deleted.")
-
-    def __delete_a_container(self, cid: int):
-        # This method do not include rearrangement of ids
-        ctn = next((c for c in self.__containers.values() if c.id == cid), None)
-        if ctn is None:
-            PrettyPrinter.error(f'container for id {cid} not found.')
-            return
-        if str(ctn.container_object.status) in ('running', 'created'):
-            ctn.container_object.stop()
-        ctn.container_object.remove()
-        del self.__containers[cid]
-        PrettyPrinter.info(f"Container {cid} of {self.__name} deleted.")
+        self.teardown(self.__containers.keys(), remove=True, kill=kill, jobs=jobs)
+        if self.container_cnt == 0:
+            PrettyPrinter.info(f"All containers of {self.__name} deleted.")
 
-    def delete_containers(self, cid: list):
+    def __teardown_one(self, ctn: PdtContainer, remove: bool, kill: bool) -> str:
+        start_time = time.monotonic()
+        try:
+            if remove and (kill or self.stop_timeout == 0):
+                ctn.container_object.remove(force=True)     # SIGKILL and remove in one call
+            elif remove:
+                ctn.container_object.stop(timeout=self.stop_timeout)
+                ctn.container_object.remove(force=True)
+            elif kill:
+                ctn.container_object.kill()
+            else:
+                ctn.container_object.stop(timeout=self.stop_timeout)
+            outcome = 'removed' if remove else ('killed' if kill else 'stopped')
+        except docker.errors.NotFound:
+            outcome = 'gone'
+        except docker.errors.APIError as e:
+            if not remove and 'is not running' in str(e):
+                outcome = 'not running'
+            else:
+                outcome = f'failed: {e.explanation if hasattr(e, "explanation") else e}'
+        return f'{outcome} ({time.monotonic() - start_time:.1f}s)'
+
+    def teardown(self, cids: list[int], remove: bool, kill: bool = False,
+                 jobs: int = DEFAULT_RUN_JOBS) -> dict[int, str]:
         """
-        delete __containers for selected ranges
-        :param cid: list of ids, each element is a range needed to be deleted, like [1, 5] means id 1-5.
-        :return: None
+        stop or remove containers concurrently. This method does not include rearrangement of ids.
+        :param cids: ids of containers
+        :param remove: remove the containers, otherwise only stop them
+        :param kill: send SIGKILL instead of waiting for stop_timeout
+        :return: outcome of every container
         """
+        outcomes: dict[int, str] = {}
+        targets = []
+        for cid in cids:
+            ctn = self.__containers.get(cid)
+            if ctn is None:
+                PrettyPrinter.error(f'container for id {cid} not found.')
+                continue
+            targets.append(ctn)
+        if len(targets) == 0:
+            return outcomes
+        start_time = time.monotonic()
+        with concurrent_futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(targets))),
+                                                   thread_name_prefix='pdt-rm', initializer=inherit_output()) as pool:
+            futures = {pool.submit(self.__teardown_one, ctn, remove, kill): ctn for ctn in targets}
+            for future in concurrent_futures.as_completed(futures):
+                outcomes[futures[future].id] = future.result()
+        elapsed = time.monotonic() - start_time
+        if remove:
+            gone = [ctn for ctn in targets if not outcomes[ctn.id].startswith('failed')]
+            port_allocator.release([p for ctn in gone for p in (ctn.outer_port, ctn.backend_port)])
+            core_allocator.release([ctn.cpuset for ctn in gone if ctn.cpuset])
+            for ctn in gone:
+                self.__containers.remove(ctn.id)
+        if len(targets) == 1:
+            PrettyPrinter.info(f"Container {targets[0].id} of {self.__name}: {outcomes[targets[0].id]}")
+        else:
+            print(PrettyPrinter.table([[ctn.id, ctn.container_id, outcomes[ctn.id]] for ctn in targets],
+                                      ['id', 'container id', 'outcome']))
+            PrettyPrinter.info(f'{len(targets)} containers of {self.__name} '
+                               f'{"removed" if remove else "stopped"} in {elapsed:.1f}s.')
+        return outcomes
+
+    def __collect_ids(self, cid: list) -> list[int] | None:
+        ret = []
         for item in cid:
             start = item[0]
             end = item[1]
             if not self.check_cid_range(start, end):
-                return
-            for i in range(start, end + 1):
-                self.__delete_a_container(i)
-        self.__rearrange_id()
+                return None
+            ids = self.__containers.range(start, end)
+            if len(ids) == 0:
+                PrettyPrinter.error(f'no container of {self.__name} found in {start}-{end}.')
+            ret += ids
+        return ret
 
-    def __stop_a_container(self, cid: int) -> None:
-        ctn = next((c for c in self.__containers.values() if c.id == cid), None)
-        if ctn is None:
-            PrettyPrinter.error(f'container for id {cid} not found.')
+    def containers_in_range(self, start: int, end: int) -> list[int]:
+        return self.__containers.range(start, end)
+
+    def delete_containers(self, cid: list, kill: bool = False, jobs: int = DEFAULT_RUN_JOBS):
+        """
+        delete __containers for selected ranges
+        :param cid: list of ids, each element is a range needed to be deleted, like [1, 5] means id 1-5.
+        :param kill: kill the containers instead of stopping them gracefully
+        :param jobs: count of containers deleted concurrently
+        :return: None
+        """
+        ids = self.__collect_ids(cid)
+        if ids is None:
             return
-        if ctn.container_object.status in ('created', 'running'):
-            ctn.container_object.stop()
-            PrettyPrinter.info(f"Container {cid} of {self.__name} stopped.")
+        self.teardown(ids, remove=True, kill=kill, jobs=jobs)
+        self.__rearrange_id()
 
-    def stop_containers(self, cid: list) -> None:
-        for item in cid:
-            start = item[0]
-            end = item[1]
-            if not self.check_cid_range(start, end):
-                return
-            for i in range(start, end + 1):
-                self.__stop_a_container(i)
+    def stop_containers(self, cid: list, kill: bool = False, jobs: int = DEFAULT_RUN_JOBS) -> None:
+        ids = self.__collect_ids(cid)
+        if ids is None:
+            return
+        self.teardown(ids, remove=False, kill=kill, jobs=jobs)
 
     def __rearrange_id(self) -> None:
-        sorted_keys = sorted(self.__containers.keys())
-        new_dict = {}
-        for index, key in enumerate(sorted_keys, start=1):
-            new_dict[index] = self.__containers[key]
-            new_dict[index].id = index
-        self.__containers = new_dict
+        if not self.stable_ids:
+            self.__containers.compact()
 
     @staticmethod
     def check_cid_range(start, end):
@@ -357,14 +838,58 @@ class PdtImage:
         PrettyPrinter.info(f"Successfully deleted image {self.__name}")
 
 
+def flag_archive(flag: str) -> bytes:
+    """
+    tar archive of the flag files of a container, to be extracted at / with put_archive. The files are owned by root
+    and readable by the group of USER, so the challenge can read the flag but cannot change it.
+    """
+    data = (flag + '\n').encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tf:
+        for path in ('flag', f'{BASEDIR_IN_DOCKER.lstrip("/")}/flag'):
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mode = 0o740
+            info.uid, info.gid = 0, USER_ID
+            info.uname, info.gname = 'root', USER
+            info.mtime = int(time.time())
+            tf.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
 class PdtDeploy:
     def __init__(self):
         self.basedir = ''
         self.files: set = set([])
         self.entry = ''
 
+    def manifest(self) -> list[tuple[str, str]]:
+        """
+        list all the files to be deployed, directories are walked recursively.
+        :return: sorted list of (name in archive, local path)
+        """
+        ret = []
+        for file in self.files:
+            path = f'{self.basedir}/{file}'
+            if os.path.isdir(path):
+                for parent, _, filenames in os.walk(path):
+                    for f in filenames:
+                        ret.append((f'{parent}/{f}'[len(self.basedir) + 1:], f'{parent}/{f}'))
+            elif os.path.exists(path):
+                ret.append((file, path))
+            else:
+                PrettyPrinter.error(f'File not found: {path}')
+        return sorted(ret)
+
     def hash(self):
-        return hashlib.sha256((str(self.basedir) + ";" + str(self.files) + ';' + self.entry).encode()).hexdigest()
+        """
+        content address of the deploy archive, derived from the digests of all deployed files, so the archive
+        only changes when the content (or name) of a file changes.
+        """
+        h = hashlib.sha256(self.entry.encode())
+        for arcname, path in self.manifest():
+            h.update(f';{arcname}:{deploy_index.digest(path)}'.encode())
+        return h.hexdigest()
 
     @property
     def basedir(self):
@@ -381,19 +906,299 @@ class PdtDeploy:
             PrettyPrinter.error('Failed to set base directory: directory not found.')
 
 
+class ResourceProfile:
+    """
+    Limits of an image: xinetd limits of every session, written into pwn.xinetd at build time, and cgroup limits of
+    every container, applied when containers are created. Values are kept as strings the way they are set.
+    """
+    XINETD_DEFAULTS = {'per_source': '10', 'rlimit_cpu': '20', 'rlimit_as': '100M'}
+    XINETD_KEYS = ('instances', 'per_source', 'rlimit_cpu', 'rlimit_as', 'rlimit_data', 'rlimit_rss',
+                   'rlimit_stack', 'rlimit_files')
+    DOCKER_KEYS = ('cpus', 'mem_limit', 'pids_limit', 'cpuset_cpus', 'pin')
+
+    def __init__(self):
+        self.xinetd: dict[str, str] = dict(self.XINETD_DEFAULTS)
+        self.docker: dict[str, str] = {}
+
+    @classmethod
+    def keys(cls) -> tuple:
+        return cls.XINETD_KEYS + cls.DOCKER_KEYS
+
+    @staticmethod
+    def check(key: str, value: str) -> str | None:
+        """
+        :return: error message, None if the value is valid for the key
+        """
+        unlimited = value.upper() == 'UNLIMITED'
+        if key in ('instances', 'per_source', 'rlimit_cpu', 'rlimit_files'):
+            ok = unlimited or value.isdigit()
+        elif key.startswith('rlimit_'):
+            ok = unlimited or re.match(r'^\d+[KM]?$', value) is not None
+        elif key == 'cpus':
+            ok = re.match(r'^\d+(\.\d+)?$', value) is not None and 0 < float(value) <= len(host_cores())
+        elif key == 'mem_limit':
+            ok = re.match(r'^\d+[bkmg]?$', value, re.IGNORECASE) is not None
+        elif key in ('pids_limit', 'pin'):
+            ok = value.isdigit()
+        elif key == 'cpuset_cpus':
+            cores = parse_cpuset(value)
+            ok = cores is not None and len(cores) != 0 and set(cores) <= set(host_cores())
+        else:
+            return f'unknown limit {key}, one of {", ".join(ResourceProfile.keys())} expected.'
+        return None if ok else f'bad value for {key}: {value}'
+
+    def set(self, key: str, value: str | None) -> None:
+        """
+        :param value: None resets the key to its default
+        """
+        target = self.xinetd if key in self.XINETD_KEYS else self.docker
+        if value is not None:
+            target[key] = value.upper() if value.upper() == 'UNLIMITED' else value
+        elif key in self.XINETD_DEFAULTS:
+            target[key] = self.XINETD_DEFAULTS[key]
+        else:
+            target.pop(key, None)
+
+    def xinetd_lines(self) -> str:
+        return '\n'.join(f'    {k:<12}= {self.xinetd[k]}' for k in self.XINETD_KEYS if k in self.xinetd)
+
+    @property
+    def pin(self) -> int:
+        return int(self.docker.get('pin', 0))
+
+    def run_kwargs(self) -> dict:
+        """
+        keyword arguments of containers.run. With pin, cpuset_cpus is only the pool cores are picked from and it is
+        decided for every container, otherwise it applies to every container as it is.
+        """
+        ret = {}
+        if 'cpuset_cpus' in self.docker and not self.pin:
+            ret['cpuset_cpus'] = self.docker['cpuset_cpus']
+        if 'cpus' in self.docker:
+            ret['nano_cpus'] = int(float(self.docker['cpus']) * 10 ** 9)
+        if 'mem_limit' in self.docker:
+            ret['mem_limit'] = self.docker['mem_limit']
+        if 'pids_limit' in self.docker:
+            ret['pids_limit'] = int(self.docker['pids_limit'])
+        return ret
+
+    def cpu_pool(self) -> list[int]:
+        if 'cpuset_cpus' in self.docker:
+            return parse_cpuset(self.docker['cpuset_cpus']) or host_cores()
+        return host_cores()
+
+    def to_dict(self) -> dict:
+        return {'xinetd': dict(self.xinetd), 'docker': dict(self.docker)}
+
+    def load(self, info: dict | None) -> None:
+        if info is not None:
+            self.xinetd = {k: str(v) for k, v in info.get('xinetd', self.XINETD_DEFAULTS).items()}
+            self.docker = {k: str(v) for k, v in info.get('docker', {}).items()}
+
+
+class CoreAllocator:
+    """
+    Spreads pinned containers evenly over host cores: every container gets the cores with the fewest containers
+    pinned to them so far, within the pool allowed by its image.
+    """
+
+    def __init__(self):
+        self.__load: dict[int, int] = {}
+        self.__lock = threading.Lock()
+
+    def allocate(self, count: int, pool: list[int]) -> str:
+        with self.__lock:
+            cores = sorted(pool, key=lambda c: (self.__load.get(c, 0), c))[:count]
+            for c in cores:
+                self.__load[c] = self.__load.get(c, 0) + 1
+        return ','.join(map(str, sorted(cores)))
+
+    def claim(self, cpusets: list[str]) -> None:
+        with self.__lock:
+            for cpuset in cpusets:
+                for c in parse_cpuset(cpuset) or []:
+                    self.__load[c] = self.__load.get(c, 0) + 1
+
+    def release(self, cpusets: list[str]) -> None:
+        with self.__lock:
+            for cpuset in cpusets:
+                for c in parse_cpuset(cpuset) or []:
+                    if self.__load.get(c, 0) > 0:
+                        self.__load[c] -= 1
+
+    def load(self) -> dict[int, int]:
+        with self.__lock:
+            return dict(self.__load)
+
+
+def host_cores() -> list[int]:
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+
+def parse_cpuset(value: str) -> list[int] | None:
+    """
+    parse a cpuset like '0-3,6'.
+    :return: sorted list of cores, None if the format is wrong
+    """
+    cores = set()
+    for part in value.split(','):
+        if match := re.match(r'^(\d+)-(\d+)$', part):
+            cores |= set(range(int(match.group(1)), int(match.group(2)) + 1))
+        elif part.isdigit():
+            cores.add(int(part))
+        else:
+            return None
+    return sorted(cores)
+
+
+core_allocator = CoreAllocator()
+
+
+class FileDigestIndex:
+    """
+    Persistent index of (path, size, mtime, inode) -> sha256, so files that did not change are not hashed again.
+    """
+
+    def __init__(self, path: str):
+        self.__path: str = path
+        self.__entries: dict[str, list] | None = None
+        self.__dirty: bool = False
+        self.__lock = threading.Lock()
+
+    def __load(self) -> None:
+        self.__entries = {}
+        if os.path.exists(self.__path):
+            try:
+                with open(self.__path, 'r') as f:
+                    self.__entries = json.load(f)
+            except (OSError, ValueError):
+                PrettyPrinter.warning(f'Broken digest index {self.__path}, rebuilding it.')
+
+    def digest(self, path: str) -> str:
+        st = os.stat(path)
+        stat_key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        with self.__lock:
+            if self.__entries is None:
+                self.__load()
+            entry = self.__entries.get(path)
+            if entry is not None and entry[:3] == stat_key:
+                return entry[3]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        digest = h.hexdigest()
+        # a file modified within the mtime granularity may change again without changing its stat,
+        # so it is only remembered once it is old enough
+        if time.time_ns() - st.st_mtime_ns > 2 * 10 ** 9:
+            with self.__lock:
+                self.__entries[path] = stat_key + [digest]
+                self.__dirty = True
+        return digest
+
+    def save(self) -> None:
+        with self.__lock:
+            if not self.__dirty:
+                return
+            with open(self.__path + '.tmp', 'w') as f:
+                json.dump(self.__entries, f)
+            os.replace(self.__path + '.tmp', self.__path)
+            self.__dirty = False
+
+
+deploy_index = FileDigestIndex(f'{ZIP_DIR}/index.json')
+
+
+class LazyDockerClient:
+    """
+    Stand-in of DockerClient which connects to the daemon when it is used for the first time, so commands that
+    only touch the config never import the docker SDK or talk to the daemon.
+    """
+
+    def __init__(self, on_connect=None, connect=None):
+        """
+        :param on_connect: called with the client right after connecting, used for reconciling state
+        :param connect: function returning a DockerClient, docker.from_env by default
+        """
+        self.__client = None
+        self.__on_connect = on_connect
+        self.__connect = connect
+        self.__lock = threading.RLock()
+
+    @property
+    def connected(self) -> bool:
+        return self.__client is not None
+
+    @property
+    def client(self) -> DockerClient:
+        if self.__client is None:
+            with self.__lock:
+                if self.__client is None:
+                    self.__client = self.__connect() if self.__connect is not None else docker.from_env()
+                    if self.__on_connect is not None:
+                        self.__on_connect(self.__client)
+        return self.__client
+
+    def __getattr__(self, item):
+        return getattr(self.client, item)
+
+
+def container_labels(container_object: Container) -> dict[str, str]:
+    # containers listed with sparse=True keep their labels at the top level of attrs
+    if 'Labels' in container_object.attrs:
+        return container_object.attrs['Labels'] or {}
+    return container_object.attrs.get('Config', {}).get('Labels') or {}
+
+
 class PdtContainer:
     def __init__(self, image: PdtImage):
         self.image: PdtImage = image
         self.flag: str = ''
         self.outer_port: int = 0  # used for mapping container's port into host
+        self.backend_port: int = 0  # loopback port of an on-demand container, the activator holds outer_port
         self.id: int = 0
         self.container_object: Container | None = None
+        self.recorded_id: str | None = None     # container id recorded in config, before connecting to docker
+        self.cpuset: str | None = None      # host cores the container is pinned to
+        self.lease: Lease | None = None     # requester the broker handed the container to
 
     @property
     def container_id(self):
         if self.container_object is not None:
             return self.container_object.short_id
-        return None
+        return self.recorded_id
+
+    @property
+    def labels(self) -> dict[str, str]:
+        """
+        labels attached to the docker container, so its state can be reconciled without inspecting it.
+        The flag itself is not exposed, only a digest of it. The id is not a label, pooled containers get theirs
+        when they are claimed and ids change when containers are compacted.
+        """
+        return {
+            LABEL_MANAGED: 'true',
+            LABEL_IMAGE: self.image.name,
+            LABEL_FLAG: flag_id(self.flag),
+            LABEL_PORT: str(self.outer_port)
+        }
+
+    def check_labels(self) -> list[str]:
+        """
+        compare labels of the docker container with the state recorded by PDT.
+        :return: list of differences found
+        """
+        labels = container_labels(self.container_object)
+        if LABEL_MANAGED not in labels:
+            # docker cannot label existing containers, reset replaces it with a labelled one
+            return ['created without labels by an older PDT, use \'reset\' to label it']
+        ret = []
+        if labels.get(LABEL_IMAGE) != self.image.name:
+            ret.append(f'labelled for image {labels.get(LABEL_IMAGE)}')
+        if labels.get(LABEL_PORT) != str(self.outer_port):
+            ret.append(f'labelled with port {labels.get(LABEL_PORT)}, {self.outer_port} recorded')
+        if labels.get(LABEL_FLAG) != flag_id(self.flag):
+            ret.append('flag differs from the one it was created with')
+        return ret
 
     @property
     def status(self):
@@ -0,0 +1,171 @@
+from __future__ import annotations
+import time
+import threading
+import collections
+from typing import TYPE_CHECKING
+from util import *
+from pdt_trace import tracer
+
+pdt_health = LazyModule('pdt_health')     # asyncio is only needed once a pool is refilled
+
+if TYPE_CHECKING:
+    from pdt_object import PdtImage, PdtContainer
+
+POOL_READY_TIMEOUT = 60.0   # seconds a new pooled container may take to accept connections
+POOL_LATENCY_SAMPLES = 1000
+
+
+class WarmPool:
+    """
+    Containers of an image which are created, started and ready, but not handed out yet. They have ports and flags
+    but no ids, 'run -n' claims them and gives them ids, so a team gets an instance without waiting for docker.
+    """
+
+    def __init__(self):
+        self.target: int = 0
+        self.__ready: list[PdtContainer] = []
+        self.stale: list[PdtContainer] = []     # recorded containers found stopped, removed by the next refill
+        self.filling: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.latency: collections.deque = collections.deque(maxlen=POOL_LATENCY_SAMPLES)    # handout ms
+        self.lock = threading.Lock()
+
+    @property
+    def containers(self) -> list[PdtContainer]:
+        with self.lock:
+            return list(self.__ready)
+
+    def __len__(self) -> int:
+        return len(self.__ready)
+
+    def claim(self, count: int) -> list[PdtContainer]:
+        with self.lock:
+            taken, self.__ready = self.__ready[:count], self.__ready[count:]
+            return taken
+
+    def add(self, containers: list[PdtContainer]) -> list[PdtContainer]:
+        """
+        :return: containers beyond the target, which the caller removes
+        """
+        with self.lock:
+            room = max(0, self.target - len(self.__ready))
+            self.__ready += containers[:room]
+            return containers[room:]
+
+    def shrink(self) -> list[PdtContainer]:
+        """
+        :return: containers beyond the target, taken out of the pool
+        """
+        with self.lock:
+            surplus, self.__ready = self.__ready[self.target:], self.__ready[:self.target]
+            return surplus
+
+    def record(self, hits: int, misses: int, latency: list[float]) -> None:
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.latency.extend(latency)
+
+    def row(self) -> list:
+        with self.lock:
+            latency = sorted(self.latency)
+            total = self.hits + self.misses
+            return [self.target, len(self.__ready), self.filling, self.hits, self.misses,
+                    f'{self.hits / total:.0%}' if total else '-',
+                    f'{latency[len(latency) // 2]:.1f}' if latency else '-',
+                    f'{latency[min(len(latency) - 1, int(len(latency) * 0.99))]:.1f}' if latency else '-']
+
+    HEADERS = ['target', 'ready', 'filling', 'hits', 'misses', 'hit rate', 'handout p50 ms', 'handout p99 ms']
+
+    def to_list(self) -> list[dict]:
+        return [{'flag': c.flag, 'mapping port': c.outer_port, 'container id': c.container_id, 'cpuset': c.cpuset}
+                for c in self.containers]
+
+    def load(self, containers: list[PdtContainer]) -> None:
+        with self.lock:
+            self.__ready = list(containers)
+
+
+def refill(image: PdtImage, wait_ready: bool = True) -> int:
+    """
+    create containers until the pool of the image reaches its target, only the ones accepting connections within
+    POOL_READY_TIMEOUT join the pool. Stale and surplus containers are removed.
+    :param wait_ready: False adds the started containers at once, for commands which must not block on the probes
+    :return: count of containers added to the pool
+    """
+    pool = image.pool
+    with pool.lock:
+        count = max(0, pool.target - len(pool) - pool.filling)
+        pool.filling += count
+        stale, pool.stale = pool.stale, []
+    try:
+        image.discard(stale + pool.shrink())
+        if count == 0:
+            return 0
+        with tracer.span('pool refill', image=image.name, count=count):
+            created = image.spawn_containers(count)
+            if wait_ready:
+                results = pdt_health.gate([(i, c.outer_port) for i, c in enumerate(created)], POOL_READY_TIMEOUT)
+        ready = [c for i, c in enumerate(created) if not wait_ready or results[i].ok]
+        if len(ready) != len(created):
+            PrettyPrinter.warning(f'{len(created) - len(ready)} pooled container(s) of {image.name} not ready '
+                                  f'after {POOL_READY_TIMEOUT:.0f}s, removed.')
+        image.discard([c for c in created if c not in ready] + pool.add(ready))
+        return len(ready)
+    finally:
+        with pool.lock:
+            pool.filling -= count
+
+
+class PoolRefiller:
+    """
+    Background thread refilling pools after containers are claimed, so the next claim is served from the pool as
+    well. Images are refilled one by one, in the order they were requested.
+    """
+
+    def __init__(self, on_change=None):
+        """
+        :param on_change: called with an image after its pool changed, from the refill thread
+        """
+        self.on_change = on_change
+        self.__pending: list[PdtImage] = []
+        self.__cond = threading.Condition()
+        self.__thread: threading.Thread | None = None
+        self.__stopped: bool = False
+
+    def request(self, image: PdtImage) -> None:
+        with self.__cond:
+            if image not in self.__pending:
+                self.__pending.append(image)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='pdt-pool', daemon=True)
+                self.__thread.start()
+            self.__cond.notify()
+
+    def cancel(self, image: PdtImage) -> None:
+        with self.__cond:
+            if image in self.__pending:
+                self.__pending.remove(image)
+
+    def __run(self) -> None:
+        while True:
+            with self.__cond:
+                while not self.__pending and not self.__stopped:
+                    self.__cond.wait()
+                if self.__stopped:
+                    return
+                image = self.__pending.pop(0)
+            try:
+                refill(image)
+            except Exception as e:
+                PrettyPrinter.error(f'Failed to refill the pool of {image.name}: {type(e).__name__}: {e}')
+            if self.on_change is not None:
+                self.on_change(image)
+
+    def stop(self) -> None:
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+        if self.__thread is not None:
+            self.__thread.join(timeout=POOL_READY_TIMEOUT)
@@ -0,0 +1,157 @@
+import threading
+from util import *
+
+
+class PortAllocator:
+    """
+    Allocates host ports for containers without binding sockets. Ports in use are kept in a bitmap over the
+    configured range, seeded once from /proc/net/tcp{,6} and from the ports PDT reserved before. PDT's own
+    reservations are persisted, so ports handed out to containers which are stopped (and therefore not
+    listening) are never handed out again, and rebuilt from the config whenever PDT connects to docker. A next-fit cursor makes allocation amortized O(1).
+    """
+
+    def __init__(self, path: str = PORT_TABLE):
+        self.__path: str = path
+        self.__lock = threading.Lock()
+        self.__seeded: bool = False
+        self.start: int = PORT_RANGE_START
+        self.end: int = PORT_RANGE_END
+        self.__used: bytearray = bytearray()
+        self.__reserved: set[int] = set()
+        self.__cursor: int = 0
+        self.__free: int = 0
+
+    def __load(self) -> None:
+        if os.path.exists(self.__path):
+            data = load_yaml(self.__path) or {}
+            self.start, self.end = data.get('range', [self.start, self.end])
+            self.__reserved = set(data.get('reserved', []))
+        if env_range := os.environ.get('PDT_PORT_RANGE'):
+            start, end = env_range.split('-')
+            self.start, self.end = int(start), int(end)
+        if not 1024 <= self.start <= self.end <= 65535:
+            PrettyPrinter.warning(f'Illegal port range {self.start}-{self.end}, '
+                                  f'{PORT_RANGE_START}-{PORT_RANGE_END} used.')
+            self.start, self.end = PORT_RANGE_START, PORT_RANGE_END
+
+    def __seed(self) -> None:
+        if self.__seeded:
+            return
+        self.__load()
+        self.__used = bytearray(self.end - self.start + 1)
+        for port in self.__reserved | host_tcp_ports():
+            if self.start <= port <= self.end:
+                self.__used[port - self.start] = 1
+        self.__free = self.__used.count(0)
+        self.__seeded = True
+
+    def __take(self, port: int, reserve: bool = True) -> bool:
+        if not self.start <= port <= self.end or self.__used[port - self.start]:
+            return False
+        self.__used[port - self.start] = 1
+        self.__free -= 1
+        if reserve:
+            self.__reserved.add(port)
+        return True
+
+    def __next_free(self) -> int:
+        size = len(self.__used)
+        for _ in range(size):
+            offset = self.__cursor
+            self.__cursor = (self.__cursor + 1) % size
+            if not self.__used[offset]:
+                return self.start + offset
+        raise RuntimeError('port range exhausted')
+
+    def allocate(self, count: int, start: int | None = None) -> list[int]:
+        """
+        reserve a block of ports.
+        :param count: count of ports needed
+        :param start: if specified, ports start+0, start+1, ... are preferred, occupied ones are replaced
+        :return: list of ports reserved
+        """
+        with self.__lock:
+            self.__seed()
+            if count > self.__free:
+                PrettyPrinter.error(f'Only {self.__free} free ports left in {self.start}-{self.end}.')
+                return []
+            ports = []
+            for i in range(count):
+                if start is not None:
+                    if self.__take(start + i):
+                        ports.append(start + i)
+                        continue
+                    PrettyPrinter.warning(f'Specified port {start + i} was occupied or out of range.')
+                port = self.__next_free()
+                self.__take(port)
+                ports.append(port)
+            self.__save()
+        return ports
+
+    def sync(self, ports: list[int]) -> None:
+        """
+        make the reservations the ports used by PDT, like the ports of containers recorded in config. Reservations
+        no container owns, left by a crash between allocating ports and recording them in config, are dropped.
+        """
+        with self.__lock:
+            self.__seed()
+            owned = {port for port in ports if port}
+            leaked = self.__reserved - owned
+            if len(leaked) != 0:
+                host = host_tcp_ports()
+                for port in leaked:
+                    self.__reserved.remove(port)
+                    if self.start <= port <= self.end and port not in host:
+                        self.__used[port - self.start] = 0
+                        self.__free += 1
+                PrettyPrinter.info(f'Released {len(leaked)} reserved port(s) no container owns.')
+            claimed = owned - self.__reserved
+            for port in claimed:
+                self.__take(port)
+                self.__reserved.add(port)
+            if len(leaked) != 0 or len(claimed) != 0:
+                self.__save()
+
+    def mark_used(self, port: int) -> None:
+        """
+        mark a port as used by something else, for ports found occupied when docker tried to publish them.
+        """
+        with self.__lock:
+            self.__seed()
+            self.__reserved.discard(port)
+            self.__take(port, reserve=False)
+            self.__save()
+
+    def release(self, ports: list[int]) -> None:
+        with self.__lock:
+            self.__seed()
+            for port in ports:
+                if port in self.__reserved:
+                    self.__reserved.remove(port)
+                    if self.start <= port <= self.end:
+                        self.__used[port - self.start] = 0
+                        self.__free += 1
+            self.__save()
+
+    def __save(self) -> None:
+        dump_yaml(self.__path, {'range': [self.start, self.end], 'reserved': sorted(self.__reserved)})
+
+
+def host_tcp_ports() -> set[int]:
+    """
+    local ports of all TCP sockets on the host, read from /proc/net/tcp and /proc/net/tcp6 in one pass.
+    """
+    ports = set()
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(table, 'r') as f:
+                next(f)     # header
+                for line in f:
+                    local_address = line.split(None, 2)[1]
+                    ports.add(int(local_address.rsplit(':', 1)[1], 16))
+        except (OSError, StopIteration):
+            continue
+    return ports
+
+
+port_allocator = PortAllocator()
@@ -0,0 +1,226 @@
+import time
+import asyncio
+import threading
+from util import *
+import pdt_health
+
+PROXY_HOST = '0.0.0.0'
+PROXY_BUFFER = 64 * 1024
+PROXY_CONNECT_TIMEOUT = 3.0
+PROXY_HEALTH_INTERVAL = float(os.environ.get('PDT_PROXY_HEALTH_INTERVAL', 5.0))    # seconds between health probes
+
+
+class LoopThread:
+    """
+    An event loop running on its own daemon thread, started when it is used for the first time.
+    """
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    def call(self, coroutine):
+        """
+        run a coroutine in the loop and wait for its result.
+        """
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def call_soon(self, function, *args) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def stop(self) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+async def relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                up_reader: asyncio.StreamReader, up_writer: asyncio.StreamWriter) -> None:
+    """
+    copy data both ways between a player and a challenge. When the player closes its side the challenge side is
+    half-closed, since the challenge may still be writing, and the session ends when the challenge exits.
+    """
+    async def splice(src: asyncio.StreamReader, dst: asyncio.StreamWriter, half_close: bool) -> None:
+        try:
+            while chunk := await src.read(PROXY_BUFFER):
+                dst.write(chunk)
+                await dst.drain()
+            if half_close and dst.can_write_eof():
+                dst.write_eof()
+        except OSError:
+            pass
+    upstream = asyncio.create_task(splice(reader, up_writer, True))
+    try:
+        await splice(up_reader, writer, False)
+    finally:
+        upstream.cancel()
+        for w in (writer, up_writer):
+            w.close()
+            try:
+                await w.wait_closed()
+            except OSError:
+                pass
+
+
+class Replica:
+    def __init__(self, key, port: int):
+        self.key = key      # container id
+        self.port: int = port
+        self.healthy: bool = True   # until a probe or a connection fails
+        self.active: int = 0
+        self.total: int = 0
+        self.failures: int = 0
+        self.state: str = 'new'     # state of the last probe
+
+
+class ImageProxy:
+    """
+    Listens on the public port of an image and relays every connection to the running replica (container) with the
+    fewest active connections. Replicas failing a health probe or refusing a connection are skipped until a later
+    probe finds them ready again.
+    """
+
+    def __init__(self, name: str, port: int, host: str = PROXY_HOST):
+        self.name: str = name
+        self.port: int = port
+        self.host: str = host
+        self.replicas: dict = {}    # container id -> Replica
+        self.started: float = 0.0
+        self.__server: asyncio.AbstractServer | None = None
+        self.__health: asyncio.Task | None = None
+
+    def update(self, targets: list[tuple]) -> None:
+        """
+        :param targets: (container id, outer port) of the replicas, counters of known replicas are kept
+        """
+        replicas = {}
+        for key, port in targets:
+            replica = self.replicas.get(key)
+            if replica is None or replica.port != port:
+                replica = Replica(key, port)
+            replicas[key] = replica
+        self.replicas = replicas
+
+    def pick(self, exclude: set) -> Replica | None:
+        candidates = [r for r in self.replicas.values() if r.healthy and r.key not in exclude]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda r: (r.active, r.total))
+
+    async def start(self) -> None:
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port, reuse_address=True)
+        self.__health = asyncio.create_task(self.__health_loop())
+        self.started = time.time()
+
+    async def stop(self) -> None:
+        if self.__health is not None:
+            self.__health.cancel()
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+
+    async def __health_loop(self) -> None:
+        while True:
+            targets = [(r.key, r.port) for r in self.replicas.values()]
+            if len(targets) != 0:
+                for result in await pdt_health.probe_all(targets):
+                    replica = self.replicas.get(result.key)
+                    if replica is not None and replica.port == result.port:
+                        replica.healthy = result.ok
+                        replica.state = result.state
+            await asyncio.sleep(PROXY_HEALTH_INTERVAL)
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        tried = set()
+        while (replica := self.pick(tried)) is not None:
+            tried.add(replica.key)
+            try:
+                up_reader, up_writer = await asyncio.wait_for(
+                    asyncio.open_connection(pdt_health.PROBE_HOST, replica.port), PROXY_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                replica.failures += 1
+                replica.healthy = False
+                replica.state = 'refused'
+                continue
+            replica.active += 1
+            replica.total += 1
+            try:
+                await relay(reader, writer, up_reader, up_writer)
+            finally:
+                replica.active -= 1
+            return
+        writer.close()      # no replica available
+
+    def rows(self) -> list[list]:
+        return [[self.name, self.port, key, r.port, 'healthy' if r.healthy else f'dropped ({r.state})',
+                 r.active, r.total, r.failures] for key, r in sorted(self.replicas.items())]
+
+
+class ProxyManager:
+    """
+    Runs the proxies of all images in one event loop on a background thread, so they keep serving while PDT
+    executes commands.
+    """
+    HEADERS = ['image', 'public port', 'container', 'port', 'state', 'active', 'total', 'failures']
+
+    def __init__(self):
+        self.__thread: LoopThread = LoopThread('pdt-proxy')
+        self.__proxies: dict[str, ImageProxy] = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def names(self) -> list[str]:
+        with self.__lock:
+            return list(self.__proxies.keys())
+
+    def start(self, name: str, port: int, targets: list[tuple]) -> str | None:
+        """
+        :return: error message, None if the proxy is listening
+        """
+        with self.__lock:
+            if name in self.__proxies:
+                return f'proxy of {name} is already running on port {self.__proxies[name].port}.'
+        proxy = ImageProxy(name, port)
+        proxy.update(targets)
+        try:
+            self.__thread.call(proxy.start())
+        except OSError as e:
+            return f'failed to listen on port {port}: {e}'
+        with self.__lock:
+            self.__proxies[name] = proxy
+        return None
+
+    def stop(self, name: str) -> bool:
+        with self.__lock:
+            proxy = self.__proxies.pop(name, None)
+        if proxy is None:
+            return False
+        self.__thread.call(proxy.stop())
+        return True
+
+    def update(self, name: str, targets: list[tuple]) -> None:
+        with self.__lock:
+            proxy = self.__proxies.get(name)
+        if proxy is not None:
+            self.__thread.call_soon(proxy.update, targets)
+
+    def rows(self) -> list[list]:
+        with self.__lock:
+            proxies = list(self.__proxies.values())
+        if len(proxies) == 0:
+            return []
+        return self.__thread.call(self.__rows(proxies))
+
+    @staticmethod
+    async def __rows(proxies: list[ImageProxy]) -> list[list]:
+        # read the counters in the loop thread, where they change
+        return [row for proxy in proxies for row in proxy.rows() or [[proxy.name, proxy.port, '-', '-',
+                                                                      'no replica', 0, 0, 0]]]
+
+    def close(self) -> None:
+        for name in self.names:
+            self.stop(name)
+        self.__thread.stop()
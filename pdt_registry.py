@@ -0,0 +1,235 @@
+import time
+import bisect
+import threading
+from util import *
+
+
+class ContainerRegistry:
+    """
+    Containers of one image indexed by local id. Local ids are also kept sorted, so range lookups like
+    'pwn.100-200' cost O(log n + k) however many containers there are.
+    It can be used like the dict[int, PdtContainer] it replaces.
+    """
+
+    def __init__(self):
+        self.__by_id: dict = {}
+        self.__ids: list[int] = []      # sorted local ids
+
+    def add(self, container) -> None:
+        if container.id in self.__by_id:
+            raise KeyError(f'container id {container.id} exists')
+        self.__by_id[container.id] = container
+        bisect.insort(self.__ids, container.id)
+
+    def remove(self, cid: int):
+        container = self.__by_id.pop(cid)
+        del self.__ids[bisect.bisect_left(self.__ids, cid)]
+        return container
+
+    def get(self, cid: int, default=None):
+        return self.__by_id.get(cid, default)
+
+    def range(self, start: int, end: int) -> list[int]:
+        """
+        :return: ids of existing containers in [start, end]
+        """
+        return self.__ids[bisect.bisect_left(self.__ids, start):bisect.bisect_right(self.__ids, end)]
+
+    def next_id(self) -> int:
+        return self.__ids[-1] + 1 if self.__ids else 1
+
+    def compact(self) -> None:
+        """
+        renumber the containers as 1, 2, 3... in the order of their ids.
+        """
+        containers = [self.__by_id[i] for i in self.__ids]
+        self.__by_id = {}
+        for index, container in enumerate(containers, start=1):
+            container.id = index
+            self.__by_id[index] = container
+        self.__ids = list(range(1, len(containers) + 1))
+
+    def clear(self) -> None:
+        self.__by_id.clear()
+        self.__ids.clear()
+
+    def keys(self) -> list[int]:
+        return list(self.__ids)
+
+    def values(self) -> list:
+        return [self.__by_id[i] for i in self.__ids]
+
+    def items(self) -> list[tuple]:
+        return [(i, self.__by_id[i]) for i in self.__ids]
+
+    def __getitem__(self, cid: int):
+        return self.__by_id[cid]
+
+    def __delitem__(self, cid: int) -> None:
+        self.remove(cid)
+
+    def __contains__(self, cid: int) -> bool:
+        return cid in self.__by_id
+
+    def __iter__(self):
+        return iter(list(self.__ids))
+
+    def __len__(self) -> int:
+        return len(self.__ids)
+
+
+class ImageRegistry:
+    """
+    Images managed by PDT indexed by name, iterated in the order they were added.
+    """
+
+    def __init__(self):
+        self.__by_name: dict = {}
+
+    def add(self, image) -> None:
+        self.__by_name[image.name] = image
+
+    def remove(self, image) -> None:
+        del self.__by_name[image.name]
+
+    def get(self, name: str, default=None):
+        return self.__by_name.get(name, default)
+
+    @property
+    def names(self) -> list[str]:
+        return list(self.__by_name.keys())
+
+    def values(self) -> list:
+        return list(self.__by_name.values())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__by_name
+
+    def __iter__(self):
+        return iter(list(self.__by_name.values()))
+
+    def __len__(self) -> int:
+        return len(self.__by_name)
+
+
+class DockerImageCache:
+    """
+    Images of the docker daemon indexed by tag and short id. The listing is fetched lazily with one images.list()
+    and kept until it is invalidated by PDT's own builds and removals, or by docker events when they are watched,
+    so checking names like 'new pwn*200' does is a set lookup instead of a round trip to the daemon per name.
+    """
+
+    # image events which may change the tags on the host
+    EVENTS = {'tag', 'untag', 'delete', 'pull', 'load', 'import', 'build'}
+
+    def __init__(self, docker_client, ttl: float | None = None):
+        """
+        :param docker_client: client (or LazyDockerClient) to list images with
+        :param ttl: seconds a listing stays valid, None means until it is invalidated
+        """
+        self.__docker_client = docker_client
+        self.ttl: float | None = ttl
+        self.__by_ref: dict = {}
+        self.__images: list = []
+        self.__fetched: float | None = None     # monotonic time of the listing, None if stale
+        self.__lock = threading.Lock()
+        self.__events = None
+
+    @property
+    def fresh(self) -> bool:
+        return self.__fetched is not None and (self.ttl is None or time.monotonic() - self.__fetched < self.ttl)
+
+    def load(self, images: list) -> None:
+        """
+        fill the cache with a listing fetched elsewhere, like the one of reconciling.
+        """
+        by_ref = {}
+        for image in images:
+            by_ref[image.short_id[7:]] = image
+            for tag in image.tags:
+                by_ref[tag] = image
+        with self.__lock:
+            self.__images, self.__by_ref, self.__fetched = list(images), by_ref, time.monotonic()
+
+    def refresh(self) -> None:
+        self.load(self.__docker_client.images.list())
+
+    def invalidate(self) -> None:
+        with self.__lock:
+            self.__fetched = None
+
+    def __ensure(self) -> None:
+        if not self.fresh:
+            self.refresh()
+
+    def get(self, ref: str, refresh_on_miss: bool = False):
+        """
+        :param ref: tag or short id (without 'sha256:')
+        :param refresh_on_miss: list the images again before giving up, for images which may have just been pulled
+        :return: image object, None if not found
+        """
+        self.__ensure()
+        image = self.__by_ref.get(ref)
+        if image is None and refresh_on_miss:
+            self.refresh()
+            image = self.__by_ref.get(ref)
+        return image
+
+    def put(self, image) -> None:
+        """
+        record an image PDT has just built, so that the listing does not need to be fetched again.
+        """
+        with self.__lock:
+            if self.__fetched is None:
+                return
+            self.__images.append(image)
+            self.__by_ref[image.short_id[7:]] = image
+            for tag in image.tags:
+                self.__by_ref[tag] = image
+
+    def as_dict(self) -> dict:
+        """
+        :return: images indexed by short id and by tag
+        """
+        self.__ensure()
+        return dict(self.__by_ref)
+
+    @property
+    def tags(self) -> set[str]:
+        self.__ensure()
+        return {ref for ref in self.__by_ref if ':' in ref}
+
+    def __contains__(self, ref: str) -> bool:
+        return self.get(ref) is not None
+
+    def watch(self) -> bool:
+        """
+        Invalidate the cache on image events of docker in a background thread, for long running processes like
+        the daemon. When the event stream breaks, the cache falls back to expiring after IMAGE_CACHE_TTL.
+        :return: whether the event stream is opened
+        """
+        try:
+            self.__events = self.__docker_client.events(decode=True, filters={'type': 'image'})
+        except Exception as e:
+            PrettyPrinter.warning(f'Cannot watch docker events ({e}), image listing expires '
+                                  f'after {IMAGE_CACHE_TTL}s.')
+            self.ttl = IMAGE_CACHE_TTL
+            return False
+        self.ttl = None
+        threading.Thread(target=self.__watch, name='pdt-image-events', daemon=True).start()
+        return True
+
+    def __watch(self) -> None:
+        try:
+            for event in self.__events:
+                if event.get('Action') in self.EVENTS:
+                    self.invalidate()
+        except Exception:
+            pass
+        self.ttl = IMAGE_CACHE_TTL
+        self.invalidate()
+
+    def unwatch(self) -> None:
+        if self.__events is not None:
+            self.__events.close()
+            self.__events = None
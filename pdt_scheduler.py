@@ -0,0 +1,134 @@
+import time
+import threading
+from util import *
+
+concurrent_futures = LazyModule('concurrent.futures')
+
+BUILD_QUEUED = 'queued'
+BUILD_BUILDING = 'building'
+BUILD_DONE = 'done'
+BUILD_FAILED = 'failed'
+BUILD_CANCELLED = 'cancelled'
+
+
+class BuildTask:
+    def __init__(self, image):
+        self.image = image
+        self.status: str = BUILD_QUEUED
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+        self.error: str = ''
+        self.future = None
+
+    @property
+    def name(self) -> str:
+        return self.image.name
+
+    @property
+    def elapsed(self) -> float:
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time if self.end_time is not None else time.monotonic()) - self.start_time
+
+
+class BuildScheduler:
+    """
+    Builds many PdtImage objects with a bounded thread pool. Images are put on a queue with submit(), run()
+    blocks until every task is finished (or cancelled) and returns the tasks in the order they were queued.
+    Building is I/O bound (archive creation and the docker daemon do the real work), so threads are enough.
+    """
+
+    def __init__(self, jobs: int = DEFAULT_BUILD_JOBS):
+        self.jobs: int = max(1, jobs)
+        self.__tasks: dict[str, BuildTask] = {}
+        self.__lock = threading.Lock()
+        self.__start_time: float = 0.0
+        self.__end_time: float = 0.0
+
+    @property
+    def tasks(self) -> list[BuildTask]:
+        return list(self.__tasks.values())
+
+    def submit(self, images: list) -> None:
+        for image in images:
+            if image.name in self.__tasks:
+                PrettyPrinter.warning(f'{image.name} is already queued, skipped.')
+                continue
+            self.__tasks[image.name] = BuildTask(image)
+        bases = {t.image.base_tag for t in self.__tasks.values() if t.image.parent is not None}
+        PrettyPrinter.info(f'{len(self.__tasks)} image(s) queued, sharing {len(bases)} base image(s).')
+
+    def status(self, name: str) -> str | None:
+        task = self.__tasks.get(name)
+        return task.status if task is not None else None
+
+    def cancel(self, names: list[str] | None = None) -> int:
+        """
+        Cancel queued tasks. Builds which are already running cannot be interrupted and will run to the end.
+        :param names: names of images to cancel, None means all queued images
+        :return: count of cancelled tasks
+        """
+        cancelled = 0
+        with self.__lock:
+            for task in self.__tasks.values():
+                if names is not None and task.name not in names:
+                    continue
+                if task.status != BUILD_QUEUED:
+                    continue
+                if task.future is not None and not task.future.cancel():
+                    continue
+                task.status = BUILD_CANCELLED
+                cancelled += 1
+        return cancelled
+
+    def __build_one(self, task: BuildTask) -> None:
+        with self.__lock:
+            if task.status != BUILD_QUEUED:
+                return
+            task.status = BUILD_BUILDING
+            task.start_time = time.monotonic()
+        PrettyPrinter.info(f'[{self.__progress()}] building {task.name} ...')
+        try:
+            ok = task.image.build()
+            if not ok:
+                task.error = task.image.build_error or 'build failed'
+        except Exception as e:
+            ok = False
+            task.error = str(e)
+        task.end_time = time.monotonic()
+        task.status = BUILD_DONE if ok else BUILD_FAILED
+        PrettyPrinter.info(f'[{self.__progress()}] {task.name} {task.status} in {task.elapsed:.1f}s')
+
+    def __progress(self) -> str:
+        finished = sum(1 for t in self.__tasks.values() if t.status in (BUILD_DONE, BUILD_FAILED, BUILD_CANCELLED))
+        return f'{finished}/{len(self.__tasks)}'
+
+    def run(self) -> list[BuildTask]:
+        self.__start_time = time.monotonic()
+        with concurrent_futures.ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='pdt-build',
+                                                   initializer=inherit_output()) as pool:
+            for task in self.__tasks.values():
+                if task.status == BUILD_QUEUED:
+                    task.future = pool.submit(self.__build_one, task)
+            pending = {t.future for t in self.__tasks.values() if t.future is not None}
+            try:
+                while pending:
+                    _, pending = concurrent_futures.wait(pending, timeout=0.5,
+                                                         return_when=concurrent_futures.FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                PrettyPrinter.warning(f'Interrupted, {self.cancel()} queued build(s) cancelled, '
+                                      f'waiting for running builds to finish ...')
+                concurrent_futures.wait(pending)
+        self.__end_time = time.monotonic()
+        return self.tasks
+
+    def summary(self) -> str:
+        rows = [[t.name, t.status, f'{t.elapsed:.1f}s', t.error] for t in self.__tasks.values()]
+        counts = {s: sum(1 for t in self.__tasks.values() if t.status == s)
+                  for s in (BUILD_DONE, BUILD_FAILED, BUILD_CANCELLED)}
+        wall = self.__end_time - self.__start_time
+        serial = sum(t.elapsed for t in self.__tasks.values())
+        lines = [PrettyPrinter.table(rows, ['name', 'status', 'time', 'error']),
+                 f'{counts[BUILD_DONE]} done, {counts[BUILD_FAILED]} failed, {counts[BUILD_CANCELLED]} cancelled; '
+                 f'wall clock {wall:.1f}s with {self.jobs} job(s), sum of build times {serial:.1f}s']
+        return '\n'.join(lines)
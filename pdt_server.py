@@ -0,0 +1,130 @@
+import io
+import json
+import socket
+import threading
+import socketserver
+from util import *
+
+
+class PdtRequestHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON object per line, a connection may send many requests. Requests:
+        {"argv": ["list", "select"]}    execute a command, the reply carries everything it printed
+        {"op": "tree"}                  get the command tree
+    Replies: {"ok": true/false, "output": "...", ...}, ok is false if the command printed an error, argparse
+    rejected it or it raised an exception.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                reply = {'ok': False, 'output': 'malformed request'}
+            else:
+                reply = self.server.dispatch(request)
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+            self.wfile.flush()
+
+
+class PdtServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Keeps one PdtFactory resident and serves commands over a Unix socket. Clients are handled by their own
+    threads, commands are serialised by a lock since they share the factory and the config store.
+    """
+    daemon_threads = True
+
+    def __init__(self, path: str, execute, command_tree: dict, should_stop=None):
+        """
+        :param path: path of the Unix socket
+        :param execute: function executing a command given as argv, including persisting its changes, and returning
+                        whether it succeeded
+        :param command_tree: command tree of the factory
+        :param should_stop: function telling whether the server should shut down after a command
+        """
+        if os.path.exists(path):
+            if connect(path) is not None:
+                raise OSError(f'another PDT daemon is listening on {path}')
+            os.remove(path)     # stale socket of a daemon which did not exit cleanly
+        super().__init__(path, PdtRequestHandler)
+        os.chmod(path, 0o600)
+        self.path: str = path
+        self.__execute = execute
+        self.__command_tree: dict = command_tree
+        self.__should_stop = should_stop
+        self.__lock = threading.Lock()
+        ThreadOutput.install()  # background threads keep printing to the daemon's output, see dispatch
+
+    def dispatch(self, request) -> dict:
+        if not isinstance(request, dict):
+            return {'ok': False, 'output': 'a JSON object expected'}
+        if request.get('op') == 'tree':
+            return {'ok': True, 'output': '', 'tree': self.__command_tree}
+        if not isinstance(request.get('argv'), list) or len(request['argv']) == 0:
+            return {'ok': False, 'output': 'argv needed'}
+        output = io.StringIO()
+        ok = False
+        with self.__lock:
+            with capture_output(output):
+                try:
+                    ok = self.__execute([str(a) for a in request['argv']])
+                except SystemExit as e:     # argparse exits on errors and -h
+                    ok = e.code in (0, None)
+                except Exception as e:
+                    PrettyPrinter.error(f'{type(e).__name__}: {e}')
+            if self.__should_stop is not None and self.__should_stop():
+                threading.Thread(target=self.shutdown).start()
+        return {'ok': ok, 'output': output.getvalue()}
+
+    def call(self, function):
+        """
+        run a function between commands, for background threads touching the factory or the config store.
+        """
+        with self.__lock:
+            return function()
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def connect(path: str = SERVER_SOCKET) -> socket.socket | None:
+    """
+    connect to a running daemon.
+    :return: connected socket, None if no daemon is listening
+    """
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def request(sock: socket.socket, payload: dict) -> dict:
+    sock.sendall(json.dumps(payload).encode() + b'\n')
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError('PDT daemon closed the connection')
+        data += chunk
+    return json.loads(data)
+
+
+def forward(argv: list[str], path: str = SERVER_SOCKET) -> bool | None:
+    """
+    forward a command to the daemon and print its output.
+    :return: whether the command succeeded, None if no daemon is running
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+    with sock:
+        reply = request(sock, {'argv': argv})
+    print(reply['output'], end='')
+    return reply['ok']
@@ -0,0 +1,125 @@
+import json
+from util import *
+from pdt_trace import tracer
+
+
+class ConfigStore:
+    """
+    Persists the state of all images as a snapshot (config.yaml) plus a write-ahead journal of JSON lines.
+    After every command only the images marked dirty are appended to the journal, so the cost of a command does
+    not grow with the total state. The journal is compacted into a new snapshot, written to a temporary file and
+    renamed, once it gets long enough. A crash can at most lose the line being appended, which is ignored on load.
+    The snapshot is also kept as JSON, which loads without yaml and is only trusted while config.yaml is unchanged.
+    """
+
+    def __init__(self, snapshot: str = CONFIG_FILE, journal: str = CONFIG_JOURNAL,
+                 compact_records: int = JOURNAL_COMPACT_RECORDS, cache: str = CONFIG_CACHE):
+        self.__snapshot: str = snapshot
+        self.__journal_path: str = journal
+        self.__cache: str = cache
+        self.__journal = None
+        self.__records: int = 0
+        self.compact_records: int = compact_records
+
+    def load(self) -> list[dict]:
+        """
+        load the snapshot and replay the journal on it.
+        :return: configs of all images, in the order they were created
+        """
+        with tracer.span('config load'):
+            return self.__load()
+
+    def __load(self) -> list[dict]:
+        images: dict[str, dict] = {}
+        if os.path.exists(self.__snapshot):
+            for info in self.__load_snapshot():
+                images[info['name']] = info
+        if os.path.exists(self.__journal_path):
+            with open(self.__journal_path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        PrettyPrinter.warning(f'Ignored a truncated record in {self.__journal_path}.')
+                        continue
+                    if record['op'] == 'put':
+                        images[record['image']['name']] = record['image']
+                    elif record['op'] == 'del':
+                        images.pop(record['name'], None)
+                    self.__records += 1
+        return list(images.values())
+
+    def __load_snapshot(self) -> list[dict]:
+        stat = os.stat(self.__snapshot)
+        try:
+            with open(self.__cache, 'r', encoding='UTF-8') as f:
+                cache = json.load(f)
+            if cache['snapshot'] == [stat.st_mtime_ns, stat.st_size]:
+                return cache['images']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        # config.yaml written by an older PDT or edited by hand
+        data = load_yaml(self.__snapshot) or []
+        self.__write_cache(data)
+        return data
+
+    def __write_cache(self, data: list[dict]) -> None:
+        stat = os.stat(self.__snapshot)
+        with open(self.__cache + '.tmp', 'w', encoding='UTF-8') as f:
+            json.dump({'snapshot': [stat.st_mtime_ns, stat.st_size], 'images': data}, f, default=_json_default)
+        os.replace(self.__cache + '.tmp', self.__cache)
+
+    def commit(self, dirty: list, deleted: list[str], sync: bool = True) -> None:
+        """
+        append the changes of a command to the journal.
+        :param dirty: images changed
+        :param deleted: names of images deleted
+        :param sync: fsync the journal, scripts only flush it after every line and sync at the end
+        """
+        if len(dirty) == 0 and len(deleted) == 0:
+            return
+        with tracer.span('config commit', images=len(dirty) + len(deleted)):
+            self.__commit(dirty, deleted, sync)
+
+    def __commit(self, dirty: list, deleted: list[str], sync: bool) -> None:
+        if self.__journal is None:
+            self.__journal = open(self.__journal_path, 'a', encoding='UTF-8')
+        lines = [json.dumps({'op': 'del', 'name': name}) for name in deleted]
+        lines += [json.dumps({'op': 'put', 'image': image.info_dict_for_config}, default=_json_default)
+                  for image in dirty]
+        self.__journal.write('\n'.join(lines) + '\n')
+        self.__journal.flush()
+        if sync:
+            os.fsync(self.__journal.fileno())
+        self.__records += len(lines)
+
+    def need_compact(self) -> bool:
+        return self.__records >= self.compact_records
+
+    def compact(self, images: list) -> None:
+        """
+        write a full snapshot atomically and start a new journal.
+        """
+        with tracer.span('config compact', images=len(images)):
+            data = [image.info_dict_for_config for image in images]
+            dump_yaml(self.__snapshot, data)
+            self.__write_cache(data)
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+        if os.path.exists(self.__journal_path):
+            os.remove(self.__journal_path)
+        self.__records = 0
+
+    def close(self) -> None:
+        if self.__journal is not None:
+            self.__journal.flush()
+            os.fsync(self.__journal.fileno())
+            self.__journal.close()
+            self.__journal = None
+
+
+def _json_default(o):
+    if isinstance(o, set):
+        return sorted(o)
+    raise TypeError(f'{type(o).__name__} is not JSON serializable')
@@ -0,0 +1,183 @@
+import json
+import time
+import threading
+import contextlib
+from util import *
+
+TRACE_FILE = './runtime/trace.jsonl'
+
+
+class _Span:
+    def __init__(self, tracer: 'Tracer', name: str, attrs: dict):
+        self.tracer: Tracer = tracer
+        self.name: str = name
+        self.attrs: dict = attrs
+        self.parent: str | None = None
+        self.start: float = 0.0
+        self.wall: float = 0.0
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.parent = stack[-1].name if stack else self.tracer.command_name
+        stack.append(self)
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        self.tracer.stack().pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.record(self, elapsed)
+        return False
+
+
+class Tracer:
+    """
+    Timing spans around command handlers, docker API calls, archive creation and config I/O. Tracing is off unless
+    PDT_TRACE is set ('1' for ./runtime/trace.jsonl, or the path of the trace file) or a command starts with
+    --trace. Spans of every command are appended to the trace file as JSON lines and summarised after the
+    command. If PDT_TRACE_PROM is set, totals of all commands are also exported to that Prometheus textfile.
+    When tracing is off, span() costs one attribute check.
+    """
+
+    def __init__(self):
+        env = os.environ.get('PDT_TRACE', '')
+        self.path: str = TRACE_FILE if env.lower() in ('', '1', 'true', 'on') else env
+        self.enabled: bool = env.lower() not in ('', '0', 'false', 'off')
+        self.prom_path: str | None = os.environ.get('PDT_TRACE_PROM') or None
+        self.command_name: str | None = None
+        self.__active: bool = False
+        self.__command_id: str = ''
+        self.__spans: list[dict] = []
+        self.__totals: dict[str, list] = {}     # span name -> [count, seconds], over the whole process
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def stack(self) -> list[_Span]:
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+        return self.__local.stack
+
+    def span(self, name: str, **attrs):
+        if not self.__active:
+            return contextlib.nullcontext()
+        return _Span(self, name, attrs)
+
+    def record(self, span: _Span, elapsed: float) -> None:
+        entry = {'command': self.__command_id, 'span': span.name, 'parent': span.parent, 'start': span.wall,
+                 'ms': round(elapsed * 1000, 3), 'thread': threading.current_thread().name}
+        entry.update(span.attrs)
+        with self.__lock:
+            self.__spans.append(entry)
+            total = self.__totals.setdefault(span.name, [0, 0.0])
+            total[0] += 1
+            total[1] += elapsed
+
+    @contextlib.contextmanager
+    def command(self, argv: list[str], force: bool = False):
+        """
+        trace one command, the spans are written and summarised when it finishes.
+        :param force: trace this command even if tracing is not enabled
+        """
+        if not (self.enabled or force):
+            yield
+            return
+        self.__active = True
+        self.__command_id = uuid.uuid4().hex[:8]
+        self.command_name = 'command ' + (argv[0] if argv else '')
+        self.__spans = []
+        try:
+            with self.span(self.command_name, argv=' '.join(argv)):
+                yield
+        finally:
+            self.__active = False
+            self.__flush()
+            self.command_name = None
+
+    def instrument_docker(self, client) -> None:
+        """
+        time every HTTP request the docker SDK sends, including the ones sent by methods of containers and images.
+        For clients without the low level API (like the fake client of the benchmarks) only the methods of the
+        image and container collections are timed.
+        """
+        api = getattr(client, 'api', None)
+        if api is None:
+            for collection in ('images', 'containers'):
+                self.__instrument_methods(getattr(client, collection), f'docker {collection}')
+            return
+        if getattr(api, '_pdt_traced', False):
+            return
+        send = api.send
+
+        def traced_send(request, **kwargs):
+            with self.span(f'docker {request.method} {_api_endpoint(request.path_url)}'):
+                return send(request, **kwargs)
+        api.send = traced_send
+        api._pdt_traced = True
+
+    def __instrument_methods(self, obj, prefix: str) -> None:
+        for name in ('list', 'get', 'build', 'create', 'run', 'remove'):
+            method = getattr(obj, name, None)
+            if method is None or getattr(method, '_pdt_traced', False):
+                continue
+
+            def traced(*args, __method=method, __name=f'{prefix}.{name}', **kwargs):
+                with self.span(__name):
+                    return __method(*args, **kwargs)
+            traced._pdt_traced = True
+            setattr(obj, name, traced)
+
+    def __flush(self) -> None:
+        with self.__lock:
+            spans, self.__spans = self.__spans, []
+        if len(spans) == 0:
+            return
+        try:
+            with open(self.path, 'a', encoding='UTF-8') as f:
+                f.write(''.join(json.dumps(s, default=str) + '\n' for s in spans))
+        except OSError as e:
+            PrettyPrinter.warning(f'Failed to write trace file {self.path}: {e}')
+        if self.prom_path is not None:
+            self.__export_prometheus()
+        print(self.summary(spans))
+
+    @staticmethod
+    def summary(spans: list[dict]) -> str:
+        groups: dict[str, list[float]] = {}
+        for s in spans:
+            groups.setdefault(s['span'], []).append(s['ms'])
+        rows = [[name, len(ms), f'{sum(ms):.1f}', f'{max(ms):.1f}']
+                for name, ms in sorted(groups.items(), key=lambda x: -sum(x[1]))]
+        return PrettyPrinter.table(rows, ['span', 'count', 'total ms', 'max ms'])
+
+    def __export_prometheus(self) -> None:
+        lines = ['# HELP pdt_span_seconds Time spent in PDT spans.', '# TYPE pdt_span_seconds summary']
+        with self.__lock:
+            for name, (count, seconds) in sorted(self.__totals.items()):
+                label = name.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'pdt_span_seconds_count{{span="{label}"}} {count}')
+                lines.append(f'pdt_span_seconds_sum{{span="{label}"}} {seconds:.6f}')
+        try:
+            with open(self.prom_path + '.tmp', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(self.prom_path + '.tmp', self.prom_path)
+        except OSError as e:
+            PrettyPrinter.warning(f'Failed to write prometheus textfile {self.prom_path}: {e}')
+
+
+def _api_endpoint(path: str) -> str:
+    """
+    turn '/v1.43/containers/3f2a.../stop?t=2' into 'containers/{id}/stop', so calls on different objects group.
+    """
+    segments = [s for s in path.split('?', 1)[0].split('/') if s]
+    if segments and re.match(r'^v\d+\.\d+$', segments[0]):
+        segments = segments[1:]
+    if len(segments) >= 2 and segments[0] in ('containers', 'images', 'networks', 'volumes', 'exec') \
+            and (len(segments) >= 3 or segments[1] not in ('json', 'create', 'prune', 'load', 'search', 'get')):
+        segments[1] = '{id}'
+    return '/'.join(segments)
+
+
+tracer = Tracer()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of PDT live in the root of the repository, next to pdt.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
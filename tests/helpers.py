@@ -0,0 +1,357 @@
+"""
+Fixtures shared by the tests and the benchmarks: an in-process stand-in of docker.DockerClient, so PDT runs without
+a docker daemon, and a temporary workspace with the layout PDT expects.
+
+Only the part of the docker SDK used by PDT is implemented. Errors are the real docker.errors classes, so the
+error handling of PDT runs as it does against a daemon. Every API call sleeps for the injected latency, which
+makes the benchmarks show how PDT behaves against a slow (or remote) daemon:
+
+    client = FakeDockerClient(latency=0.005, build_latency=0.5)
+    factory = PdtFactory(images, docker_client=client)
+"""
+import hashlib
+import itertools
+import os
+import queue
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import docker.errors
+
+import pdt_factory
+import pdt_object
+from pdt_port import port_allocator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARENT = 'ubuntu:20.04'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class FakeImage:
+    def __init__(self, client, tags: list[str], labels: dict | None = None):
+        self.client = client
+        self.id = 'sha256:' + hashlib.sha256(f'{next(client.serial)}'.encode()).hexdigest()
+        self.tags: list[str] = tags
+        self.labels: dict = labels or {}
+
+    @property
+    def short_id(self) -> str:
+        return self.id[:17]
+
+    @property
+    def attrs(self) -> dict:
+        return {'Id': self.id, 'RepoTags': self.tags, 'Config': {'Labels': self.labels}}
+
+    def remove(self, force: bool = False) -> None:
+        self.client.images.remove(self.id, force=force)
+
+
+class FakeContainer:
+    def __init__(self, client, image: FakeImage, ports: dict, labels: dict):
+        self.client = client
+        self.id = hashlib.sha256(f'container {next(client.serial)}'.encode()).hexdigest()
+        self.image = image
+        self.ports: dict = ports
+        self.labels: dict = labels
+        self.status: str = 'created'
+        self.archives: list[tuple[str, bytes]] = []     # (path, tar data) put into the container
+
+    @property
+    def short_id(self) -> str:
+        return self.id[:12]
+
+    @property
+    def name(self) -> str:
+        return f'fake_{self.short_id}'
+
+    @property
+    def attrs(self) -> dict:
+        # the shape of containers listed with sparse=True
+        return {'Id': self.id, 'Image': self.image.id, 'Labels': self.labels, 'State': self.status}
+
+    def start(self) -> None:
+        self.client.call()
+        if self.status != 'running':
+            self.client.containers.bind(self)
+            self.status = 'running'
+
+    def stop(self, timeout: int = 10) -> None:
+        self.client.call(self.client.stop_latency(timeout) if self.status == 'running' else 0.0)
+        self.__exit()
+
+    def kill(self) -> None:
+        self.client.call()
+        if self.status != 'running':
+            raise docker.errors.APIError(f'Cannot kill container: {self.id}: container {self.id} is not running')
+        self.__exit()
+
+    def remove(self, force: bool = False) -> None:
+        self.client.call()
+        if self.status == 'running' and not force:
+            raise docker.errors.APIError(f'You cannot remove a running container {self.id}.')
+        self.__exit()
+        self.client.containers.forget(self)
+
+    def put_archive(self, path: str, data: bytes) -> bool:
+        self.client.call()
+        self.archives.append((path, data))
+        return True
+
+    def reload(self) -> None:
+        self.client.call()
+        if not self.client.containers.exists(self.id):
+            raise docker.errors.NotFound(f'No such container: {self.id}')
+
+    def __exit(self) -> None:
+        if self.status == 'running':
+            self.client.containers.unbind(self)
+            self.status = 'exited'
+
+
+class FakeImageCollection:
+    def __init__(self, client):
+        self.client = client
+        self.__images: dict[str, FakeImage] = {}
+        self.__lock = threading.Lock()
+
+    def add(self, tags: list[str], labels: dict | None = None) -> FakeImage:
+        """
+        put an image on the fake host without a build, like pulling it.
+        """
+        image = FakeImage(self.client, tags, labels)
+        with self.__lock:
+            for other in self.__images.values():
+                other.tags = [t for t in other.tags if t not in tags]
+            self.__images[image.id] = image
+        self.client.publish({'Type': 'image', 'Action': 'pull', 'id': image.id})
+        return image
+
+    def list(self, name: str | None = None, all: bool = False, filters: dict | None = None) -> list[FakeImage]:
+        self.client.call()
+        with self.__lock:
+            return [i for i in self.__images.values() if name is None or name in i.tags]
+
+    def get(self, name: str) -> FakeImage:
+        self.client.call()
+        if ':' not in name.rsplit('/', 1)[-1] and not all(c in '0123456789abcdef' for c in name):
+            name = f'{name}:latest'
+        with self.__lock:
+            for image in self.__images.values():
+                if name in image.tags or image.id == name or image.id[7:].startswith(name):
+                    return image
+        raise docker.errors.ImageNotFound(f'No such image: {name}')
+
+    def build(self, fileobj=None, custom_context: bool = False, tag: str | None = None, labels: dict | None = None,
+              **kwargs) -> tuple[FakeImage, list]:
+        size = 0
+        if fileobj is not None:
+            # drain the context like the upload to the daemon would
+            while chunk := fileobj.read(1 << 20):
+                size += len(chunk)
+        self.client.call(self.client.build_latency)
+        tag = tag if tag is None or ':' in tag.rsplit('/', 1)[-1] else f'{tag}:latest'
+        image = self.add([tag] if tag is not None else [], labels)
+        self.client.stats['build context bytes'] += size
+        return image, [{'stream': f'Successfully built {image.short_id[7:]}'}]
+
+    def remove(self, image: str, force: bool = False) -> None:
+        self.client.call()
+        target = self.get(image)
+        if not force and any(c.image is target for c in self.client.containers.list(all=True)):
+            raise docker.errors.APIError(f'conflict: unable to delete {image}, it is used by a container')
+        with self.__lock:
+            self.__images.pop(target.id, None)
+        self.client.publish({'Type': 'image', 'Action': 'delete', 'id': target.id})
+
+
+class FakeContainerCollection:
+    def __init__(self, client):
+        self.client = client
+        self.__containers: dict[str, FakeContainer] = {}
+        self.__bound: dict[int, FakeContainer] = {}     # host port -> running container
+        self.__lock = threading.Lock()
+
+    def create(self, image: str, ports: dict | None = None, labels: dict | None = None,
+               **kwargs) -> FakeContainer:
+        self.client.call(self.client.create_latency)
+        container = FakeContainer(self.client, self.client.images.get(image), ports or {}, labels or {})
+        with self.__lock:
+            self.__containers[container.id] = container
+        return container
+
+    def run(self, image: str, ports: dict | None = None, labels: dict | None = None, detach: bool = False,
+            **kwargs) -> FakeContainer:
+        container = self.create(image, ports=ports, labels=labels, **kwargs)
+        try:
+            container.start()
+        except docker.errors.APIError:
+            self.forget(container)
+            raise
+        return container
+
+    def bind(self, container: FakeContainer) -> None:
+        with self.__lock:
+            for binding in container.ports.values():
+                port = binding[1] if isinstance(binding, tuple) else binding
+                if port in self.__bound or port in self.client.occupied_ports:
+                    raise docker.errors.APIError(f'driver failed programming external connectivity: '
+                                                 f'Bind for 0.0.0.0:{port} failed: port is already allocated')
+            for binding in container.ports.values():
+                self.__bound[binding[1] if isinstance(binding, tuple) else binding] = container
+
+    def unbind(self, container: FakeContainer) -> None:
+        with self.__lock:
+            for port in [p for p, c in self.__bound.items() if c is container]:
+                del self.__bound[port]
+
+    def forget(self, container: FakeContainer) -> None:
+        with self.__lock:
+            self.__containers.pop(container.id, None)
+
+    def exists(self, container_id: str) -> bool:
+        with self.__lock:
+            return container_id in self.__containers
+
+    def list(self, all: bool = False, sparse: bool = False, filters: dict | None = None) -> list[FakeContainer]:
+        self.client.call()
+        label = (filters or {}).get('label')
+        key, _, value = label.partition('=') if label else (None, '', '')
+        with self.__lock:
+            return [c for c in self.__containers.values()
+                    if (all or c.status == 'running')
+                    and (key is None or (key in c.labels and (value == '' or c.labels[key] == value)))]
+
+    def get(self, container_id: str) -> FakeContainer:
+        self.client.call()
+        with self.__lock:
+            for container in self.__containers.values():
+                if container.id.startswith(container_id):
+                    return container
+        raise docker.errors.NotFound(f'No such container: {container_id}')
+
+
+class FakeEventStream:
+    def __init__(self, client):
+        self.client = client
+        self.__queue: queue.Queue = queue.Queue()
+
+    def put(self, event: dict | None) -> None:
+        self.__queue.put(event)
+
+    def __iter__(self):
+        while (event := self.__queue.get()) is not None:
+            yield event
+
+    def close(self) -> None:
+        self.client.unsubscribe(self)
+        self.__queue.put(None)
+
+
+class FakeDockerClient:
+    """
+    :param latency: seconds every API call takes
+    :param jitter: random extra seconds, up to this value, added to every call
+    :param create_latency: extra seconds creating a container takes
+    :param build_latency: seconds building an image takes, the context upload is simulated by reading it
+    :param stop_delay: seconds a running container takes to exit after SIGTERM, stopping waits at most the timeout
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, create_latency: float = 0.0,
+                 build_latency: float = 0.0, stop_delay: float = 0.0):
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.create_latency: float = create_latency
+        self.build_latency: float = build_latency
+        self.stop_delay: float = stop_delay
+        self.serial = itertools.count()
+        self.occupied_ports: set[int] = set()  # ports used by something outside docker
+        self.stats: dict[str, int] = {'calls': 0, 'build context bytes': 0}
+        self.__stats_lock = threading.Lock()
+        self.__subscribers: list[FakeEventStream] = []
+        self.images = FakeImageCollection(self)
+        self.containers = FakeContainerCollection(self)
+
+    def call(self, extra: float = 0.0) -> None:
+        with self.__stats_lock:
+            self.stats['calls'] += 1
+        delay = self.latency + extra + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def stop_latency(self, timeout: int) -> float:
+        return min(self.stop_delay, timeout)
+
+    def events(self, decode: bool = False, filters: dict | None = None) -> FakeEventStream:
+        self.call()
+        stream = FakeEventStream(self)
+        self.__subscribers.append(stream)
+        return stream
+
+    def publish(self, event: dict) -> None:
+        for stream in list(self.__subscribers):
+            stream.put(event)
+
+    def unsubscribe(self, stream: FakeEventStream) -> None:
+        if stream in self.__subscribers:
+            self.__subscribers.remove(stream)
+
+    def ping(self) -> bool:
+        self.call()
+        return True
+
+    def close(self) -> None:
+        for stream in list(self.__subscribers):
+            stream.close()
+
+
+class Workspace:
+    """
+    A temporary working directory with the layout PDT expects, so the real runtime directory is never touched.
+    """
+
+    def __init__(self):
+        self.path: str = tempfile.mkdtemp(prefix='pdt-test-')
+        os.symlink(os.path.join(ROOT, 'templates'), os.path.join(self.path, 'templates'))
+        self.cwd: str = os.getcwd()
+        os.chdir(self.path)
+
+    def reset(self) -> None:
+        shutil.rmtree('runtime', ignore_errors=True)
+        pdt_factory.check_dirs()
+        # module level state of PDT is tied to the runtime directory
+        port_allocator.__init__()
+        pdt_object.deploy_index = pdt_object.FileDigestIndex(f'{pdt_object.ZIP_DIR}/index.json')
+        pdt_factory.use_script = True
+
+    def close(self) -> None:
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+
+def new_factory(client: FakeDockerClient, images: list[dict] | None = None) -> pdt_factory.PdtFactory:
+    pdt_factory.factory = pdt_factory.PdtFactory(images, docker_client=client)
+    return pdt_factory.factory
+
+
+def ready_factory(client: FakeDockerClient, name: str = 'pwn') -> pdt_factory.PdtFactory:
+    """
+    a factory with one configured and built image, selected.
+    """
+    client.images.add([PARENT])
+    factory = new_factory(client)
+    os.makedirs('problem', exist_ok=True)
+    with open(os.path.join('problem', 'pwn'), 'wb') as f:
+        f.write(b'\x7fELF')
+    for command in (['new', name], ['select', name], ['set', 'parent', PARENT], ['set', 'basedir', 'problem'],
+                    ['set', 'deploy', '-a', 'pwn'], ['set', 'entry', 'pwn'], ['set', 'port', '10001'], ['build']):
+        factory.arg_parser(command)
+    return factory
@@ -0,0 +1,110 @@
+"""
+Activation starts an on-demand container for the first connection and the reaper stops it when it is idle.
+"""
+import time
+import socket
+import asyncio
+import threading
+import unittest
+
+from pdt_activator import Activation
+from helpers import free_port
+
+
+class BannerContainer:
+    """
+    container object whose service prints a banner on a loopback port while it runs, stop blocks until released.
+    """
+
+    def __init__(self, port: int):
+        self.id: str = 'c0'
+        self.port: int = port
+        self.status: str = 'exited'
+        self.calls: list[str] = []
+        self.release_stop: threading.Event = threading.Event()
+        self.release_stop.set()
+        self.stopping: threading.Event = threading.Event()
+        self.__socket: socket.socket | None = None
+
+    def start(self) -> None:
+        self.calls.append('start')
+        self.__socket = socket.create_server(('127.0.0.1', self.port), reuse_port=True)
+        threading.Thread(target=self.__serve, args=(self.__socket,), daemon=True).start()
+        self.status = 'running'
+
+    def __serve(self, server: socket.socket) -> None:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            with connection:
+                connection.sendall(b'banner\n')
+
+    def stop(self, timeout: int = 10) -> None:
+        self.calls.append('stop')
+        self.stopping.set()
+        self.release_stop.wait(5)
+        self.__socket.close()
+        self.status = 'exited'
+
+
+class ActivationTest(unittest.TestCase):
+    def setUp(self):
+        self.container = BannerContainer(free_port())
+        self.activation = Activation(('pwn', 0), free_port(), self.container.port, self.container,
+                                     idle_timeout=0, stop_timeout=1)
+
+    def tearDown(self):
+        self.container.release_stop.set()
+
+    async def __connect(self) -> bytes:
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.activation.port)
+        try:
+            return await asyncio.wait_for(reader.read(), 10)
+        finally:
+            writer.close()
+
+    async def __cold_start_then_reap(self):
+        await self.activation.listen()
+        try:
+            self.assertEqual(await self.__connect(), b'banner\n')
+            self.assertEqual(self.activation.starts, 1)
+            self.activation.last_active = time.monotonic() - 1
+            await self.activation.reap()
+            self.assertFalse(self.activation.running)
+            self.assertEqual(self.container.calls, ['start', 'stop'])
+        finally:
+            await self.activation.close()
+
+    def test_cold_start_then_reap(self):
+        asyncio.run(self.__cold_start_then_reap())
+
+    async def __connection_during_stop(self):
+        await self.activation.listen()
+        try:
+            self.assertEqual(await self.__connect(), b'banner\n')
+            self.container.release_stop.clear()
+            self.activation.last_active = time.monotonic() - 1
+            reap = asyncio.create_task(self.activation.reap())
+            await asyncio.get_running_loop().run_in_executor(None, self.container.stopping.wait, 5)
+            self.assertEqual(self.activation.row()[4], 'stopping')
+            # arrives while the container is still being stopped, must wait for the stop and start it again
+            connection = asyncio.create_task(self.__connect())
+            await asyncio.sleep(0.2)
+            self.assertFalse(connection.done())
+            self.container.release_stop.set()
+            await reap
+            self.assertEqual(await connection, b'banner\n')
+            self.assertEqual(self.container.calls, ['start', 'stop', 'start'])
+            self.assertEqual((self.activation.starts, self.activation.stops), (2, 1))
+            self.assertTrue(self.activation.running)
+        finally:
+            await self.activation.close()
+
+    def test_connection_during_stop(self):
+        asyncio.run(self.__connection_during_stop())
+
+
+if __name__ == '__main__':
+    unittest.main()
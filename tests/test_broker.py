@@ -0,0 +1,92 @@
+"""
+InstanceBroker leases, releases and reclaims containers, and its HTTP endpoint on kept-alive connections.
+"""
+import json
+import unittest
+import http.client
+
+import docker
+from pdt_broker import InstanceBroker, BrokerError
+from pdt_object import PdtImage
+from pdt_registry import ImageRegistry
+from helpers import FakeDockerClient, Workspace, free_port
+
+
+class BrokerTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = Workspace()
+        self.workspace.reset()
+        self.client = FakeDockerClient()
+        self.client.images.add(['pwn:latest'])
+        self.image = PdtImage('pwn', self.client)
+        self.image.port = 10001
+        self.image.stable_ids = True
+        self.image.broker.ttl = 60
+        images = ImageRegistry()
+        images.add(self.image)
+        self.changed: list[PdtImage] = []
+        self.broker = InstanceBroker(images, lambda f: f(), lambda: None, self.changed.append)
+
+    def tearDown(self):
+        self.broker.stop()
+        self.workspace.close()
+
+    def test_quota(self):
+        first = self.broker.acquire('alice', 'pwn')
+        with self.assertRaises(BrokerError) as e:
+            self.broker.acquire('alice', 'pwn')
+        self.assertEqual(e.exception.status, 429)
+        self.assertEqual(e.exception.details['instances'], [first])
+        self.assertNotEqual(self.broker.acquire('bob', 'pwn')['id'], first['id'])
+
+    def test_release(self):
+        leased = self.broker.acquire('alice', 'pwn')
+        with self.assertRaises(BrokerError):
+            self.broker.release('bob', 'pwn', leased['id'])
+        self.broker.release('alice', 'pwn', leased['id'])
+        self.assertEqual(self.image.container_cnt, 0)
+        self.assertEqual(self.broker.instances('alice'), [])
+
+    def test_expired(self):
+        leased = self.broker.acquire('alice', 'pwn')
+        self.image.containers[leased['id']].lease.expires = 0
+        self.assertEqual(self.broker.instances('alice'), [])
+        self.assertEqual(self.broker.reclaim(), 1)
+        self.assertEqual(self.image.container_cnt, 0)
+
+    def test_failed_removal_retires(self):
+        leased = self.broker.acquire('alice', 'pwn')
+        container = self.image.containers[leased['id']].container_object
+        remove = container.remove
+
+        def failing_remove(*args, **kwargs):
+            raise docker.errors.APIError('device or resource busy')
+        container.remove = failing_remove
+        self.broker.release('alice', 'pwn', leased['id'])
+        self.assertEqual(self.image.container_cnt, 1)
+        self.assertEqual(self.broker.instances('alice'), [])
+        # never handed out again, even though it is running without a live lease
+        self.assertNotEqual(self.broker.acquire('bob', 'pwn')['id'], leased['id'])
+        self.assertEqual(self.broker.rows()[0][-1], 'retired')
+        container.remove = remove
+        self.assertEqual(self.broker.reclaim(), 1)
+        self.assertNotIn(leased['id'], self.image.containers)
+
+    def test_body_on_kept_alive_connection(self):
+        port = free_port()
+        self.broker.start(('127.0.0.1', port), 'localhost')
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        headers = {'Authorization': 'Bearer alice', 'Content-Type': 'application/json'}
+        connection.request('POST', '/instances/pwn', body=json.dumps({'note': 'x' * 1000}), headers=headers)
+        response = connection.getresponse()
+        self.assertEqual(response.status, 201)
+        leased = json.loads(response.read())
+        connection.request('GET', '/instances', headers=headers)
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(response.read()), [leased])
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
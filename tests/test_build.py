@@ -0,0 +1,47 @@
+"""
+BuildScheduler tells why a build failed.
+"""
+import unittest
+
+import docker
+from pdt_scheduler import BuildScheduler, BUILD_DONE, BUILD_FAILED
+from helpers import FakeDockerClient, Workspace, ready_factory
+
+
+class BuildErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = Workspace()
+        self.workspace.reset()
+        self.client = FakeDockerClient()
+        self.image = ready_factory(self.client).select_list
+
+    def tearDown(self):
+        self.workspace.close()
+
+    def build(self) -> tuple[str, str]:
+        scheduler = BuildScheduler(1)
+        scheduler.submit([self.image])
+        task = scheduler.run()[0]
+        return task.status, task.error
+
+    def test_built(self):
+        self.assertEqual(self.build(), (BUILD_DONE, ''))
+
+    def test_incomplete_config(self):
+        self.image.deploy.entry = ''
+        status, error = self.build()
+        self.assertEqual(status, BUILD_FAILED)
+        self.assertIn('incomplete config', error)
+
+    def test_docker_error(self):
+        def failing_build(*args, **kwargs):
+            raise docker.errors.BuildError('apt-get returned 100', [])
+        self.client.images.build = failing_build
+        self.client.images.remove(self.image.base_tag)
+        status, error = self.build()
+        self.assertEqual(status, BUILD_FAILED)
+        self.assertIn('apt-get returned 100', error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+The container limits of a resource profile are passed to containers.create.
+"""
+import unittest
+
+from pdt_object import PdtImage, parse_cpuset
+from helpers import FakeDockerClient, Workspace
+
+
+class CreateKwargsTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = Workspace()
+        self.workspace.reset()
+        self.client = FakeDockerClient()
+        self.client.images.add(['pwn:latest'])
+        self.created: list[dict] = []
+        create = self.client.containers.create
+
+        def recording_create(*args, **kwargs):
+            self.created.append(kwargs)
+            return create(*args, **kwargs)
+        self.client.containers.create = recording_create
+        self.image = PdtImage('pwn', self.client)
+        self.image.port = 10001
+
+    def tearDown(self):
+        self.workspace.close()
+
+    def test_cpuset_without_pin(self):
+        self.image.limits.set('cpuset_cpus', '0-3')
+        self.image.limits.set('mem_limit', '256m')
+        self.assertEqual(len(self.image.add_containers(2)), 2)
+        for kwargs in self.created:
+            self.assertEqual(kwargs['cpuset_cpus'], '0-3')
+            self.assertEqual(kwargs['mem_limit'], '256m')
+
+    def test_cpuset_with_pin(self):
+        self.image.limits.set('cpuset_cpus', '0')
+        self.image.limits.set('pin', '1')
+        self.assertEqual(len(self.image.add_containers(1)), 1)
+        self.assertEqual(parse_cpuset(self.created[0]['cpuset_cpus']), [0])
+
+    def test_no_cpuset(self):
+        self.assertEqual(len(self.image.add_containers(1)), 1)
+        self.assertNotIn('cpuset_cpus', self.created[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+"""
+Warm pools filled by commands outside the daemon, which must not wait for the pooled containers to get ready.
+"""
+import time
+import unittest
+
+from helpers import FakeDockerClient, Workspace, ready_factory
+
+
+class CommandRefillTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = Workspace()
+        self.workspace.reset()
+        self.factory = ready_factory(FakeDockerClient())
+        self.image = self.factory.select_list
+
+    def tearDown(self):
+        self.workspace.close()
+
+    def test_refill_does_not_wait(self):
+        # nothing listens on the ports of fake containers, waiting for them would take POOL_READY_TIMEOUT
+        start = time.monotonic()
+        self.factory.arg_parser(['set', 'pool', '2'])
+        self.assertEqual(len(self.image.pool), 2)
+        self.factory.arg_parser(['run', '-n', '1'])
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual((self.image.pool.hits, self.image.pool.misses), (1, 0))
+        self.assertEqual(self.image.container_cnt, 1)
+        self.assertEqual(len(self.image.pool), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Containers running out of ports while they are created or reset, and port reservations persisted across runs.
+"""
+import unittest
+from unittest import mock
+
+import docker
+from pdt_object import PdtImage
+from pdt_port import PortAllocator, port_allocator
+from util import PORT_TABLE, load_yaml
+from helpers import FakeDockerClient, Workspace, new_factory, ready_factory
+
+
+class PortExhaustionTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = Workspace()
+        self.workspace.reset()
+        self.client = FakeDockerClient()
+        self.client.images.add(['pwn:latest'])
+        self.image = PdtImage('pwn', self.client)
+        self.image.port = 10001
+
+    def tearDown(self):
+        self.workspace.close()
+
+    def test_reset_to_ondemand_without_backend_port(self):
+        container = self.image.add_containers(1)[0]
+        old = container.container_object
+        self.image.idle_timeout = 30
+        with mock.patch.object(port_allocator, 'allocate', return_value=[]):
+            self.assertEqual(self.image.reset_containers([[container.id, container.id]]), [])
+        self.assertIs(container.container_object, old)
+        self.assertEqual(container.backend_port, 0)
+
+    def test_port_seized_without_replacement(self):
+        def seized(*args, **kwargs):
+            raise docker.errors.APIError('port is already allocated')
+        self.client.containers.create = seized
+        allocate = port_allocator.allocate
+        with mock.patch.object(port_allocator, 'allocate',
+                               side_effect=lambda count, start=None: allocate(count, start) if count > 1 else []):
+            self.assertEqual(self.image.add_containers(2), [])
+
+
+class PortTableTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = Workspace()
+        self.workspace.reset()
+
+    def tearDown(self):
+        self.workspace.close()
+
+    def test_sync_drops_leaked_reservations(self):
+        ports = PortAllocator().allocate(3)
+        allocator = PortAllocator()     # the next run, the ports were never recorded in config
+        allocator.sync([ports[0]])
+        self.assertEqual(load_yaml(PORT_TABLE)['reserved'], [ports[0]])
+        self.assertEqual(allocator.allocate(1, ports[1]), [ports[1]])
+
+    def test_connect_rebuilds_reservations(self):
+        client = FakeDockerClient()
+        factory = ready_factory(client)
+        factory.arg_parser(['run', '-n', '2'])
+        owned = sorted(c.outer_port for c in factory.select_list.containers.values())
+        port_allocator.allocate(2)      # crashed before the config was committed
+        self.assertEqual(len(load_yaml(PORT_TABLE)['reserved']), 4)
+        images = [image.info_dict_for_config for image in factory.containers]
+        port_allocator.__init__()
+        new_factory(client, images).connect()
+        self.assertEqual(load_yaml(PORT_TABLE)['reserved'], owned)
+
+
+if __name__ == '__main__':
+    unittest.main()
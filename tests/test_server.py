@@ -0,0 +1,116 @@
+"""
+PdtServer.dispatch replies with the output of its own command only, while background threads print and several
+clients send commands at once, and tells whether the command failed.
+"""
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+import pdt_factory
+from util import PrettyPrinter, inherit_output
+from pdt_server import PdtServer
+from pdt_store import ConfigStore
+from helpers import FakeDockerClient, Workspace, ready_factory
+
+
+def execute(argv: list[str]) -> bool:
+    # prints from the command thread and from a pool, like 'run -n'
+    print(f'begin {argv[0]}')
+    with ThreadPoolExecutor(max_workers=2, initializer=inherit_output()) as pool:
+        list(pool.map(lambda i: PrettyPrinter.info(f'{argv[0]} worker {i}'), range(4)))
+    print(f'end {argv[0]}')
+    return True
+
+
+class DispatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        self.server = PdtServer(os.path.join(self.directory.name, 'pdt.sock'), execute, {})
+        self.daemon_output = io.StringIO()
+        sys.stdout.stream = self.daemon_output  # where the daemon prints outside commands
+
+    def tearDown(self):
+        self.server.server_close()
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        self.directory.cleanup()
+
+    def test_background_output_not_captured(self):
+        stopped = threading.Event()
+
+        def refill():
+            while not stopped.is_set():
+                PrettyPrinter.info('pool refilled')
+        thread = threading.Thread(target=refill)
+        thread.start()
+        try:
+            reply = self.server.dispatch({'argv': ['list']})
+        finally:
+            stopped.set()
+            thread.join()
+        self.assertTrue(reply['ok'])
+        self.assertNotIn('pool refilled', reply['output'])
+        self.assertEqual(reply['output'].count('list worker'), 4)
+        self.assertIn('pool refilled', self.daemon_output.getvalue())
+
+    def test_concurrent_clients(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            replies = list(pool.map(lambda i: self.server.dispatch({'argv': [f'c{i}']}), range(16)))
+        for i, reply in enumerate(replies):
+            lines = reply['output'].splitlines()
+            self.assertEqual(lines[0], f'begin c{i}')
+            self.assertEqual(lines[-1], f'end c{i}')
+            self.assertEqual(len(lines), 6)
+            self.assertTrue(all(f'c{i}' in line for line in lines))
+
+    def test_malformed_requests(self):
+        for request in [[], 'list', 1, None]:
+            self.assertFalse(self.server.dispatch(request)['ok'])
+        self.assertFalse(self.server.dispatch({'argv': []})['ok'])
+
+
+
+class CommandStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = Workspace()
+        self.workspace.reset()
+        self.client = FakeDockerClient()
+        ready_factory(self.client)
+        pdt_factory.store = ConfigStore()
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        self.server = PdtServer(os.path.join(self.workspace.path, 'pdt.sock'), pdt_factory.execute, {})
+
+    def tearDown(self):
+        self.server.server_close()
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        pdt_factory.store.close()
+        self.workspace.close()
+
+    def test_succeeded(self):
+        reply = self.server.dispatch({'argv': ['list', 'select']})
+        self.assertTrue(reply['ok'])
+        self.assertEqual(reply['output'], 'pwn\n')
+
+    def test_error_printed(self):
+        self.assertFalse(self.server.dispatch({'argv': ['select', 'nope']})['ok'])
+        self.assertTrue(self.server.dispatch({'argv': ['select', 'pwn']})['ok'])
+
+    def test_error_printed_by_pool(self):
+        def failing_create(*args, **kwargs):
+            raise docker.errors.APIError('no space left on device')
+        self.client.containers.create = failing_create
+        reply = self.server.dispatch({'argv': ['run', '-n', '2', '-j', '2']})
+        self.assertFalse(reply['ok'])
+        self.assertIn('no space left on device', reply['output'])
+
+    def test_argparse_error(self):
+        self.assertFalse(self.server.dispatch({'argv': ['bench', 'pwn', '-c', '0']})['ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+ConfigStore replays the journal on the snapshot, survives a truncated last record, compacts the journal into a
+new snapshot and trusts the JSON cache of the snapshot only while config.yaml is unchanged.
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from pdt_store import ConfigStore
+from util import dump_yaml
+
+
+class Image:
+    def __init__(self, name: str, port: int):
+        self.name: str = name
+        self.port: int = port
+
+    @property
+    def info_dict_for_config(self) -> dict:
+        return {'name': self.name, 'port': self.port, 'apt': {'socat'}}
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='pdt-store-')
+        self.snapshot = os.path.join(self.dir, 'config.yaml')
+        self.journal = os.path.join(self.dir, 'config.journal')
+        self.cache = os.path.join(self.dir, 'config.cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def new_store(self, compact_records: int = 100) -> ConfigStore:
+        return ConfigStore(self.snapshot, self.journal, compact_records, self.cache)
+
+    def test_replay(self):
+        store = self.new_store()
+        store.compact([Image('a', 10001), Image('b', 10002)])
+        store.commit([Image('a', 10003), Image('c', 10004)], ['b'])
+        store.close()
+        loaded = self.new_store().load()
+        self.assertEqual(loaded, [{'name': 'a', 'port': 10003, 'apt': ['socat']},
+                                  {'name': 'c', 'port': 10004, 'apt': ['socat']}])
+
+    def test_truncated_record(self):
+        store = self.new_store()
+        store.commit([Image('a', 10001)], [])
+        store.close()
+        with open(self.journal, 'a') as f:
+            f.write('{"op": "put", "image": {"name": "b", "po')     # crashed while appending
+        loaded = self.new_store().load()
+        self.assertEqual([i['name'] for i in loaded], ['a'])
+
+    def test_compact(self):
+        store = self.new_store(compact_records=3)
+        store.commit([Image('a', 10001), Image('b', 10002)], [])
+        self.assertFalse(store.need_compact())
+        store.commit([Image('b', 10005)], [])
+        self.assertTrue(store.need_compact())
+        store.compact([Image('a', 10001), Image('b', 10005)])
+        self.assertFalse(store.need_compact())
+        self.assertFalse(os.path.exists(self.journal))
+        store.commit([Image('c', 10006)], [])
+        store.close()
+        reloaded = self.new_store(compact_records=3)
+        self.assertEqual([(i['name'], i['port']) for i in reloaded.load()],
+                         [('a', 10001), ('b', 10005), ('c', 10006)])
+        self.assertFalse(reloaded.need_compact())   # only the record written after compacting is counted
+
+    def test_cache(self):
+        store = self.new_store()
+        store.compact([Image('a', 10001)])
+        with open(self.cache) as f:
+            cache = json.load(f)
+        cache['images'][0]['port'] = 10009
+        with open(self.cache, 'w') as f:
+            json.dump(cache, f)
+        # trusted while config.yaml is unchanged
+        self.assertEqual(self.new_store().load()[0]['port'], 10009)
+        dump_yaml(self.snapshot, [{'name': 'a', 'port': 10002}, {'name': 'edited', 'port': 10003}])
+        self.assertEqual([(i['name'], i['port']) for i in self.new_store().load()],
+                         [('a', 10002), ('edited', 10003)])
+        # rewritten from the edited config.yaml
+        with open(self.cache) as f:
+            self.assertEqual(len(json.load(f)['images']), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
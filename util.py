@@ -1,12 +1,13 @@
 import argparse
 import os
 import re
-import yaml
-import uuid
-import socket
+import sys
+import hashlib
+import importlib
+import threading
+import contextlib
 from typing import Union
 from colorama import Fore, Back, Style
-import pandas as pd
 
 PDT_CONSOLE = 'pdt> '
 PDT_ERROR = 'pdt: [x] '
@@ -16,15 +17,38 @@ PDT_SCRIPT = '+ '
 FLAG_HEADER = 'flag'
 
 RUNTIME_DIR = './runtime'
+CONFIG_FILE = './runtime/config.yaml'
+CONFIG_JOURNAL = './runtime/config.journal'
+CONFIG_CACHE = './runtime/config.cache.json'  # JSON copy of config.yaml, spares importing yaml at startup
+SERVER_SOCKET = './runtime/pdt.sock'
+JOURNAL_COMPACT_RECORDS = 1000     # records in the journal before it is compacted into config.yaml
 DEPLOY_FILE_DIR = './runtime/deploy_files'
 ZIP_DIR = './runtime/deploy_files/zips'
+DEPLOY_ARCHIVE_NAME = 'deploy.tar'
+BASE_IMAGE_REPO = 'pdt-base'
+LABEL_MANAGED = 'pdt.managed'
+LABEL_IMAGE = 'pdt.image'
+LABEL_FLAG = 'pdt.flag.id'
+LABEL_PORT = 'pdt.port'
+CONTEXT_SPOOL_SIZE = 64 * 1024 * 1024    # build contexts larger than this are spooled to a temporary file
+PORT_TABLE = './runtime/ports.yaml'
+PORT_RANGE_START = 10000
+PORT_RANGE_END = 65535
 USER = 'ctf'
+USER_ID = 1337     # uid and gid of USER, fixed so that files put into containers can be owned by its group
 BASEDIR_IN_DOCKER = '/home/' + USER
+DEFAULT_RUN_JOBS = int(os.environ.get('PDT_RUN_JOBS', 16))
+CREATE_RETRIES = 3
+DEFAULT_STOP_TIMEOUT = 2     # xinetd ignores SIGTERM, waiting docker's default 10s is useless
+DEFAULT_BUILD_JOBS = int(os.environ.get('PDT_BUILD_JOBS', min(4, os.cpu_count() or 1)))
+IMAGE_CACHE_TTL = 2.0    # seconds the daemon trusts its image listing when docker events cannot be watched
 
 
 class PrettyPrinter:
     @staticmethod
     def error(message, fore=Fore.RED, back=Back.RESET, style=Style.BRIGHT):
+        if (status := getattr(_thread_output, 'status', None)) is not None:
+            status.failed = True
         print(Fore.RED + PDT_ERROR, end='')
         print(fore + back + style + message + Style.RESET_ALL)
 
@@ -91,6 +115,27 @@ class PrettyPrinter:
             ret += '    ' * indent + str(i) + '\n'
         return ret
 
+    @staticmethod
+    def table(rows: list[list], headers: list[str]) -> str:
+        """
+        render rows as a plain text table, cells may contain multiple lines.
+        :param rows: list of rows, each row is a list of cells
+        :param headers: column names
+        :return: pretty version
+        """
+        cells = [[str(c).split('\n') for c in row] for row in rows]
+        widths = [len(h) for h in headers]
+        for row in cells:
+            for i, c in enumerate(row):
+                widths[i] = max(widths[i], max(len(line) for line in c))
+        lines = ['  '.join(h.ljust(widths[i]) for i, h in enumerate(headers)).rstrip()]
+        for row in cells:
+            height = max(len(c) for c in row)
+            for h in range(height):
+                lines.append('  '.join((c[h] if h < len(c) else '').ljust(widths[i])
+                                       for i, c in enumerate(row)).rstrip())
+        return '\n'.join(lines)
+
     @staticmethod
     def alignment_of_lists(l: list, bound: int):
         """
@@ -171,46 +216,121 @@ def translate_containers(l: list):
     return result
 
 
-def get_free_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as temp_socket:
-        temp_socket.bind(('0.0.0.0', 0))
-        _, port = temp_socket.getsockname()
-        return port
+class LazyModule:
+    """
+    A module imported when one of its attributes is used for the first time, for heavy dependencies which are
+    not needed by every command.
+    """
+
+    def __init__(self, name: str):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, item):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, item)
+
+
+yaml = LazyModule('yaml')
+uuid = LazyModule('uuid')
+
+_thread_output = threading.local()
+
+
+class ThreadOutput:
+    """
+    Stands for sys.stdout and sys.stderr in the daemon. A thread inside capture_output() writes to its own stream,
+    other threads write to the original one, so a reply only carries the output of its own command.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __target(self):
+        stream = getattr(_thread_output, 'stream', None)
+        return stream if stream is not None else self.stream
+
+    def write(self, s: str) -> int:
+        return self.__target().write(s)
+
+    def flush(self) -> None:
+        self.__target().flush()
+
+    def __getattr__(self, item):
+        return getattr(self.stream, item)
 
+    @staticmethod
+    def install() -> None:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+
+
+@contextlib.contextmanager
+def capture_output(stream):
+    """
+    send what the current thread prints to stream, see ThreadOutput.
+    """
+    previous = getattr(_thread_output, 'stream', None)
+    _thread_output.stream = stream
+    try:
+        yield stream
+    finally:
+        _thread_output.stream = previous
+
+
+class CommandStatus:
+    """
+    Whether a command failed: set when it prints an error, commands report failures with PrettyPrinter.error.
+    """
+
+    def __init__(self):
+        self.failed: bool = False
 
-def check_sock_free(port: int):
-    if port < 10000 or port > 65535:
-        PrettyPrinter.error("Illegal sock specified.")
+
+@contextlib.contextmanager
+def command_status():
+    """
+    collect the errors printed by the current thread, and by the pools it starts with inherit_output().
+    """
+    previous = getattr(_thread_output, 'status', None)
+    status = _thread_output.status = CommandStatus()
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as temp_socket:
-            temp_socket.bind(('0.0.0.0', port))
-            _, port = temp_socket.getsockname()
-            return True
-    except socket.error:
-        return False
+        yield status
+    finally:
+        _thread_output.status = previous
 
 
-def analyse_console_table(output: str) -> pd.DataFrame:
+def inherit_output():
+    """
+    :return: initializer of a thread pool, its threads print where the calling thread prints and their errors
+             count for its command
+    """
+    stream = getattr(_thread_output, 'stream', None)
+    status = getattr(_thread_output, 'status', None)
+
+    def initializer():
+        _thread_output.stream = stream
+        _thread_output.status = status
+    return initializer
+
+
+def analyse_console_table(output: str) -> list[dict[str, str]]:
     lines = output.split('\n')
     header = re.split(r'\s{2,}', lines[0])
-    data = [re.split(r'\s{2,}', line) for line in lines[1:-1]]
-    df = pd.DataFrame(data, columns=header)
-    return df
+    return [dict(zip(header, re.split(r'\s{2,}', line))) for line in lines[1:-1]]
 
 
-def save_config(images: list):
-    file = open('./runtime/config.yaml', 'w', encoding='UTF-8')
-    config_data = []
-    for c in images:
-        config_data.append(c.info_dict_for_config)
-    yaml.dump(config_data, file)
-    file.close()
+def load_yaml(path: str):
+    with open(path, 'r') as f:
+        return yaml.load(f.read(), Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 
-def load_config():
-    with open('./runtime/config.yaml', 'r') as f:
-        data = yaml.safe_load(f.read())
-    return data
+def dump_yaml(path: str, data) -> None:
+    # write to a temporary file and rename it, so the file is never left truncated
+    with open(path + '.tmp', 'w', encoding='UTF-8') as f:
+        yaml.dump(data, f, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper))
+    os.replace(path + '.tmp', path)
 
 
 def flag_generator(number: int) -> list:
@@ -220,6 +340,10 @@ def flag_generator(number: int) -> list:
     return ret
 
 
+def flag_id(flag: str) -> str:
+    return hashlib.sha256(flag.encode()).hexdigest()[:16] if flag else ''
+
+
 def file_in_list(files, target):
     for f in files:
         pass
@@ -266,4 +390,10 @@ def validate_ids(value):
         if match.group(2) <= match.group(1):
             raise argparse.ArgumentTypeError(f"Invalid value: {value}. range end must be larger than range start.")
         return match.group(1), match.group(2)
-    raise argparse.ArgumentTypeError(f'Invalid value: {value}. It must be a number or a range.')
\ No newline at end of file
+    raise argparse.ArgumentTypeError(f'Invalid value: {value}. It must be a number or a range.')
+
+def validate_levels(value) -> list[int]:
+    levels = value.split(',')
+    if not all(re.match(r'^[0-9]+$', c) and int(c) >= 1 for c in levels):
+        raise argparse.ArgumentTypeError(f'Invalid value: {value}. It must be positive numbers separated by commas.')
+    return [int(c) for c in levels]